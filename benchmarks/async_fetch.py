@@ -0,0 +1,76 @@
+""" Measure the latency of many concurrent AsyncVault.get() calls.
+
+A temporary vault is filled with one account per service, then the fetches are started together
+with asyncio.gather(). Each fetch's latency runs from the start of the gather to its completion.
+The "spread" run fetches every service about equally; the "hot" run sends every fetch to a few
+services, so most of them are coalesced.
+
+Usage: python benchmarks/async_fetch.py (optional fetches) (optional workers)
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+SERVICES = 1000
+HOT_SERVICES = 10
+
+
+def percentile(values, q):
+    """ Return the q-th percentile of a sorted list. """
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+async def fetch_all(vault, services):
+    """ Fetch every service concurrently.
+
+    :return: the latency of each fetch in milliseconds, sorted, and the total time in seconds.
+    """
+    start = time.perf_counter()
+    latencies = []
+
+    async def fetch(service):
+        await vault.get(service)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(fetch(service) for service in services))
+    return sorted(latencies), time.perf_counter() - start
+
+
+async def run(db_path, fetches, workers):
+    names = ["svc%d" % i for i in range(SERVICES)]
+    runs = {
+        "spread": [random.choice(names) for _ in range(fetches)],
+        "hot": [random.choice(names[:HOT_SERVICES]) for _ in range(fetches)],
+    }
+    async with pwmanager.AsyncVault(db_path, workers=workers) as vault:
+        await fetch_all(vault, names[:workers * 4])  # Open every worker's vault and load its key.
+        for name, services in runs.items():
+            latencies, elapsed = await fetch_all(vault, services)
+            print("%s: %d fetches, %d workers: p50 %.1f ms, p99 %.1f ms, %.0f fetches/sec"
+                  % (name, fetches, workers, percentile(latencies, 50), percentile(latencies, 99),
+                     fetches / elapsed))
+
+
+def main(fetches=1000, workers=pwmanager.ASYNC_WORKERS):
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "store.db")
+        with pwmanager.Vault(db_path) as vault:
+            vault.create()
+            ops = []
+            for i in range(SERVICES):
+                ops.append({"op": "define", "service": "svc%d" % i})
+                ops.append({"op": "add", "service": "svc%d" % i, "username": "user", "password": "password%d" % i})
+            vault.batch(json.dumps(op) for op in ops)
+        asyncio.run(run(db_path, fetches, workers))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*(int(arg) for arg in sys.argv[1:3])))
@@ -0,0 +1,60 @@
+""" Generate a synthetic vault for benchmarking.
+
+Service i is named "service%07d" with shorthand "s%d" and has the accounts "user0", "user1", ...
+Passwords are encrypted with the vault's own key, so every keyword works against the result.
+Encrypting a million passwords one by one would dominate the run, so a pool of distinct
+tokens is encrypted once and reused across accounts.
+
+Usage: python benchmarks/generate_vault.py path (optional accounts) (optional accounts per service)
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+TOKEN_POOL = 1000  # Distinct encrypted passwords reused across the generated accounts.
+INSERT_BATCH = 10000  # Rows per executemany() call.
+
+
+def service_name(i):
+    """ Return the name of the i-th generated service. """
+    return "service%07d" % i
+
+
+def generate(db_path, accounts=10000, accounts_per_service=2):
+    """ Create a vault holding the given number of accounts.
+
+    :param db_path: the path of the database to create. It must not already hold a vault.
+    :param accounts: the number of accounts.
+    :param accounts_per_service: the number of accounts each service has (the last may have fewer).
+    :return: the number of services.
+    """
+    services = -(-accounts // accounts_per_service)
+    with pwmanager.Vault(db_path) as vault:
+        vault.create()
+        tokens = [(vault.encrypt("password-%d" % i), vault.fingerprint("password-%d" % i)) for i in range(TOKEN_POOL)]
+        cursor = vault.connection.cursor()
+        cursor.executemany("INSERT INTO service VALUES(?, ?);",
+                           ((service_name(i), "s%d" % i) for i in range(services)))
+
+        rows = []
+        for n in range(accounts):
+            token, fingerprint = tokens[n % TOKEN_POOL]
+            rows.append(("user%d" % (n % accounts_per_service), token, service_name(n // accounts_per_service),
+                         fingerprint))
+            if len(rows) == INSERT_BATCH:
+                cursor.executemany("INSERT INTO account VALUES(?, ?, ?, ?);", rows)
+                rows = []
+        cursor.executemany("INSERT INTO account VALUES(?, ?, ?, ?);", rows)
+        vault.connection.commit()
+    return services
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    accounts = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    per_service = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    services = generate(sys.argv[1], accounts, per_service)
+    print("Generated %d accounts across %d services in %.1fs." % (accounts, services, time.perf_counter() - start))
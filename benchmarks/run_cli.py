@@ -0,0 +1,36 @@
+""" Run the CLI once and report its peak RSS, for end-to-end benchmarks.
+
+Benchmark hosts usually have no clipboard, so a stand-in pyperclip module is installed that
+discards what GET copies. The peak RSS in KiB is written as the last line of standard error.
+
+Usage: python benchmarks/run_cli.py path/to/pw.py KEYWORD (arguments)
+"""
+import os
+import resource
+import runpy
+import sys
+import types
+
+
+def peak_rss():
+    """ Return the peak RSS of this process in KiB.
+    VmHWM is preferred where available, since on Linux ru_maxrss keeps the parent's peak across exec.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+if __name__ == "__main__":
+    sys.modules["pyperclip"] = types.SimpleNamespace(copy=lambda text: None)
+    sys.argv = sys.argv[1:]
+    sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))  # As if the script was run directly.
+    try:
+        runpy.run_path(sys.argv[0], run_name="__main__")
+    finally:
+        print("peak_rss_kb %d" % peak_rss(), file=sys.stderr)
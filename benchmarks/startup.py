@@ -0,0 +1,120 @@
+""" Check that each keyword starts up within its time budget.
+
+Every keyword is run through run_cli.py and the pw.py entry script a number of times against a small
+generated vault, after a first run that caches pwmanager's bytecode. The median wall time, less the
+median time of an empty script run the same way (interpreter startup), is compared against the
+keyword's budget. Keywords that never decrypt must not import the modules in HEAVY_MODULES, and
+keywords in pwmanager.OFFLINE_KEYWORDS must not create a database.
+
+Usage: python benchmarks/startup.py (optional runs per keyword)
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+from generate_vault import generate, service_name  # noqa: E402
+
+ACCOUNTS = 1000
+RUNS = 20
+HEAVY_MODULES = ("cryptography", "asyncio", "concurrent.futures")
+
+# Milliseconds each keyword may take beyond interpreter startup, with pwmanager's bytecode cached.
+# About twice what they take on a quiet host, so only a real regression (such as a heavy import)
+# fails the check. Keywords marked light must not import HEAVY_MODULES.
+BUDGETS = (
+    # (arguments, standard input, budget, light)
+    (["HELP"], "", 90, True),
+    (["HELP", "GET"], "", 90, True),
+    (["CLEAR"], "", 90, True),
+    (["LS"], "", 100, True),
+    (["LS", "-a", "-u"], "", 100, True),
+    (["SEARCH", "service00000"], "", 100, True),
+    (["COMPLETE", "s1"], "", 100, True),
+    (["GET", service_name(1)], "1\n", 120, False),
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ("pw.py", "pwmanager.py")  # The entry script, and the module it imports.
+RUN_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_cli.py")
+
+
+def run_once(script, args, stdin, env, options=()):
+    """ Run a script through run_cli.py.
+
+    :param options: interpreter options.
+    :return: the standard error output.
+    """
+    # A new session has no terminal, so getpass reads the piped standard input.
+    process = subprocess.run([sys.executable] + list(options) + [RUN_CLI, script] + args, input=stdin.encode(),
+                             env=env, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError("%s failed: %s" % (" ".join(args), process.stderr.decode(errors="replace")))
+    return process.stderr.decode(errors="replace")
+
+
+def median_time(script, args, stdin, env, runs):
+    """ Return the median wall time of several runs in milliseconds. """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_once(script, args, stdin, env)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def heavy_imports(script, args, stdin, env):
+    """ Return the modules in HEAVY_MODULES that a run imports. """
+    errors = run_once(script, args, stdin, env, ("-X", "importtime"))
+    names = {line.split("|")[-1].strip() for line in errors.splitlines() if line.startswith("import time:")}
+    return [name for name in HEAVY_MODULES if name in names]
+
+
+def main(runs=RUNS):
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        generate(os.path.join(directory, "store.db"), ACCOUNTS)
+        for name in SCRIPTS:  # The CLI opens the store.db next to it.
+            shutil.copy(os.path.join(ROOT, name), directory)
+        script = os.path.join(directory, SCRIPTS[0])
+        empty = os.path.join(directory, "empty.py")
+        open(empty, "w").close()
+        env = dict(os.environ, PW_AGENT_SOCK=os.path.join(directory, "agent.sock"))  # Never use a running agent.
+        env.pop("PW_TRACE", None)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)  # Measure with the bytecode cached, as an install would have it.
+        run_once(script, ["HELP"], "", env)  # Compile and cache pwmanager.
+
+        baseline = median_time(empty, [], "", env, runs)
+        print("interpreter startup: %.1f ms" % baseline)
+        for args, stdin, budget, light in BUDGETS:
+            elapsed = median_time(script, args, stdin, env, runs) - baseline
+            heavy = heavy_imports(script, args, stdin, env)
+            print("%-24s %6.1f ms (budget %d ms)%s" % (" ".join(args), elapsed, budget,
+                                                     "" if light else " imports %s" % ", ".join(heavy)))
+            if elapsed > budget:
+                failures.append("%s took %.1f ms, over its budget of %d ms" % (" ".join(args), elapsed, budget))
+            if light and heavy:
+                failures.append("%s imported %s" % (" ".join(args), ", ".join(heavy)))
+
+        offline = os.path.join(directory, "offline")
+        os.makedirs(offline)
+        for name in SCRIPTS:
+            shutil.copy(os.path.join(ROOT, name), offline)
+        for keyword in pwmanager.OFFLINE_KEYWORDS:
+            run_once(os.path.join(offline, SCRIPTS[0]), [keyword], "", env)
+            if os.path.exists(os.path.join(offline, "store.db")):
+                failures.append("%s opened the database" % keyword)
+                os.remove(os.path.join(offline, "store.db"))
+
+    for failure in failures:
+        print("Failed: %s" % failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*(int(arg) for arg in sys.argv[1:2])))
@@ -0,0 +1,103 @@
+""" Stress the connection layer with many concurrent readers and writers.
+
+Threads share a ConnectionPool and extra processes open their own connections, all against
+one temporary vault. Any "database is locked" error is counted and makes the run fail.
+
+Usage: python benchmarks/stress_concurrency.py (optional seconds)
+"""
+import contextlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+READER_THREADS = 16
+WRITER_THREADS = 4
+WRITER_PROCESSES = 4
+
+
+def read_loop(pool, deadline, results):
+    """ Look services up by name or shorthand until the deadline. """
+    ops = errors = 0
+    while time.monotonic() < deadline:
+        try:
+            with pool.connection() as db_connection:
+                db_connection.execute("SELECT account_name, account_pw FROM account WHERE service_name = ("
+                                      "SELECT service_name FROM service WHERE service_name = ? OR shorthand_name = ?);",
+                                      ("svc%d" % (ops % 100), "svc%d" % (ops % 100))).fetchall()
+            ops += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    results.append(("read", ops, errors))
+
+
+def write_loop(db_connection_factory, name, deadline, results):
+    """ Define services and add accounts until the deadline, one transaction each. """
+    ops = errors = 0
+    with db_connection_factory() as db_connection:
+        while time.monotonic() < deadline:
+            try:
+                service = "%s-%d" % (name, ops)
+                db_connection.execute("INSERT INTO service VALUES(?, NULL);", (service,))
+                db_connection.execute("INSERT INTO account VALUES(?, ?, ?, NULL);", ("user", b"token", service))
+                db_connection.commit()
+                ops += 1
+            except sqlite3.OperationalError:
+                db_connection.rollback()
+                errors += 1
+    results.append(("write", ops, errors))
+
+
+def process_writer(db_path, name, deadline, queue):
+    """ Writer running in its own process with its own connection. """
+    results = []
+    write_loop(lambda: contextlib.closing(pwmanager.connect(db_path)), name, deadline, results)
+    queue.put(results[0])
+
+
+def main(seconds=5.0):
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "store.db")
+        with pwmanager.Vault(db_path) as vault:
+            vault.create()
+            for i in range(100):
+                vault.define("svc%d" % i, "s%d" % i)
+
+        pool = pwmanager.ConnectionPool(db_path, size=READER_THREADS + WRITER_THREADS)
+        deadline = time.monotonic() + seconds
+        results = []
+        queue = multiprocessing.Queue()
+
+        processes = [multiprocessing.Process(target=process_writer, args=(db_path, "proc%d" % i, deadline, queue))
+                     for i in range(WRITER_PROCESSES)]
+        threads = [threading.Thread(target=read_loop, args=(pool, deadline, results))
+                   for _ in range(READER_THREADS)]
+        threads += [threading.Thread(target=write_loop, args=(pool.connection, "thread%d" % i, deadline, results))
+                    for i in range(WRITER_THREADS)]
+
+        for worker in processes + threads:
+            worker.start()
+        for thread in threads:
+            thread.join()
+        results += [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        pool.close()
+
+    errors = 0
+    for kind in ("read", "write"):
+        ops = sum(r[1] for r in results if r[0] == kind)
+        kind_errors = sum(r[2] for r in results if r[0] == kind)
+        errors += kind_errors
+        print("%s: %d ops (%.0f/sec), %d locked errors" % (kind, ops, ops / seconds, kind_errors))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) == 2 else 5.0))
@@ -0,0 +1,234 @@
+""" Benchmark the keywords against a synthetic vault, both in-process and end to end.
+
+In-process runs call the Vault API in a fresh interpreter per operation, so peak RSS belongs to
+that operation alone. End-to-end runs invoke the CLI through run_cli.py once per iteration,
+including interpreter startup. Operations that change the vault each get a fresh copy of it.
+
+Results are printed as JSON: throughput, latency percentiles (ms) and peak RSS (KiB) per
+operation. With --baseline, the p50 latency and peak RSS of each operation are compared against
+a stored run, and the suite exits non-zero if any are more than TOLERANCE times worse.
+
+Usage:
+    python benchmarks/suite.py (--accounts n) (--accounts-per-service n) (--iterations n)
+                               (--e2e-iterations n) (--output file) (--baseline file)
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+from generate_vault import generate, service_name  # noqa: E402
+from run_cli import peak_rss  # noqa: E402
+
+OPERATIONS = ("define", "add", "get", "ls", "ls -a", "ls -u", "ls -a -u", "update_service", "remove_service", "backup")
+MUTATING = ("define", "add", "update_service", "remove_service")
+BULK = ("ls", "ls -a", "ls -u", "ls -a -u", "backup")  # Whole-vault operations, run fewer times.
+BULK_ITERATIONS = 5
+TOLERANCE = 1.5  # A result this many times the baseline is a regression.
+NOISE_MS = 0.5  # Latency increases smaller than this are ignored, however large the ratio.
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pwmanager.py")
+RUN_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_cli.py")
+
+
+def percentile(values, q):
+    """ Return the q-th percentile of a sorted list. """
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def summarise(latencies, peak_rss):
+    """ Summarise the latencies (in seconds) of one operation. """
+    latencies = sorted(latencies)
+    return {
+        "iterations": len(latencies),
+        "throughput_per_sec": round(len(latencies) / sum(latencies), 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "peak_rss_kb": peak_rss,
+    }
+
+
+def targets(services, iterations):
+    """ Return distinct service indexes to operate on, the same on every run. """
+    return random.Random(0).sample(range(services), min(iterations, services))
+
+
+def in_process(op, db_path, services, iterations):
+    """ Time an operation through the Vault API. Runs in a worker process (see --worker).
+
+    :return: the latencies in seconds and the peak RSS in KiB.
+    """
+    latencies = []
+    with pwmanager.Vault(db_path) as vault:
+        vault.cipher()  # Load the key outside the timings.
+        for n, i in enumerate(targets(services, iterations)):
+            start = time.perf_counter()
+            if op == "define":
+                vault.define("bench%d" % n)
+            elif op == "add":
+                vault.add(service_name(i), "bench%d" % n, "password")
+            elif op == "get":
+                vault.get(service_name(i), "user0")
+            elif op.startswith("ls"):
+                for _ in vault.list(alphabetical="-a" in op, acc="-u" in op):
+                    pass
+            elif op == "update_service":
+                vault.update_service(service_name(i), "renamed%d" % n)
+            elif op == "remove_service":
+                vault.remove_service(service_name(i))
+            elif op == "backup":
+                vault.backup(os.path.dirname(db_path))
+            latencies.append(time.perf_counter() - start)
+    return latencies, peak_rss()
+
+
+def end_to_end(op, directory, services, iterations):
+    """ Time an operation through the command line, one process per iteration.
+
+    :return: the latencies in seconds and the highest peak RSS of the processes in KiB.
+    """
+    script = os.path.join(directory, "pwmanager.py")  # The CLI opens the store.db next to it.
+    env = dict(os.environ, PW_AGENT_SOCK=os.path.join(directory, "agent.sock"))  # Never use a running agent.
+    latencies = []
+    highest_rss = 0
+    for n, i in enumerate(targets(services, iterations)):
+        args, stdin = {
+            "define": (["DEFINE", "bench%d" % n], ""),
+            "add": (["ADD", service_name(i)], "bench%d\npassword\n" % n),
+            "get": (["GET", service_name(i)], "1\n"),
+            "update_service": (["UPDATE", "-s", service_name(i)], "renamed%d\n\n" % n),
+            "remove_service": (["REMOVE", "-s", service_name(i)], ""),
+            "backup": (["BACKUP", directory], ""),
+        }.get(op, (op.upper().split(), ""))
+
+        start = time.perf_counter()
+        # A new session has no terminal, so getpass reads the piped standard input.
+        process = subprocess.run([sys.executable, RUN_CLI, script] + args, input=stdin.encode(), env=env,
+                                 start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        latencies.append(time.perf_counter() - start)
+        errors = process.stderr.decode(errors="replace")
+        if process.returncode != 0:
+            raise RuntimeError("%s failed: %s" % (op, errors))
+        highest_rss = max(highest_rss, int(errors.split()[-1]))
+    return latencies, highest_rss
+
+
+def prepare(template, directory):
+    """ Copy the generated vault and the CLI script into a directory. """
+    os.makedirs(directory)
+    shutil.copy(template, os.path.join(directory, "store.db"))
+    shutil.copy(SCRIPT, os.path.join(directory, "pwmanager.py"))
+
+
+def run(accounts, accounts_per_service, iterations, e2e_iterations):
+    """ Generate a vault and benchmark every operation against it.
+
+    :return: the results dict.
+    """
+    results = {
+        "accounts": accounts,
+        "accounts_per_service": accounts_per_service,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "in_process": {},
+        "end_to_end": {},
+    }
+    with tempfile.TemporaryDirectory() as work:
+        template = os.path.join(work, "template.db")
+        start = time.perf_counter()
+        services = generate(template, accounts, accounts_per_service)
+        results["services"] = services
+        results["generate_s"] = round(time.perf_counter() - start, 2)
+        prepare(template, os.path.join(work, "read"))  # Shared by the operations that don't write.
+
+        for op in OPERATIONS:
+            directory = os.path.join(work, "read")
+            if op in MUTATING:
+                directory = os.path.join(work, op)
+                prepare(template, directory)
+
+            n = BULK_ITERATIONS if op in BULK else iterations
+            worker = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", op,
+                                     os.path.join(directory, "store.db"), str(services), str(n)],
+                                    check=True, stdout=subprocess.PIPE)
+            results["in_process"][op] = summarise(*json.loads(worker.stdout))
+
+            if op in MUTATING:  # Start the end-to-end run from the same state.
+                shutil.rmtree(directory)
+                prepare(template, directory)
+            n = min(BULK_ITERATIONS, e2e_iterations) if op in BULK else e2e_iterations
+            results["end_to_end"][op] = summarise(*end_to_end(op, directory, services, n))
+            print("%s done." % op, file=sys.stderr)
+    return results
+
+
+def compare(results, baseline):
+    """ Compare results against a baseline run.
+
+    :return: a list of regression descriptions, empty if there are none.
+    """
+    shape = ("accounts", "accounts_per_service")
+    if [results[key] for key in shape] != [baseline[key] for key in shape]:
+        print("Baseline was run with %d accounts (%d per service); results may not be comparable."
+              % (baseline["accounts"], baseline["accounts_per_service"]), file=sys.stderr)
+
+    regressions = []
+    for mode in ("in_process", "end_to_end"):
+        for op, result in results[mode].items():
+            before = baseline.get(mode, {}).get(op)
+            if before is None:
+                continue
+            for metric in ("p50_ms", "peak_rss_kb"):
+                if metric == "p50_ms" and result[metric] - before[metric] < NOISE_MS:
+                    continue
+                if before[metric] and result[metric] > before[metric] * TOLERANCE:
+                    regressions.append("%s %s: %s %.3f -> %.3f (%.1fx)" % (
+                        mode, op, metric, before[metric], result[metric], result[metric] / before[metric]))
+    return regressions
+
+
+def main():
+    if len(sys.argv) == 6 and sys.argv[1] == "--worker":  # Run one in-process operation and print its timings.
+        op, db_path, services, iterations = sys.argv[2:]
+        print(json.dumps(in_process(op, db_path, int(services), int(iterations))))
+        return 0
+
+    parser = argparse.ArgumentParser(description="Benchmark the keywords against a synthetic vault.")
+    parser.add_argument("--accounts", type=int, default=10000, help="accounts in the generated vault (1k to 1M)")
+    parser.add_argument("--accounts-per-service", type=int, default=2, help="accounts each service has")
+    parser.add_argument("--iterations", type=int, default=200, help="in-process iterations per operation")
+    parser.add_argument("--e2e-iterations", type=int, default=10, help="CLI invocations per operation")
+    parser.add_argument("--output", help="also write the results to this file, e.g. to store a new baseline")
+    parser.add_argument("--baseline", help="compare against the results stored in this file")
+    args = parser.parse_args()
+
+    results = run(args.accounts, args.accounts_per_service, args.iterations, args.e2e_iterations)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print("Regression: %s" % regression, file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against %s." % args.baseline, file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,10 @@
+""" Command line entry point. Usage: python pw.py KEYWORD (arguments), or python pw.py HELP for the keywords.
+
+Running pwmanager.py directly works too, but Python compiles the script it's given on every run,
+and pwmanager.py is large enough for that to be most of a quick keyword's time. Imported from here,
+its compiled bytecode is cached in __pycache__ and reused.
+"""
+import pwmanager
+
+if __name__ == "__main__":
+    pwmanager.main()
@@ -1,739 +1,4444 @@
-from cryptography.fernet import Fernet
+import time
+
+_started = time.perf_counter()  # When the imports below began, for the import span of a trace.
+
+# cryptography, pyperclip, asyncio and concurrent.futures are slow to load and most commands
+# need at most one of them, so they are imported on first use through lazy_import().
+
+import base64
+import bisect
+import collections
+import contextlib
+import csv
 import getpass
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import mmap
 import os
-import pyperclip
+import queue
+import socket
+import socketserver
 import sqlite3
+import stat
 import sys
+import tempfile
+import threading
 
 
-# TODO: Add print statement if ls is used and returns no results.
+BUSY_TIMEOUT_MS = 5000  # How long a connection waits for another writer before giving up.
+POOL_SIZE = 8  # Connections kept by a ConnectionPool.
+ASYNC_WORKERS = 4  # Worker threads (each with its own connection) behind an AsyncVault.
+FEDERATION_WORKERS = 4  # Threads a VaultSet fans lookups out over.
 
-# ---------- Query Functions ---------- #
+VAULTS_DIRECTORY = "vaults"  # Named vaults are VAULTS_DIRECTORY/name.db next to the script.
+FEDERATED_KEYWORDS = ("GET", "LS", "SEARCH")  # Keywords that can run across several vaults at once.
 
+IMPORT_BATCH_SIZE = 1000  # Rows encrypted and written per executemany() call.
+EXPORT_CHUNK_SIZE = 1000  # Rows per encrypted chunk in an export archive.
+EXPORT_HEADER = "PWMANAGER-EXPORT 1"  # First line of an encrypted export archive.
 
-def get_service_info(name):
-    """ Return the service name (key) and shorthand using the input to
-    find a row match in either the service name or shorthand columns.
+BACKUP_PAGES_PER_STEP = 1024  # Pages copied per backup step; the vault is only locked during a step.
+BACKUP_RETENTION = 5  # Rotating snapshots kept by BACKUP -r.
+BACKUP_SNAPSHOT_FORMAT = "_backup_%Y%m%d-%H%M%S.db"  # After the vault's file name, e.g. store_backup_...
 
-    :param name: service name or shorthand.
-    :return: the service name and shorthand stored in the db.
-    """
-    cursor.execute("SELECT service_name, shorthand_name FROM service WHERE service_name = ? OR shorthand_name = ?;",
-                   (name, name))
+SEARCH_PAGE_SIZE = 20  # Results per page of SEARCH.
+ROTATE_CHUNK_SIZE = 2000  # Passwords re-encrypted per worker task and checkpoint.
+VERIFY_CHUNK_SIZE = 5000  # Passwords checked per worker task by VERIFY.
+CHANGE_LOG_NOW = "(julianday('now') - 2440587.5) * 86400.0"  # Unix time in SQL, for the SYNC change log.
+MIGRATE_CHUNK_SIZE = 10000  # Passwords converted per statement by a storage format migration.
+BREACH_CHUNK_SIZE = 5000  # Passwords checked per worker task by BREACH AUDIT.
+FINGERPRINT_CHUNK_SIZE = 5000  # Passwords fingerprinted per worker task by AUDIT, for accounts without one.
+FINGERPRINT_SIZE = 16  # Bytes of each password's HMAC-SHA256 fingerprint kept.
 
-    rec = cursor.fetchone()
-    if rec is None:
-        return None
-    else:  # Record exists.
-        return rec[0], rec[1]  # [0] = name, [1] = shorthand.
+BREACH_INDEX_FILE = "breach.idx"  # The breach index next to the script, unless PW_BREACH_INDEX is set.
+BREACH_INDEX_MAGIC = b"PWBRIDX1"  # First bytes of a breach index.
+BREACH_FANOUT = 2 ** 16  # Buckets in a breach index's fanout table, one per first two bytes of a hash.
+BREACH_RUN_SIZE = 2000000  # Hashes sorted in memory at a time while building a breach index.
 
+KDF_TARGET_MS = 500  # Target time to derive the key from the master password.
+KDF_MIN_N = 2 ** 14  # Starting scrypt cost for calibration.
+KDF_MAX_N = 2 ** 20  # Highest scrypt cost calibration will pick (1 GiB of memory at r=8).
+KDF_R = 8
+KDF_P = 1
+SESSION_TIMEOUT = 300  # Seconds an unlocked master password is remembered.
 
-def get_service_name(name):
-    cursor.execute("SELECT service_name FROM service WHERE service_name = ? OR shorthand_name = ?;", (name, name))
+AGENT_IDLE_TIMEOUT = 900  # Seconds without a request before the agent exits.
+AGENT_KEYWORDS = ("GET", "LS", "ADD")  # Keywords the CLI forwards to a running agent.
+OFFLINE_KEYWORDS = ("HELP", "CLEAR", "VAULTS")  # Keywords that run without opening the database.
 
-    rec = cursor.fetchone()
-    if rec is None:
-        return None
-    else:
-        return rec[0]
+SECRET_CACHE_SIZE = 256  # Decrypted passwords kept by a SecretCache, such as the agent's.
+SECRET_CACHE_TTL = 60  # Seconds a decrypted password stays cached.
 
+TRACE_NAME_WIDTH = 60  # Characters of each span name shown in a trace printed to standard error.
 
-def check_service_unique(name):
-    """ Check that the service name isn't already in use as
-    another service name or shorthand.
+# Column names used by other password managers' exports, mapped to our fields.
+IMPORT_FIELDS = {
+    "service": ("service", "service_name", "name", "title"),
+    "shorthand": ("shorthand", "shorthand_name"),
+    "username": ("username", "account", "account_name", "login_username", "login", "user"),
+    "password": ("password", "account_pw", "login_password"),
+}
 
-    :param name: the name of the service.
-    :return: true if no occurrences, false otherwise
-    """
-    cursor.execute("SELECT * FROM service WHERE service_name = ? OR shorthand_name = ?;", (name, name))
 
-    return len(cursor.fetchall()) < 1
+# ---------- Errors ---------- #
 
 
-def check_shorthand_unique(shorthand):
-    """ Check that the shorthand name isn't already in use as
-    a service name or another shorthand.
+class VaultError(Exception):
+    """ Base class of the errors raised by Vault. The message is suitable for showing to the user. """
 
-    :param shorthand: the shorthand name.
-    :return: true if no occurrences, false otherwise.
-    """
-    cursor.execute("SELECT * FROM service WHERE service_name = ? OR shorthand_name = ?;", (shorthand, shorthand))
 
-    return len(cursor.fetchall()) < 1
+class TablesMissingError(VaultError):
+    """ The vault's tables haven't been created. """
 
 
-def get_accounts_from_service(service):
-    """ Get the account name(s) and password(s) for a specified service
-    via name or shorthand.
+class TablesExistError(VaultError):
+    """ The vault's tables already exist. """
 
-    :param service: the service name or shorthand.
-    :return: accounts, or None if there are no accounts.
-    """
-    cursor.execute("""SELECT account_name, account_pw FROM account WHERE service_name = (
-                    SELECT service_name FROM service WHERE service_name = ? OR shorthand_name = ?);""",
-                   (service, service))
 
-    accounts = cursor.fetchall()
-    if len(accounts) == 0:
-        return None
-    else:
-        return accounts
+class ServiceNotFoundError(VaultError):
+    """ No service has the given name or shorthand. """
 
+    def __init__(self, name):
+        super().__init__("Service doesn't exist.")
+        self.name = name
 
-def encrypt(pw):
-    """ Encrypt a password using the stored key.
 
-    :param pw: the password to encrypt.
-    :return: the encrypted password.
-    """
-    cursor.execute("""SELECT key FROM encryption;""")
-    key = cursor.fetchone()[0]
-    cipher = Fernet(key)
-    return cipher.encrypt(str.encode(pw))
+class AccountNotFoundError(VaultError):
+    """ The service has no account with the given username, or no accounts at all. """
 
 
-def decrypt(enc_pw):
-    """ Decrypt a password using the stored key.
+class AmbiguousAccountError(VaultError):
+    """ The service has several accounts and no username was given to choose between them. """
 
-    :param enc_pw: the password to be decrypted.
-    :return: the decrypted password (in bytes).
-    """
-    cursor.execute("""SELECT key FROM encryption;""")
-    key = cursor.fetchone()[0]
-    cipher = Fernet(key)
-    return cipher.decrypt(enc_pw)
+    def __init__(self, usernames):
+        super().__init__("The service has %d accounts. Provide the username." % len(usernames))
+        self.usernames = usernames
 
 
-def tables_exist():
-    """ Check if the database tables exist inside the database.
+class NameConflictError(VaultError):
+    """ A service name, shorthand or username is already in use. """
 
-    :return: true if they exist, false otherwise.
-    """
 
-    cursor.execute("""SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'encryption';""")
-    return len(cursor.fetchall()) > 0
+class MasterPasswordError(VaultError):
+    """ The master password is wrong, or is needed and there is no way to ask for it. """
 
 
-# ---------- Main Menu ---------- #
+# ---------- Tracing ---------- #
 
 
-def menu():
-    """ Menu - use cl arguments to go to specific functions.
-    Service name and shorthand arguments are made lower case - avoids case sensitivity.
+_tracer = None  # The Tracer of this command, if --profile or PW_TRACE turned tracing on.
+
+
+class Tracer:
+    """ Collects timing spans over one command, aggregated by kind and name.
+    Kinds are "import", "connect", "command", "sql" (one span per distinct statement) and "crypto".
     """
-    # Help screen if no arguments provided.
-    if len(sys.argv) == 1:
-        info()
 
-    # Define a service.
-    elif sys.argv[1].upper() == "DEFINE":
-        if len(sys.argv) == 4:
-            define(service=sys.argv[2].lower(),
-                   shorthand=sys.argv[3].lower())  # Name and shorthand.
-        elif len(sys.argv) == 3:
-            define(sys.argv[2].lower())  # Just name.
+    def __init__(self, destination, profile_path=None):
+        """
+        :param destination: "stderr", or the path of a JSONL file the trace is appended to.
+        :param profile_path: if given, the command also runs under cProfile and the stats are dumped here.
+        """
+        self.destination = destination
+        self.spans = {}  # (kind, name) -> [count, seconds, rows]
+        self.lock = threading.Lock()  # AsyncVault workers and the agent record spans from several threads.
+        self.add("import", "modules", time.perf_counter() - _started)
+
+        self.profile_path = profile_path
+        self.profiler = None
+        if profile_path is not None:
+            self.profiler = lazy_import("cProfile").Profile()
+            self.profiler.enable()
+
+    def add(self, kind, name, seconds, rows=0, count=1):
+        """ Record a span, or add to an existing span of the same kind and name. """
+        with self.lock:
+            span = self.spans.setdefault((kind, name), [0, 0.0, 0])
+            span[0] += count
+            span[1] += seconds
+            span[2] += rows
+
+    @contextlib.contextmanager
+    def span(self, kind, name):
+        """ Time the block as a span. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(kind, name, time.perf_counter() - start)
+
+    def finish(self, command):
+        """ Stop profiling and write out the trace of the command. """
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+
+        total = time.perf_counter() - _started
+        spans = [{"kind": kind, "name": name, "count": count, "ms": round(seconds * 1000, 3), "rows": rows}
+                 for (kind, name), (count, seconds, rows) in self.spans.items()]
+        if self.destination == "stderr":
+            print("Trace of %s: %.3f ms" % (command, total * 1000), file=sys.stderr)
+            for span in spans:
+                name = span["name"]
+                if len(name) > TRACE_NAME_WIDTH:
+                    name = name[:TRACE_NAME_WIDTH - 3] + "..."
+                print("  %-8s %-*s %10.3f ms %6dx %8d rows" % (span["kind"], TRACE_NAME_WIDTH, name, span["ms"],
+                                                               span["count"], span["rows"]), file=sys.stderr)
+            if self.profile_path is not None:
+                print("Profile written to %s" % self.profile_path, file=sys.stderr)
         else:
-            print("Invalid number of arguments. Provide a name and optional shorthand.")
+            with open(self.destination, "a") as f:
+                f.write(json.dumps({"time": time.time(), "command": command, "total_ms": round(total * 1000, 3),
+                                    "spans": spans}) + "\n")
 
-    # Add an account for a specific service.
-    elif sys.argv[1].upper() == "ADD":
-        if len(sys.argv) != 3:
-            print("Invalid number of arguments. Provide the name of the service for the account.")
-        else:
-            add(sys.argv[2].lower())
 
-    # Update an existing service or account.
-    elif sys.argv[1].upper() == "UPDATE":
-        if len(sys.argv) == 4:
-            if sys.argv[2].lower() == "-a":
-                update_account(sys.argv[3].lower())
-            elif sys.argv[2].lower() == '-s':
-                update_service(sys.argv[3].lower())
-            else:
-                print("Invalid key. Use -a or -s.")
-        else:
-            print("Invalid number of arguments. Provide the key -s or -a, and the service.")
+class TracedCursor(sqlite3.Cursor):
+    """ Cursor that records a span for each statement it runs: the executions, the time spent
+    executing and fetching, and the rows fetched or changed. Only used while tracing.
+    """
 
-    # Retrieve the password of an account.
-    elif sys.argv[1].upper() == "GET":
-        if len(sys.argv) == 3:
-            get(sys.argv[2].lower())
-        else:
-            print("Invalid number of arguments. Provide the service of the account.")
+    def execute(self, sql, parameters=()):
+        self.trace_name = " ".join(sql.split())
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        _tracer.add("sql", self.trace_name, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
 
-    # Delete an account or service.
-    elif sys.argv[1].upper() == "REMOVE":
-        if len(sys.argv) == 4:
-            if sys.argv[2].lower() == "-a":
-                remove_account(sys.argv[3].lower())
-            elif sys.argv[2].lower() == "-s":
-                remove_service(sys.argv[3].lower())
+    def executemany(self, sql, seq_of_parameters):
+        self.trace_name = " ".join(sql.split())
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        _tracer.add("sql", self.trace_name, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
 
-            elif sys.argv[2].lower() == "-b":
-                remove_backup(sys.argv[3])
-            else:
-                print("Invalid key. Use -a or -s.")
-        else:
-            print("Invalid number of arguments. Provide the key -s or -a, and the service.")
+    def executescript(self, sql_script):
+        self.trace_name = " ".join(sql_script.split())
+        start = time.perf_counter()
+        super().executescript(sql_script)
+        _tracer.add("sql", self.trace_name, time.perf_counter() - start)
+        return self
 
-    # List all services (and other information).
-    elif sys.argv[1].upper() == "LS":
-        alpha = False
-        acc = False
-        if "-a" in sys.argv:
-            alpha = True
-        if "-u" in sys.argv:
-            acc = True
-        ls(alpha, acc)
+    def fetched(self, start, rows):
+        """ Add the time and rows of a fetch to the span of the last statement. """
+        _tracer.add("sql", self.trace_name, time.perf_counter() - start, rows, count=0)
 
-    # Clear the clipboard.
-    elif sys.argv[1].upper() == "CLEAR":
-        clear()
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, row is not None)
+        return row
 
-    # Display help information.
-    elif sys.argv[1].upper() == "HELP":
-        if len(sys.argv) == 3:  # Extra argument for specific information.
-            info(sys.argv[2].upper())
-        else:
-            info()
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.fetched(start, len(rows))
+        return rows
 
-    # Create the database tables.
-    elif sys.argv[1].upper() == "CREATE":
-        if len(sys.argv) == 3:
-            if sys.argv[2].upper() == "CONFIRM":
-                create(connection)
-            else:
-                print("Type CONFIRM after CREATE.")
-        else:
-            print("Invalid number of arguments. Type CONFIRM after CREATE.")
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows))
+        return rows
 
-    # Drop the database tables.
-    elif sys.argv[1].upper() == "DROP":
-        if len(sys.argv) == 3:
-            if sys.argv[2].upper() == "CONFIRM":
-                drop(connection)
-            else:
-                print("Table deletion requires confirmation. Type CONFIRM after DROP.")
-        else:
-            print("Invalid number of arguments. Type CONFIRM after DROP.")
+    def __next__(self):
+        start = time.perf_counter()
+        row = super().__next__()
+        self.fetched(start, 1)
+        return row
 
-    elif sys.argv[1].upper() == "BACKUP":
-        if len(sys.argv) == 2:
-            backup()
-        elif len(sys.argv) == 3:
-            backup(sys.argv[2])
-        elif len(sys.argv) == 4 & sys.argv[2].upper() == "REMOVE":
-            # TODO: Remove the backup at the specified file path.
-            #  CM-Line Form 1: pw backup remove filepath   - verbose
-            #  CM-Line Form 2: pw remove -b filepath   - makes use of the remove keyword already defined.
-            #    ... so, just alter the "if arg == remove" part.
-            #    ... consider the db connection, what happens if the filepath doesn't have a db?
-            #    - we dont want to create a new one.
-            print("")
 
-        else:
-            print("Invalid number of arguments.")
+class TracedConnection(sqlite3.Connection):
+    """ Connection whose cursors, including those of its execute() shortcuts, are TracedCursors. """
 
-    else:
-        print("Invalid keyword. Type HELP for more information.")
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
 
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
 
-# ---------- Utility Functions ---------- #
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
 
-def define(service, shorthand=None):
-    """ Define a service using a name and optional shorthand.
-    Add it to the database if there are no naming conflicts.
-    Service name and shorthand are converted to lowercase to avoid case sensitivity.
 
-    :param service: the name of the service.
-    :param shorthand: the (optional) shorthand of the name, for ease of use.
-    """
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
+def trace(kind, name):
+    """ Time a block as a span of the current trace, if tracing is on.
 
-    if shorthand is None:  # Only check for name conflicts.
-        cursor.execute("""SELECT * FROM service WHERE
-                        service_name = ?
-                        OR shorthand_name = ?;""", (service, service))
-    else:  # Check for name and shorthand conflicts.
-        cursor.execute("""SELECT * FROM service WHERE
-                        service_name = ?
-                        OR shorthand_name = ?
-                        OR service_name = ?
-                        OR shorthand_name = ?;""", (service, service, shorthand, shorthand))
-
-    if len(cursor.fetchall()) != 0:  # Name/shorthand exist elsewhere.
-        print("Name/shorthand already in use.")
-    else:  # Service name and shorthand don't conflict. Create entry.
-        if shorthand is None:
-            cursor.execute("INSERT INTO service VALUES(?, null );", (service,))
-            print("Service '%s' added." % service)
-        else:
-            cursor.execute("INSERT INTO service VALUES(?, ?);", (service, shorthand))
-            print("Service '%s' (%s) added." % (service, shorthand))
-        connection.commit()
+    :return: a context manager.
+    """
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(kind, name)
 
 
-def add(service):
-    """ Check a service exists. Ask for username and password. Store the account.
+def lazy_import(name):
+    """ Import a module the first time it is needed, timing the import as a span of the trace.
 
-    :param service: the service to create an account for (either name or shorthand).
+    :param name: the full name of the module, e.g. "cryptography.fernet".
+    :return: the module.
     """
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
-
-    cursor.execute("""SELECT service_name FROM service WHERE service_name = ? OR shorthand_name == ?;""",
-                   (service, service))
-    rec = cursor.fetchone()
+    module = sys.modules.get(name)
+    if module is None:
+        with trace("import", name):
+            __import__(name)
+        module = sys.modules[name]
+    return module
+
+
+def start_trace():
+    """ Turn tracing on if --profile comes before the keyword (it is removed from the arguments)
+    or the PW_TRACE environment variable is set. PW_TRACE is "stderr" (or "1") to print the trace
+    to standard error, or the path of a JSONL file to append it to; --profile prints it to standard
+    error unless PW_TRACE says otherwise. --profile=file also dumps cProfile stats to the file.
+    """
+    global _tracer
+    destination = os.environ.get("PW_TRACE")
+    profile_path = None
+    if len(sys.argv) > 1 and (sys.argv[1] == "--profile" or sys.argv[1].startswith("--profile=")):
+        profile_path = sys.argv.pop(1).partition("=")[2] or None
+        destination = destination or "stderr"
+    if destination:
+        _tracer = Tracer("stderr" if destination == "1" else destination, profile_path)
 
-    if rec is None:
-        print("Service doesn't exist. Define a service using the DEFINE keyword.")
-    else:
-        username = input("Enter Username\n > ")
-        # Check email doesn't already exist for the service..
-        cursor.execute("""SELECT * FROM account WHERE account_name = ? AND service_name = ?;""", (username, rec[0]))
 
-        if len(cursor.fetchall()) == 0:  # Account doesn't exist.
-            pw = getpass.getpass("Enter Password\n > ")
-            # Encrypt password, convert type into string.
-            enc_pw = encrypt(pw)
+def finish_trace():
+    """ Write out the trace of the command, if tracing is on. """
+    if _tracer is not None:
+        _tracer.finish(sys.argv[1].upper() if len(sys.argv) > 1 else "HELP")
 
-            # Add account.
-            cursor.execute("""INSERT INTO account VALUES (?, ?, ?);""", (username, enc_pw, rec[0]))
-            connection.commit()
-            print("Account added.")
 
-        else:
-            print("An account with this username already exists.")
+# ---------- Connection Functions ---------- #
 
 
-def get(service):
-    """ Get the account for a specific service using its name or shorthand.
-    Multiple accounts require input to determine what account's password to return.
+def connect(db_path, check_same_thread=True):
+    """ Open a connection to a database with the settings every connection should use:
+    WAL journaling so readers and a writer don't block each other, a busy timeout so
+    concurrent writers wait their turn instead of failing, and enforced foreign keys.
 
-    :param service: name or shorthand of the service.
+    :param db_path: the path to the database file.
+    :param check_same_thread: passed to sqlite3.connect(). Pooled connections move between threads.
+    :return: the connection.
+    """
+    db_connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=check_same_thread,
+                                    factory=sqlite3.Connection if _tracer is None else TracedConnection)
+    db_connection.execute("PRAGMA journal_mode = WAL;")
+    db_connection.execute("PRAGMA busy_timeout = %d;" % BUSY_TIMEOUT_MS)
+    db_connection.execute("PRAGMA synchronous = NORMAL;")  # Durable across crashes in WAL mode, fewer fsyncs.
+    db_connection.execute("PRAGMA foreign_keys = ON;")
+    return db_connection
+
+
+class ConnectionPool:
+    """ Thread-safe pool of connections to one database.
+    Each connection is used by one thread at a time and returned to the pool afterwards.
     """
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
 
-    ser = get_service_name(service)
-    if ser is None:
-        print("Service doesn't exist.")
-    else:
-        rec = get_accounts_from_service(service)
-        if rec is None:
-            print("This service doesn't have any associated accounts.")
-        elif len(rec) == 1:
-            pw_bytes = decrypt(rec[0][1])
-            pyperclip.copy(pw_bytes.decode("utf-8", "strict"))
-            print("Password copied to clipboard. (username: %s)" % rec[0][0])
-        else:
-            print("Which account? (enter number)")
-            for i in range(0, len(rec)):
-                print("[%d] %s" % (i+1, rec[i][0]))
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self.idle = queue.LifoQueue()  # Most recently used first, so caches stay warm.
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Borrow a connection, waiting if all of them are in use.
+        The transaction is committed if the block succeeds and rolled back otherwise.
+        """
+        with self.slots:
             try:
-                acc = int(input(" > "))
-                try:
-                    pw_bytes = decrypt(rec[acc-1][1])
-                    pyperclip.copy(pw_bytes.decode("utf-8", "strict"))
-                    print("Password copied to clipboard.")
-                except IndexError:
-                    print("Invalid choice.")
-            except ValueError:
-                print("Invalid input.")
+                db_connection = self.idle.get_nowait()
+            except queue.Empty:
+                db_connection = connect(self.db_path, check_same_thread=False)
+            try:
+                yield db_connection
+                db_connection.commit()
+            except BaseException:
+                db_connection.rollback()
+                raise
+            finally:
+                self.idle.put(db_connection)
+
+    def close(self):
+        """ Close every idle connection. """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
 
 
-def update_account(service):
-    """ Update an account with a new username and password.
+# ---------- Key Derivation ---------- #
 
-    :param service: the service to which the account belongs.
+
+def derive_kek(password, salt, n, r, p):
+    """ Derive the key-encryption key from the master password with scrypt.
+
+    :return: the key-encryption key, usable as a Fernet key.
     """
+    kdf = lazy_import("cryptography.hazmat.primitives.kdf.scrypt").Scrypt(salt=salt, length=32, n=n, r=r, p=p)
+    with trace("crypto", "scrypt"):
+        return base64.urlsafe_b64encode(kdf.derive(password.encode()))
 
-    def write_update(new_name, pw, old_name):
-        """ Write the updated information to the database.
 
-        :param new_name: The new account username.
-        :param pw: The new account password.
-        :param old_name: The old account username.
-        """
-        cursor.execute("UPDATE account SET account_name = ?, account_pw = ? WHERE account_name = ?;",
-                       (new_name, pw, old_name))
-        connection.commit()
-        print("Account updated. (%s -> %s)" % (old_name, new_name))
+def calibrate_kdf(target_ms=KDF_TARGET_MS):
+    """ Find the scrypt cost that takes at least the target time to derive a key on this host.
+    The cost doubles until the target is met, capped at KDF_MAX_N to bound memory use.
 
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
+    :param target_ms: the target unlock time in milliseconds.
+    :return: a list of (n, milliseconds) measurements. The last n is the one to use.
+    """
+    results = []
+    n = KDF_MIN_N
+    while True:
+        start = time.perf_counter()
+        derive_kek("calibration", os.urandom(16), n, KDF_R, KDF_P)
+        elapsed = (time.perf_counter() - start) * 1000
+        results.append((n, elapsed))
+        if elapsed >= target_ms or n >= KDF_MAX_N:
+            return results
+        n *= 2
 
-    rec = get_accounts_from_service(service)
-    if rec is None:
-        print("Account or service doesn't exist.")
-    elif len(rec) == 1:
-        # One account exists. No need to check for conflicts.
-        username = input("Enter Username\n > ")
-        pw = getpass.getpass("Enter Password\n > ")
-        enc_pw = encrypt(pw)
 
-        write_update(username, enc_pw, rec[0][0])
+# ---------- Token Storage ---------- #
 
-    else:  # Multiple accounts.
-        print("Which account? (enter number)")
-        for i in range(0, len(rec)):
-            print("[%d] %s" % (i+1, rec[i][0]))
 
-        try:
-            acc = int(input(" > "))
-            # Check it exists.
-            if acc-1 <= len(rec):
-                username = input("Enter Username\n > ")
-
-                # If the username is different from the current one, check that it doesn't conflict.
-                if username != rec[acc-1][0]:  # entered different username.
-                    cursor.execute("""SELECT * FROM account WHERE account_name = ? AND service_name = ?;""",
-                                   (username, service))
-                    check_account = cursor.fetchone()
-                    if check_account is not None:
-                        print("This username is already associated with another account.")
-                        return
-
-                pw = getpass.getpass("Enter Password\n > ")
-                enc_pw = encrypt(pw)
-                write_update(username, enc_pw, rec[acc-1][0])
-        except ValueError:
-            print("Invalid input.")
+def pack_token(token):
+    """ Return a Fernet token in the form passwords are stored: the raw token bytes in a BLOB,
+    rather than the base64 text Fernet produces, which is a third larger.
 
+    :param token: a Fernet token, base64 or already raw.
+    :return: the raw token.
+    """
+    if isinstance(token, bytes) and token[:1] == b"\x80":  # Raw tokens start with the Fernet version byte.
+        return token
+    return base64.urlsafe_b64decode(token)
 
-def update_service(service):
-    """ Update a service with a new name and (optional) shorthand.
 
-    :param service: the service to be updated.
+def unpack_token(stored):
+    """ Return a stored password as a Fernet token. Raw tokens are base64-encoded again; base64
+    tokens stored by older versions (which start with "g") are returned as they are.
+
+    :param stored: the stored password.
+    :return: the token, as Fernet expects it.
     """
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
+    if isinstance(stored, bytes) and stored[:1] == b"\x80":
+        return base64.urlsafe_b64encode(stored)
+    return stored
 
-    service_info = get_service_info(service)
 
-    if service_info is None:
-        print("Service doesn't exist.")
-        return
+# ---------- Service Index ---------- #
 
-    # Unpack stored service information.
-    stored_name, stored_short = service_info
 
-    new_name = input("New Service Name:\n > ").lower()
-    # Avoid running elif. Indicative of poor structure but works for now.
-    if new_name == stored_short:
-        pass
+class ServiceIndex:
+    """ In-memory index of service names and shorthands for prefix and fuzzy lookup.
+    Keys are kept in a sorted list, which serves prefix search with a binary search and doubles
+    as a trie for fuzzy search: keys sharing a prefix are adjacent, so the edit distance to
+    a prefix is worked out once for all of them, and a prefix already too far from the name
+    is skipped over without looking at its keys. Nothing else needs to be built.
+    """
 
-    elif new_name != stored_name:
-        if not check_service_unique(new_name):  # New name conflicts with stored data.
-            print("Name already in use elsewhere.")
+    def __init__(self):
+        self.keys = []  # Sorted names and shorthands.
+        self.services = {}  # Name or shorthand -> service name.
+
+    def load(self, db_connection):
+        """ Build the index from the service table.
+
+        :param db_connection: the connection to the vault's database.
+        """
+        cursor = db_connection.cursor()
+        cursor.execute("SELECT service_name, shorthand_name FROM service;")
+        for service, shorthand in cursor:
+            self.services[service] = service
+            if shorthand:
+                self.services.setdefault(shorthand, service)
+        self.keys = sorted(self.services)
+
+    def add_key(self, key, service):
+        if key in self.services:
             return
+        bisect.insort(self.keys, key)
+        self.services[key] = service
 
-    new_short = input("New Shorthand Name: (press enter to skip)\n > ").lower()
-    if new_short != stored_short:
-        if not check_shorthand_unique(new_short):  # New shorthand conflicts with stored data.
-            print("Shorthand already in use elsewhere.")
+    def remove_key(self, key):
+        if key not in self.services:
             return
+        del self.keys[bisect.bisect_left(self.keys, key)]
+        del self.services[key]
 
-    if new_short == "":  # Update without shorthand.
-        cursor.execute("UPDATE service SET service_name = ?, shorthand_name = NULL WHERE service_name = ?;",
-                       (new_name, stored_name))
-    else:  # Update with shorthand.
-        cursor.execute("UPDATE service SET service_name = ?, shorthand_name = ? WHERE service_name = ?;",
-                       (new_name, new_short, stored_name))
-    connection.commit()
+    def add(self, service, shorthand=None):
+        """ Index a service and its optional shorthand.
 
-    # Update references to the old name in the account table.
-    cursor.execute("UPDATE account SET service_name = ? WHERE service_name = ?;", (new_name, stored_name))
-    connection.commit()
-    print("Service updated.")
+        :param service: the service name.
+        :param shorthand: the shorthand, or None.
+        """
+        self.add_key(service, service)
+        if shorthand:
+            self.add_key(shorthand, service)
 
+    def remove(self, service, shorthand=None):
+        """ Remove a service and its optional shorthand from the index.
 
-def remove_service(service_lookup):
-    """ Remove a service and any associated accounts.
+        :param service: the service name.
+        :param shorthand: the shorthand, or None.
+        """
+        self.remove_key(service)
+        if shorthand:
+            self.remove_key(shorthand)
 
-    :param service_lookup: the service's name or shorthand.
-    """
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
+    def prefix(self, prefix, limit=None):
+        """ Return the names and shorthands starting with a prefix, in order.
 
-    service = get_service_name(service_lookup)
-    if service is None:
-        print("Service doesn't exist.")
+        :param prefix: the prefix to complete.
+        :param limit: the maximum number of results.
+        :return: the matching keys.
+        """
+        matches = []
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            if limit is not None and len(matches) == limit:
+                break
+            matches.append(self.keys[i])
+            i += 1
+        return matches
+
+    def within(self, name, max_distance):
+        """ Return every key within an edit distance of a name, walking the sorted keys as a trie.
+        Each prefix extends the Levenshtein row of its parent by one character. Once no entry of
+        a prefix's row is within the distance, none of its keys can be, and they're skipped.
+
+        :param name: the name to match.
+        :param max_distance: the largest edit distance to return.
+        :return: (distance, key) pairs, in no particular order.
+        """
+        matches = []
+        stack = [(0, len(self.keys), 0, list(range(len(name) + 1)))]  # Keys lo:hi share keys[lo][:depth].
+        while stack:
+            lo, hi, depth, row = stack.pop()
+            if len(self.keys[lo]) == depth:  # The prefix is itself a key, and sorts first.
+                if row[-1] <= max_distance:
+                    matches.append((row[-1], self.keys[lo]))
+                lo += 1
+            while lo < hi:
+                prefix = self.keys[lo][:depth+1]
+                end = bisect.bisect_left(self.keys, prefix + chr(sys.maxunicode), lo, hi)  # Past the prefix's keys.
+                char = prefix[depth]
+                next_row = [row[0] + 1]
+                for j, char_name in enumerate(name):
+                    next_row.append(min(row[j+1] + 1, next_row[j] + 1, row[j] + (char_name != char)))
+                if min(next_row) <= max_distance:
+                    stack.append((lo, end, depth + 1, next_row))
+                lo = end
+        return matches
+
+    def fuzzy(self, name, limit=5):
+        """ Return the services with a name or shorthand within two edits (Levenshtein distance:
+        insertions, deletions and substitutions) of a misspelt name. Closest first, then by name.
+
+        :param name: the name to match.
+        :param limit: the maximum number of results.
+        :return: service names, closest first.
+        """
+        best = {}  # Service -> closest distance of its name or shorthand.
+        if self.keys:
+            for distance, key in self.within(name, 2):
+                service = self.services[key]
+                best[service] = min(distance, best.get(service, distance))
+        return sorted(best, key=lambda service: (best[service], service))[:limit]
 
-    else:
-        # Delete the accounts associated with the service and the service itself.
-        cursor.execute("DELETE FROM account WHERE service_name = ?;", (service,))
-        cursor.execute("DELETE FROM service WHERE service_name = ?;", (service,))
-        connection.commit()
-        print("Service (and associated accounts) deleted.")
 
+# ---------- Secret Cache ---------- #
 
-def remove_account(service):
-    """ Remove the account for a service. If there are multiple, let the user choose.
 
-    :param service: the account's service name/shorthand.
+class SecretCache:
+    """ LRU cache of decrypted passwords with a time to live, keyed by the service and username
+    as they were asked for. Passwords are held in bytearrays that are overwritten with zeros when
+    they expire, are evicted or are invalidated, so they don't linger in memory after leaving
+    the cache. (The strings returned to callers are immutable and can't be wiped.)
     """
 
-    def execute_remove(account_name):
-        """ Remove the provided account from the database.
+    def __init__(self, size=SECRET_CACHE_SIZE, ttl=SECRET_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # (service, username) -> [expiry, service name, username, password].
+        self.lock = threading.Lock()  # The cache may be shared between threads.
 
-        :param account_name: the account to be deleted.
-        """
-        cursor.execute("DELETE FROM account WHERE account_name = ?;", (account_name,))
-        connection.commit()
-        print("Account deleted. (%s)" % account_name)
+    @staticmethod
+    def wipe(entry):
+        """ Overwrite an entry's password with zeros. """
+        entry[3][:] = bytes(len(entry[3]))
 
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
+    def get(self, key):
+        """ Return a cached account.
 
-    accounts = get_accounts_from_service(service)
-    if accounts is None:
-        print("No related account.")
+        :param key: the (service, username) the account was asked for with.
+        :return: the username and password, or None if not cached or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self.wipe(self.entries.pop(key))
+                return None
+            self.entries.move_to_end(key)
+            return entry[2], entry[3].decode("utf-8", "strict")
+
+    def put(self, key, service, username, pw):
+        """ Cache an account, evicting the least recently used ones beyond the size bound.
+
+        :param key: the (service, username) the account was asked for with.
+        :param service: the service name, used for invalidation.
+        :param username: the account's username.
+        :param pw: the decrypted password, in bytes.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.wipe(self.entries.pop(key))
+            self.entries[key] = [time.monotonic() + self.ttl, service, username, bytearray(pw)]
+            while len(self.entries) > self.size:
+                self.wipe(self.entries.popitem(last=False)[1])
+
+    def invalidate(self, service, username=None):
+        """ Drop the cached accounts of a service.
+
+        :param service: the service name.
+        :param username: only drop this account, or None for all of the service's accounts.
+        """
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry[1] == service and (username is None or entry[2] == username):
+                    self.wipe(self.entries.pop(key))
 
-    elif len(accounts) == 1:
-        execute_remove(accounts[0][0])
+    def clear(self):
+        """ Drop every cached account. """
+        with self.lock:
+            for entry in self.entries.values():
+                self.wipe(entry)
+            self.entries.clear()
 
-    else:
-        print("Which account? (enter number)")
-        for i in range(0, len(accounts)):
-            print("[%d] %s" % (i+1, accounts[i][0]))
-        try:
-            acc = int(input(" > "))
-            execute_remove(accounts[acc-1][0])
-        except ValueError:
-            print("Invalid input.")
-        except IndexError:
-            print("Number out of bounds.")
 
+# ---------- Breach Index ---------- #
 
-def remove_backup(filepath):
-    """ Delete the database file at the specified filepath.
 
-    :param filepath: the filepath to the .db file.
+class BreachIndex:
+    """ A file of known-breached passwords' SHA-1 hashes, looked up through mmap so it's never read into
+    memory. The file is BREACH_INDEX_MAGIC, then a fanout table of BREACH_FANOUT little-endian 8-byte
+    counts (entry i is the number of hashes whose first two bytes are at most i), then the sorted,
+    distinct 20-byte hashes. A lookup reads one fanout entry and binary searches one bucket, touching
+    a handful of pages.
     """
-    backup_path = os.path.join(filepath, "store_backup.db")
-    try:
-        os.remove(backup_path)
-        print("Backup removed successfully.")
-    except FileNotFoundError:
-        print("The file doesn't exist at the specified filepath.")
 
+    HASH_SIZE = 20
+    RECORDS_OFFSET = len(BREACH_INDEX_MAGIC) + 8 * BREACH_FANOUT
 
-def ls(alphabetical=False, acc=False):
-    """ List all services and relevant information.
+    def __init__(self, path, writable=False):
+        """ Open an index.
 
-    :param alphabetical: display services alphabetically (on service name).
-    :param acc: display all related account usernames.
+        :param path: the path of the index file.
+        :param writable: map the file for writing, to fill in its fanout table.
+        :raises VaultError: if the file isn't a breach index, or is only part of one (e.g. an interrupted copy).
+        """
+        error = VaultError("%s isn't a breach index. Build one with BREACH BUILD." % path)
+        with open(path, "r+b" if writable else "rb") as f:
+            if os.fstat(f.fileno()).st_size < self.RECORDS_OFFSET:  # Also, an empty file can't be mapped.
+                raise error
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        # The last fanout entry counts every hash, so a file cut short between hashes is caught too. An index
+        # being built has no fanout table yet.
+        if (self.map[:len(BREACH_INDEX_MAGIC)] != BREACH_INDEX_MAGIC
+                or (len(self.map) - self.RECORDS_OFFSET) % self.HASH_SIZE != 0
+                or (not writable and self.bucket_end(BREACH_FANOUT - 1) != len(self))):
+            self.map.close()
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return (len(self.map) - self.RECORDS_OFFSET) // self.HASH_SIZE
+
+    def __getitem__(self, i):
+        """ Return the i-th hash, so the index can be searched with bisect. """
+        start = self.RECORDS_OFFSET + i * self.HASH_SIZE
+        return self.map[start:start + self.HASH_SIZE]
+
+    def bucket_end(self, prefix):
+        """ Return the number of hashes whose first two bytes are at most prefix. """
+        start = len(BREACH_INDEX_MAGIC) + 8 * prefix
+        return int.from_bytes(self.map[start:start + 8], "little")
+
+    def fill_fanout(self):
+        """ Write the fanout table of an index opened for writing, from its sorted hashes. """
+        fanout = [bisect.bisect_left(self, (prefix + 1).to_bytes(2, "big")) for prefix in range(BREACH_FANOUT - 1)]
+        fanout.append(len(self))
+        self.map[len(BREACH_INDEX_MAGIC):self.RECORDS_OFFSET] = b"".join(n.to_bytes(8, "little") for n in fanout)
+
+    def __contains__(self, password):
+        """ Check if a password is in the index.
+
+        :param password: the password, as a string or UTF-8 bytes.
+        """
+        if isinstance(password, str):
+            password = password.encode()
+        digest = hashlib.sha1(password).digest()
+        prefix = int.from_bytes(digest[:2], "big")
+        lo = self.bucket_end(prefix - 1) if prefix else 0
+        hi = self.bucket_end(prefix)
+        i = bisect.bisect_left(self, digest, lo, hi)
+        return i < hi and self[i] == digest
+
+    def close(self):
+        self.map.close()
+
+
+def read_breach_hashes(f):
+    """ Read the hashes from a Pwned Passwords SHA-1 download: one hash per line in hex,
+    optionally followed by a colon and a count. Lines are parsed a block at a time.
+
+    :param f: the file, opened in binary mode.
+    :return: a generator of 20-byte hashes.
+    :raises VaultError: if a line isn't a SHA-1 hash, e.g. in the NTLM download.
+    """
+    size = BreachIndex.HASH_SIZE
+    line_number = 0
+    for lines in iter(lambda: f.readlines(1 << 20), []):
+        digests = [line.split(b":", 1)[0].strip() for line in lines]
+        try:
+            if any(len(digest) != 2 * size for digest in digests if digest):
+                raise ValueError
+            block = bytes.fromhex(b"".join(digests).decode("ascii"))
+        except ValueError:
+            bad = next(n for n, digest in enumerate(digests) if digest and (
+                len(digest) != 2 * size or not all(c in b"0123456789abcdefABCDEF" for c in digest)))
+            raise VaultError("Line %d isn't a SHA-1 hash. Use the SHA-1 Pwned Passwords download."
+                             % (line_number + bad + 1))
+        line_number += len(lines)
+        for i in range(0, len(block), size):
+            yield block[i:i + size]
+
+
+def build_breach_index(source, destination, progress=None):
+    """ Build a breach index from a Pwned Passwords SHA-1 download. The download is read in runs of
+    BREACH_RUN_SIZE hashes, each sorted and written to a temporary file beside the destination, and
+    the runs are then merged, so memory use doesn't grow with the download's size.
+
+    :param source: the path of the downloaded file.
+    :param destination: the path to write the index to. It's replaced only once the index is complete.
+    :param progress: called with the number of hashes read so far, after each run.
+    :return: the number of distinct hashes in the index.
+    """
+    def read_run(path):
+        """ Yield the hashes of a sorted run file. """
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(BreachIndex.HASH_SIZE * 4096)
+                if not block:
+                    return
+                for i in range(0, len(block), BreachIndex.HASH_SIZE):
+                    yield block[i:i + BreachIndex.HASH_SIZE]
+
+    directory = os.path.dirname(os.path.abspath(destination))
+    with tempfile.TemporaryDirectory(dir=directory) as work, open(source, "rb") as f:
+        runs = []
+        hashes = read_breach_hashes(f)
+        read = 0
+        while True:
+            run = sorted(itertools.islice(hashes, BREACH_RUN_SIZE))
+            if not run:
+                break
+            runs.append(os.path.join(work, "run%d" % len(runs)))
+            with open(runs[-1], "wb") as out:
+                out.write(b"".join(run))
+            read += len(run)
+            if progress is not None:
+                progress(read)
+            del run  # Free this run before the next is read.
+
+        partial = os.path.join(work, "index")
+        with open(partial, "wb") as out:
+            out.write(BREACH_INDEX_MAGIC + bytes(8 * BREACH_FANOUT))  # The fanout table is filled in below.
+            merged = heapq.merge(*(read_run(path) for path in runs))
+            distinct = (digest for digest, _ in itertools.groupby(merged))
+            for block in iter(lambda: list(itertools.islice(distinct, 65536)), []):
+                out.write(b"".join(block))
+        with BreachIndex(partial, writable=True) as index:
+            index.fill_fanout()
+            count = len(index)
+        os.replace(partial, destination)
+    return count
+
+
+# ---------- Vault ---------- #
+
+
+class Vault:
+    """ A password vault stored in one SQLite file.
+    Methods return data and raise VaultError subclasses rather than printing or prompting,
+    so the vault can be used in-process. The command line functions below are a front end to it.
+
+    Usage:
+        with Vault("store.db") as vault:
+            username, password = vault.get("github")
     """
-    if not tables_exist():
-        print("Tables do not exist. Type CREATE CONFIRM to create the tables.")
-        return
 
-    # Display services and the related accounts.
-    if acc:
-        # Services (repeated) with all account usernames.
-        cursor.execute("""SELECT service.service_name, service.shorthand_name, account.account_name
-         FROM service INNER JOIN account ON service.service_name = account.service_name;""")
+    def __init__(self, path, unlock=None, check_same_thread=True, secret_cache=None):
+        """ Open the vault, upgrading stores created by older versions in place.
 
-        rec = cursor.fetchall()
-        if alphabetical:
-            rec = sorted(rec, key=lambda tup: tup[0])
+        :param path: the path to the database file.
+        :param unlock: called without arguments to ask for the master password, if one is set.
+        :param check_same_thread: passed to connect(). A vault used by one thread at a time may move between threads.
+        :param secret_cache: a SecretCache to keep decrypted passwords in, or None to decrypt on every get().
+        """
+        self.path = path
+        self.directory = os.path.split(os.path.realpath(path))[0]
+        self.stem = os.path.splitext(os.path.basename(path))[0]  # Backups are named after the file.
+        self.unlock = unlock
+        self.connection = connect(path, check_same_thread)
+        self.in_batch = False  # Writes are committed by batch() instead of by each method.
+        self._cipher = None  # Cached Fernet cipher, see cipher().
+        self._cipher_version = None  # PRAGMA data_version when the cipher was loaded.
+        self._fingerprint_key = None  # Cached with the cipher, see fingerprint_key().
+        self._kek = None  # Key-encryption key derived from the master password, see unwrap_key().
+        self.session_expires = None  # When the unlocked master password is forgotten (time.time()), if one is set.
+        self._service_index = None  # Cached ServiceIndex, see service_index().
+        self._service_index_version = None  # PRAGMA data_version when the index was built.
+        self.secret_cache = secret_cache
+        self._secret_cache_version = None  # PRAGMA data_version when the cache was last checked.
+        if self.tables_exist():
+            migrate(self.connection)
+
+    def close(self):
+        """ Close the database connection, wiping any cached passwords. """
+        if self.secret_cache is not None:
+            self.secret_cache.clear()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _commit(self):
+        """ Commit the current write, unless it's part of a batch. """
+        if not self.in_batch:
+            self.connection.commit()
+
+    def _rollback(self):
+        """ Roll back the current transaction, forgetting a fingerprint key generated in it. """
+        self.connection.rollback()
+        self._fingerprint_key = None
+
+    # Queries.
+
+    def tables_exist(self):
+        """ Check if the database tables exist inside the database.
+
+        :return: true if they exist, false otherwise.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("""SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'encryption';""")
+        return len(cursor.fetchall()) > 0
 
-        for row in rec:
-            name, shorthand, username = row
-            if shorthand is None:
-                print("  - %s: %s" % (name, username))
-            else:
-                print("  - %s (%s): %s" % (name, shorthand, username))
+    def require_tables(self):
+        """ Raise TablesMissingError if the tables haven't been created. """
+        if not self.tables_exist():
+            raise TablesMissingError("Tables do not exist. Type CREATE CONFIRM to create the tables.")
 
-    # Just display services.
-    else:
-        cursor.execute("SELECT service_name, shorthand_name FROM service")
-        rec = cursor.fetchall()
-        if alphabetical:
-            rec = sorted(rec, key=lambda tup: tup[0])
+    def service_info(self, name):
+        """ Return the service name (key) and shorthand using the input to
+        find a row match in either the service name or shorthand columns.
 
-        for row in rec:
-            name, shorthand = row
-            if shorthand is None:
-                print("  - %s" % name)
-            else:
-                print("  - %s (%s)" % (name, shorthand))
+        :param name: service name or shorthand.
+        :return: the service name and shorthand stored in the db, or None.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT service_name, shorthand_name FROM service WHERE service_name = ? OR shorthand_name = ?;",
+                       (name, name))
+        return cursor.fetchone()
 
+    def find_service(self, name):
+        """ Return the service name and shorthand for a service name or shorthand.
 
-def clear():
-    """ Empty the clipboard. """
-    pyperclip.copy('')
-    print("Clipboard cleared.")
+        :param name: service name or shorthand.
+        :return: the service name and shorthand stored in the db.
+        :raises ServiceNotFoundError: if no service matches.
+        """
+        service_info = self.service_info(name)
+        if service_info is None:
+            raise ServiceNotFoundError(name)
+        return service_info
 
+    def name_unique(self, name):
+        """ Check that a name isn't already in use as a service name or shorthand.
 
-def info(keyword=None):
-    """ Display overview help information,
-     or information for an optional keyword.
-     """
-    if keyword is None:  # Overview information.
-        print(" A simple command line-based password management system.\n"
-              " To get started, use the CREATE keyword to setup the database along with CONFIRM.\n Then, define"
-              " a service using DEFINE, add accounts to a service using ADD, and get the password to an account"
-              " using GET.\n Below are all keywords. Type HELP KEYWORD for more information on a particular keyword."
-              "\n  - DEFINE\n  - ADD\n  - GET\n  - UPDATE\n  - REMOVE\n  - LS\n  - CLEAR\n  - CREATE\n  - DROP"
-              "\n  - BACKUP")
+        :param name: the service name or shorthand.
+        :return: true if no occurrences, false otherwise.
+        """
+        return self.service_info(name) is None
 
-    elif keyword == "DEFINE":
-        print("-----> %s Help\n Add a service with a name and optional shorthand keyword. Service name"
-              " and shorthand must not already be defined.\n Service name and shorthand can be the same.\n"
-              " Form: DEFINE servicename\n Form: DEFINE servicename shorthand" % keyword)
+    def accounts(self, service):
+        """ Get the account name(s) and encrypted password(s) for a service.
 
-    elif keyword == "ADD":
-        print("-----> %s Help\n Add an account for a specific service. Provide a username and password.\n"
-              " The username must not already be associated with the specific service.\n"
-              " Form: ADD (service name or shorthand)" % keyword)
+        :param service: the service name.
+        :return: a list of (username, token) pairs, empty if there are no accounts.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT account_name, account_pw FROM account WHERE service_name = ?;", (service,))
+        return cursor.fetchall()
 
-    elif keyword == "GET":
-        print("-----> %s Help\n Copy the password of an account to the clipboard using the service name or shorthand.\n"
+    def usernames(self, service):
+        """ Return the usernames of a service's accounts.
+
+        :param service: the service name or shorthand.
+        :return: the usernames.
+        """
+        self.require_tables()
+        name = self.find_service(service)[0]
+        return [username for username, _ in self.accounts(name)]
+
+    # Encryption.
+
+    def cipher(self):
+        """ Return the Fernet cipher for the stored key.
+        The key is read from the database once and the cipher is kept for the life of the vault,
+        unless another process writes to the database (which may have rotated the key). That's
+        checked on every call, so operations call this once up front: encrypt() and decrypt() reuse
+        the cipher it returned rather than checking again for every password.
+        While a rotation is in progress, the cipher encrypts with the new key and decrypts with either.
+
+        :return: the cipher.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("PRAGMA data_version;")
+        version = cursor.fetchone()[0]
+        if self._cipher is None or version != self._cipher_version:
+            cursor.execute("""SELECT key FROM encryption;""")
+            key = self.unwrap_key(cursor.fetchone()[0])
+            cursor.execute("""SELECT new_key FROM rotation;""")
+            pending = cursor.fetchone()
+            fernet = lazy_import("cryptography.fernet")
+            if pending is None:
+                self._cipher = fernet.Fernet(key)
+            else:
+                self._cipher = fernet.MultiFernet([fernet.Fernet(self.unwrap_key(pending[0])), fernet.Fernet(key)])
+            self._cipher_version = version
+            self._fingerprint_key = None
+        return self._cipher
+
+    def reset_cipher(self):
+        """ Forget the cached cipher, forcing the key to be read again on next use.
+        Called whenever the tables (and therefore the key) are created, dropped or rotated.
+        """
+        self._cipher = None
+        self._fingerprint_key = None
+
+    def encrypt(self, pw):
+        """ Encrypt a password using the stored key, as loaded by the last call to cipher().
+
+        :param pw: the password to encrypt.
+        :return: the encrypted password, packed for storage.
+        """
+        cipher = self._cipher if self._cipher is not None else self.cipher()
+        with trace("crypto", "encrypt"):
+            return pack_token(cipher.encrypt(str.encode(pw)))
+
+    def decrypt(self, enc_pw):
+        """ Decrypt a password using the stored key, as loaded by the last call to cipher().
+
+        :param enc_pw: the password to be decrypted, in either storage format.
+        :return: the decrypted password (in bytes).
+        """
+        cipher = self._cipher if self._cipher is not None else self.cipher()
+        with trace("crypto", "decrypt"):
+            return cipher.decrypt(unpack_token(enc_pw))
+
+    def fingerprint_key(self):
+        """ Return the key password fingerprints are made with, generating it if the vault has none yet.
+        It's separate from the Fernet key, so ROTATE leaves fingerprints valid, and is wrapped
+        by the master password in the same way.
+
+        :return: the fingerprint key.
+        """
+        if self._cipher is None:
+            self.cipher()  # Unlocks the vault. Loading the cipher drops a cached key another process may have changed.
+        if self._fingerprint_key is None:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT fingerprint_key FROM encryption;")
+            stored = cursor.fetchone()[0]
+            if stored is None:  # Migrated with a master password set, see migrate_v7().
+                # Written in the caller's transaction, so _rollback() forgets it if that's rolled back.
+                cursor.execute("UPDATE encryption SET fingerprint_key = ? WHERE fingerprint_key IS NULL;",
+                               (self.wrap_key(os.urandom(32)),))
+                cursor.execute("SELECT fingerprint_key FROM encryption;")  # Another process's, if it got there first.
+                stored = cursor.fetchone()[0]
+            self._fingerprint_key = self.unwrap_key(stored)
+        return self._fingerprint_key
+
+    def fingerprint(self, pw):
+        """ Return a password's fingerprint: equal passwords have equal fingerprints, but without the
+        fingerprint key they reveal nothing about the password.
+
+        :param pw: the password, as a string or bytes.
+        :return: the fingerprint.
+        """
+        if isinstance(pw, str):
+            pw = pw.encode()
+        return hmac.new(self.fingerprint_key(), pw, hashlib.sha256).digest()[:FINGERPRINT_SIZE]
+
+    # Master password.
+
+    def master(self):
+        """ Return the KDF parameters of the master password.
+
+        :return: (salt, n, r, p), or None if no master password is set.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT salt, n, r, p FROM master;")
+        return cursor.fetchone()
+
+    def session_path(self):
+        """ Return the path of the unlocked-session cache for this vault, named per database. It lives
+        in a directory of the user's own (pwmanager-user in the runtime or temp directory), which is
+        created only accessible by the user. Sessions aren't cached if another user could get at it.
+
+        :return: the session file path, or None if the directory isn't safe.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("PRAGMA database_list;")
+        db_file = [row[2] for row in cursor.fetchall() if row[1] == "main"][0]
+        directory = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+                                 "pwmanager-%s" % getpass.getuser())
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            return None
+        info = os.lstat(directory)  # Not a symlink another user could have planted.
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            return None
+        return os.path.join(directory, "%s.session" % hashlib.sha256(db_file.encode()).hexdigest()[:16])
+
+    @staticmethod
+    def session_safe(fd):
+        """ Check that an open session file is a regular file only the user can read or write. """
+        info = os.fstat(fd)
+        return stat.S_ISREG(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+    def read_session(self):
+        """ Return the key-encryption key cached by a recent unlock, if it hasn't expired.
+
+        :return: the key-encryption key, or None.
+        """
+        path = self.session_path()
+        if path is None:
+            return None
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+        try:
+            with os.fdopen(fd) as f:
+                if not self.session_safe(f.fileno()):
+                    return None
+                session = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if session.get("expires", 0) < time.time():
+            self.lock()
+            return None
+        self.session_expires = session["expires"]
+        return session["kek"].encode()
+
+    def write_session(self, kek):
+        """ Cache the key-encryption key for SESSION_TIMEOUT seconds. The file is only readable by the owner.
+
+        :param kek: the key-encryption key.
+        """
+        self.session_expires = time.time() + SESSION_TIMEOUT  # Kept to even if the session can't be cached.
+        path = self.session_path()
+        if path is None:
+            return
+        try:
+            os.remove(path)  # Replaced rather than rewritten, so the new file's owner and mode are ours.
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        except OSError:  # Created by someone else in between: don't cache the session.
+            return
+        with os.fdopen(fd, "w") as f:
+            if self.session_safe(f.fileno()):
+                json.dump({"expires": self.session_expires, "kek": kek.decode()}, f)
+
+    def lock(self):
+        """ Forget the unlocked session, so the master password is asked for again.
+
+        :return: true if there was an unlocked session, false otherwise.
+        """
+        self._kek = None
+        self.session_expires = None
+        path = self.session_path()
+        if path is None:
+            return False
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def unwrap_key(self, stored):
+        """ Return a key as stored in the database, decrypting it with the master password if one is set.
+        The master password is taken from the session cache or asked for through unlock.
+
+        :param stored: the stored key.
+        :return: the usable Fernet key.
+        :raises MasterPasswordError: if the master password is wrong or can't be asked for.
+        """
+        master = self.master()
+        if master is None:
+            return stored
+
+        fernet = lazy_import("cryptography.fernet")
+        for attempt in range(2):  # A stale session falls through to one password prompt.
+            from_prompt = False
+            if self._kek is None:
+                self._kek = self.read_session()
+            if self._kek is None:
+                if self.unlock is None:
+                    raise MasterPasswordError("The vault is locked. Provide unlock to ask for the master password.")
+                self._kek = derive_kek(self.unlock(), *master)
+                from_prompt = True
+            try:
+                key = fernet.Fernet(self._kek).decrypt(stored)
+                if from_prompt:
+                    self.write_session(self._kek)
+                return key
+            except fernet.InvalidToken:
+                self.lock()
+                if from_prompt:
+                    break
+        raise MasterPasswordError("Incorrect master password.")
+
+    def wrap_key(self, key):
+        """ Return a key as it should be stored, encrypted with the master password if one is set.
+
+        :param key: the Fernet key.
+        :return: the key to store.
+        """
+        if self.master() is None:
+            return key
+        if self._kek is None:
+            self.cipher()  # Unlocks the session.
+        return lazy_import("cryptography.fernet").Fernet(self._kek).encrypt(key)
+
+    def set_master(self, pw):
+        """ Set or change the master password. The scrypt cost is calibrated to KDF_TARGET_MS on this host.
+
+        :param pw: the new master password.
+        :return: the scrypt cost n and the milliseconds it takes to unlock.
+        """
+        self.require_tables()
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT key FROM encryption;")
+        key = self.unwrap_key(cursor.fetchone()[0])
+        cursor.execute("SELECT new_key FROM rotation;")
+        pending = cursor.fetchone()
+        pending = None if pending is None else self.unwrap_key(pending[0])
+        cursor.execute("SELECT fingerprint_key FROM encryption;")
+        fingerprint_key = cursor.fetchone()[0]
+        fingerprint_key = None if fingerprint_key is None else self.unwrap_key(fingerprint_key)
+        if pw == "":
+            raise VaultError("Master password can't be empty.")
+
+        n, elapsed = calibrate_kdf()[-1]
+        salt = os.urandom(16)
+        kek = derive_kek(pw, salt, n, KDF_R, KDF_P)
+
+        cursor.execute("DELETE FROM master;")
+        cursor.execute("INSERT INTO master VALUES(?, ?, ?, ?);", (salt, n, KDF_R, KDF_P))
+        cipher = lazy_import("cryptography.fernet").Fernet(kek)
+        cursor.execute("UPDATE encryption SET key = ?;", (cipher.encrypt(key),))
+        if pending is not None:
+            cursor.execute("UPDATE rotation SET new_key = ?;", (cipher.encrypt(pending),))
+        if fingerprint_key is not None:
+            cursor.execute("UPDATE encryption SET fingerprint_key = ?;", (cipher.encrypt(fingerprint_key),))
+        self.connection.commit()
+
+        self._kek = kek
+        self.write_session(kek)
+        self.reset_cipher()
+        return n, elapsed
+
+    def remove_master(self):
+        """ Remove the master password, storing the key unencrypted again. """
+        self.require_tables()
+        if self.master() is None:
+            raise VaultError("No master password is set.")
+
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT key FROM encryption;")
+        key = self.unwrap_key(cursor.fetchone()[0])
+        cursor.execute("SELECT new_key FROM rotation;")
+        pending = cursor.fetchone()
+        cursor.execute("SELECT fingerprint_key FROM encryption;")
+        fingerprint_key = cursor.fetchone()[0]
+
+        cursor.execute("UPDATE encryption SET key = ?;", (key,))
+        if pending is not None:
+            cursor.execute("UPDATE rotation SET new_key = ?;", (self.unwrap_key(pending[0]),))
+        if fingerprint_key is not None:
+            cursor.execute("UPDATE encryption SET fingerprint_key = ?;", (self.unwrap_key(fingerprint_key),))
+        cursor.execute("DELETE FROM master;")
+        self.connection.commit()
+
+        self.lock()
+        self.reset_cipher()
+
+    # Service index.
+
+    def service_index(self):
+        """ Return the service index, building it on first use.
+        It is rebuilt if another process has written to the database since it was built
+        (this vault's own changes are applied incrementally through update_service_index).
+
+        :return: the index.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("PRAGMA data_version;")
+        version = cursor.fetchone()[0]
+        if self._service_index is None or version != self._service_index_version:
+            self._service_index = ServiceIndex()
+            self._service_index.load(self.connection)
+            self._service_index_version = version
+        return self._service_index
+
+    def update_service_index(self, removed=None, added=None):
+        """ Keep a built service index in step with a change to the service table.
+        An index that hasn't been built yet will be loaded fresh when needed.
+
+        :param removed: (service, shorthand) removed from the table, or None.
+        :param added: (service, shorthand) added to the table, or None.
+        """
+        if self._service_index is None:
+            return
+        if removed is not None:
+            self._service_index.remove(*removed)
+        if added is not None:
+            self._service_index.add(*added)
+
+    def reset_service_index(self):
+        """ Forget the service index, forcing it to be rebuilt on next use. """
+        self._service_index = None
+
+    def suggest(self, name):
+        """ Return the services closest to a name that wasn't found.
+
+        :param name: the name that wasn't found.
+        :return: service names, closest first.
+        """
+        return self.service_index().fuzzy(name)
+
+    def complete(self, prefix=""):
+        """ Return the service names and shorthands starting with a prefix.
+
+        :param prefix: the prefix to complete.
+        :return: the matching names and shorthands, in order.
+        """
+        self.require_tables()
+        return self.service_index().prefix(prefix)
+
+    # Services and accounts.
+
+    def define(self, service, shorthand=None):
+        """ Define a service using a name and optional shorthand.
+
+        :param service: the name of the service.
+        :param shorthand: the (optional) shorthand of the name, for ease of use.
+        :raises NameConflictError: if the name or shorthand is already in use.
+        """
+        self.require_tables()
+        if not self.name_unique(service) or (shorthand is not None and not self.name_unique(shorthand)):
+            raise NameConflictError("Name/shorthand already in use.")
+
+        cursor = self.connection.cursor()
+        cursor.execute("INSERT INTO service VALUES(?, ?);", (service, shorthand))
+        self._commit()
+        self.update_service_index(added=(service, shorthand))
+
+    def add(self, service, username, pw):
+        """ Store an account for a service.
+
+        :param service: the service name or shorthand.
+        :param username: the account username.
+        :param pw: the account password.
+        :raises NameConflictError: if the service already has an account with this username.
+        """
+        self.require_tables()
+        name = self.find_service(service)[0]
+        cursor = self.connection.cursor()
+        cursor.execute("""SELECT * FROM account WHERE account_name = ? AND service_name = ?;""", (username, name))
+        if cursor.fetchone() is not None:
+            raise NameConflictError("An account with this username already exists.")
+
+        self.cipher()  # Checks for a new key once, for both encrypt() and fingerprint().
+        cursor.execute("""INSERT INTO account VALUES (?, ?, ?, ?);""",
+                       (username, self.encrypt(pw), name, self.fingerprint(pw)))
+        self._commit()
+        self.forget_secrets(name)  # A get() without a username is no longer unambiguous.
+
+    def get(self, service, username=None):
+        """ Get the username and password of an account.
+
+        :param service: the service name or shorthand.
+        :param username: the account's username. Only needed if the service has several accounts.
+        :return: the username and the decrypted password.
+        :raises AmbiguousAccountError: if no username is given and the service has several accounts.
+        """
+        cached = self.cached_secret(service, username)
+        if cached is not None:
+            return cached
+
+        self.require_tables()
+        name = self.find_service(service)[0]
+        rec = self.accounts(name)
+        if username is not None:
+            rec = [row for row in rec if row[0] == username]
+            if len(rec) == 0:
+                raise AccountNotFoundError("Account doesn't exist.")
+        elif len(rec) == 0:
+            raise AccountNotFoundError("This service doesn't have any associated accounts.")
+        elif len(rec) > 1:
+            raise AmbiguousAccountError([row[0] for row in rec])
+
+        self.cipher()
+        pw = self.decrypt(rec[0][1])
+        if self.secret_cache is not None:
+            self.secret_cache.put((service, username), name, rec[0][0], pw)
+        return rec[0][0], pw.decode("utf-8", "strict")
+
+    def cached_secret(self, service, username=None):
+        """ Return an account from the secret cache, if there is one.
+        The whole cache is dropped if another process has written to the database since the last check.
+
+        :param service: the service name or shorthand, as passed to get().
+        :param username: the username, as passed to get().
+        :return: the username and password, or None.
+        """
+        if self.secret_cache is None:
+            return None
+        cursor = self.connection.cursor()
+        cursor.execute("PRAGMA data_version;")
+        version = cursor.fetchone()[0]
+        if version != self._secret_cache_version:
+            self.secret_cache.clear()
+            self._secret_cache_version = version
+        return self.secret_cache.get((service, username))
+
+    def forget_secrets(self, service=None, username=None):
+        """ Drop cached passwords that a change has made stale.
+
+        :param service: the service name, or None for every service.
+        :param username: the username, or None for all of the service's accounts.
+        """
+        if self.secret_cache is None:
+            return
+        if service is None:
+            self.secret_cache.clear()
+        else:
+            self.secret_cache.invalidate(service, username)
+
+    def update_account(self, service, username, new_username=None, pw=None):
+        """ Update an account with a new username and/or password.
+
+        :param service: the service name or shorthand.
+        :param username: the account's current username.
+        :param new_username: the new username, or None to keep it.
+        :param pw: the new password, or None to keep it.
+        :raises NameConflictError: if the new username is used by another account of the service.
+        """
+        self.require_tables()
+        name = self.find_service(service)[0]
+        cursor = self.connection.cursor()
+        cursor.execute("""SELECT account_pw FROM account WHERE account_name = ? AND service_name = ?;""",
+                       (username, name))
+        rec = cursor.fetchone()
+        if rec is None:
+            raise AccountNotFoundError("Account doesn't exist.")
+
+        if new_username is None:
+            new_username = username
+        elif new_username != username:
+            cursor.execute("""SELECT * FROM account WHERE account_name = ? AND service_name = ?;""",
+                           (new_username, name))
+            if cursor.fetchone() is not None:
+                raise NameConflictError("This username is already associated with another account.")
+
+        if pw is None:
+            cursor.execute("UPDATE account SET account_name = ? WHERE account_name = ? AND service_name = ?;",
+                           (new_username, username, name))
+        else:
+            self.cipher()
+            cursor.execute("""UPDATE account SET account_name = ?, account_pw = ?, account_fp = ?
+                           WHERE account_name = ? AND service_name = ?;""",
+                           (new_username, self.encrypt(pw), self.fingerprint(pw), username, name))
+        self._commit()
+        self.forget_secrets(name, username)
+
+    def update_service(self, service, new_name, new_shorthand=None):
+        """ Update a service with a new name and (optional) shorthand.
+
+        :param service: the service name or shorthand.
+        :param new_name: the new service name.
+        :param new_shorthand: the new shorthand, or None for no shorthand.
+        :raises NameConflictError: if the new name or shorthand is used by another service.
+        """
+        self.require_tables()
+        stored_name, stored_short = self.find_service(service)
+        if new_name not in (stored_name, stored_short) and not self.name_unique(new_name):
+            raise NameConflictError("Name already in use elsewhere.")
+        if new_shorthand not in (None, stored_name, stored_short) and not self.name_unique(new_shorthand):
+            raise NameConflictError("Shorthand already in use elsewhere.")
+
+        cursor = self.connection.cursor()
+        # Accounts follow the new name through ON UPDATE CASCADE, in the same transaction.
+        cursor.execute("UPDATE service SET service_name = ?, shorthand_name = ? WHERE service_name = ?;",
+                       (new_name, new_shorthand, stored_name))
+        self._commit()
+        self.update_service_index(removed=(stored_name, stored_short), added=(new_name, new_shorthand))
+        self.forget_secrets(stored_name)  # Cached under the old name or shorthand.
+
+    def remove_service(self, service):
+        """ Remove a service and any associated accounts.
+
+        :param service: the service name or shorthand.
+        """
+        self.require_tables()
+        service_info = self.find_service(service)
+        cursor = self.connection.cursor()
+        # The service's accounts are deleted through ON DELETE CASCADE, in the same transaction.
+        cursor.execute("DELETE FROM service WHERE service_name = ?;", (service_info[0],))
+        self._commit()
+        self.update_service_index(removed=service_info)
+        self.forget_secrets(service_info[0])
+
+    def remove_account(self, service, username=None):
+        """ Remove an account of a service.
+
+        :param service: the service name or shorthand.
+        :param username: the account's username. Only needed if the service has several accounts.
+        :return: the username of the removed account.
+        :raises AmbiguousAccountError: if no username is given and the service has several accounts.
+        """
+        self.require_tables()
+        name = self.find_service(service)[0]
+        if username is None:
+            usernames = [row[0] for row in self.accounts(name)]
+            if len(usernames) > 1:
+                raise AmbiguousAccountError(usernames)
+            username = usernames[0] if usernames else None
+
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM account WHERE account_name = ? AND service_name = ?;", (username, name))
+        if cursor.rowcount == 0:
+            raise AccountNotFoundError("No related account.")
+        self._commit()
+        self.forget_secrets(name, username)
+        return username
+
+    def list(self, alphabetical=False, acc=False, pattern=None, limit=None, offset=0, after=None):
+        """ Stream services, and optionally their account usernames, straight from the database.
+        Ordering, filtering and paging are all done in SQL, so rows can be used as they are read.
+
+        :param alphabetical: order by service name (and username), using the primary key index.
+        :param acc: include account usernames. Services without accounts have a None username.
+        :param pattern: only include rows whose name, shorthand or username contains this text.
+        :param limit: the maximum number of rows, or None for all.
+        :param offset: the number of rows to skip.
+        :param after: only include services whose name sorts after this one (keyset pagination).
+        :return: an iterator of (service, shorthand, username) tuples.
+        """
+        self.require_tables()
+        if acc:
+            sql = """SELECT service.service_name, service.shorthand_name, account.account_name
+                  FROM service LEFT JOIN account ON service.service_name = account.service_name"""
+            searched = ("service.service_name", "service.shorthand_name", "account.account_name")
+        else:
+            sql = "SELECT service.service_name, service.shorthand_name, NULL FROM service"
+            searched = ("service.service_name", "service.shorthand_name")
+
+        conditions = []
+        params = []
+        if pattern is not None:
+            like = "%" + pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            conditions.append("(" + " OR ".join("%s LIKE ? ESCAPE '\\'" % column for column in searched) + ")")
+            params += [like] * len(searched)
+        if after is not None:
+            conditions.append("service.service_name > ?")
+            params.append(after)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        if alphabetical or after is not None:
+            sql += " ORDER BY service.service_name" + (", account.account_name" if acc else "")
+        sql += " LIMIT ? OFFSET ?;"
+        params += [-1 if limit is None else limit, offset]
+
+        ls_cursor = self.connection.cursor()
+        ls_cursor.execute(sql, params)
+        return ls_cursor
+
+    def search(self, terms, page=1, page_size=SEARCH_PAGE_SIZE):
+        """ Search service names, shorthands and account usernames using the full-text index.
+        Every term must match the start of a word. Results are ranked by relevance and paginated.
+
+        :param terms: the search terms.
+        :param page: the page of results, starting from 1.
+        :param page_size: the number of results per page.
+        :return: a list of (service, shorthand, username) tuples. Services have a None username.
+        """
+        self.require_tables()
+        # Quote each term so punctuation isn't read as query syntax, and match it as a prefix.
+        query = " ".join('"%s"*' % term.replace('"', '""') for term in terms)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""SELECT service.service_name, service.shorthand_name, search_index.account_name
+                           FROM search_index JOIN service ON service.service_name = search_index.service_name
+                           WHERE search_index MATCH ? ORDER BY rank LIMIT ? OFFSET ?;""",
+                           (query, page_size, (page - 1) * page_size))
+            return cursor.fetchall()
+        except sqlite3.OperationalError:
+            raise VaultError("Invalid search terms.")
+
+    # Batches.
+
+    def batch_op(self, op):
+        """ Apply one batch operation.
+
+        :param op: the operation dict, e.g. {"op": "add", "service": "github", "username": "me", "password": "pw"}.
+        :return: a short description of what was done.
+        :raises ValueError: if the operation is malformed.
+        """
+        for field in ("service", "shorthand", "username", "password", "new_username", "new_service", "new_shorthand"):
+            if field not in op or isinstance(op[field], str) or (field.endswith("shorthand") and op[field] is None):
+                continue
+            raise ValueError("The %s must be a string." % field)
+
+        kind = op.get("op")
+        service = op.get("service", "").lower()
+        if not service:
+            raise ValueError("No service provided.")
+
+        if kind == "define":
+            shorthand = op.get("shorthand")
+            shorthand = None if shorthand is None else str(shorthand).lower()
+            self.define(service, shorthand)
+            return "Service '%s' added." % service
+
+        elif kind == "add":
+            if "username" not in op or "password" not in op:
+                raise ValueError("Provide a username and password.")
+            self.add(service, op["username"], op["password"])
+            return "Account added."
+
+        elif kind == "update":
+            if "username" not in op:
+                raise ValueError("Provide the username of the account.")
+            new_username = op.get("new_username", op["username"])
+            self.update_account(service, op["username"], new_username, op.get("password"))
+            return "Account updated. (%s -> %s)" % (op["username"], new_username)
+
+        elif kind == "update_service":
+            stored_name, stored_short = self.find_service(service)
+            new_name = str(op.get("new_service", stored_name)).lower()
+            new_short = op.get("new_shorthand", stored_short)
+            new_short = None if new_short in (None, "") else str(new_short).lower()
+            self.update_service(service, new_name, new_short)
+            return "Service updated."
+
+        elif kind == "remove":
+            if "username" in op:
+                self.remove_account(service, op["username"])
+                return "Account deleted. (%s)" % op["username"]
+            self.remove_service(service)
+            return "Service (and associated accounts) deleted."
+
+        raise ValueError("Unknown operation. Use define, add, update, update_service or remove.")
+
+    def batch(self, lines):
+        """ Apply a stream of operations, one JSON object per line, in a single transaction.
+        Each operation runs inside its own savepoint so every failure can be reported, but if any
+        operation fails the whole batch is rolled back and nothing is written.
+
+        :param lines: the operations, e.g. an open file.
+        :return: a list of (line number, succeeded, description) tuples.
+        """
+        self.require_tables()
+        results = []
+        cursor = self.connection.cursor()
+        self.connection.commit()
+        cursor.execute("BEGIN IMMEDIATE;")  # Take the write lock up front rather than failing to upgrade later.
+        self.in_batch = True
+        try:
+            for number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                cursor.execute("SAVEPOINT batch_op;")
+                try:
+                    op = json.loads(line)
+                    if not isinstance(op, dict):
+                        raise ValueError("Operation must be a JSON object.")
+                    results.append((number, True, self.batch_op(op)))
+                    cursor.execute("RELEASE batch_op;")
+                except (VaultError, ValueError, sqlite3.IntegrityError) as e:
+                    cursor.execute("ROLLBACK TO batch_op;")
+                    cursor.execute("RELEASE batch_op;")
+                    self._fingerprint_key = None  # In case the operation generated it.
+                    results.append((number, False, str(e)))
+        except BaseException:
+            self._rollback()
+            raise
+        finally:
+            self.in_batch = False
+            self.reset_service_index()
+
+        if all(succeeded for _, succeeded, _ in results):
+            self.connection.commit()
+        else:
+            self._rollback()
+        return results
+
+    # Import and export.
+
+    def import_file(self, filepath, export_key=None):
+        """ Import services and accounts from an export file in a single transaction.
+        Existing names are loaded once so every record is validated against the
+        service/shorthand and account uniqueness rules without a query per row.
+        Records with conflicting or missing names are skipped. Records with a service
+        but no username and password only define the service.
+
+        :param filepath: the path to the export file (.csv, .json, .jsonl or an EXPORT archive).
+        :param export_key: called without arguments to ask for the key of an EXPORT archive.
+        :return: the number of accounts imported and the number of records skipped.
+        """
+        self.require_tables()
+        self.cipher()  # Unlock, and check for a new key, once for the whole file.
+        cursor = self.connection.cursor()
+
+        # Every name and shorthand in use, mapped to the service it resolves to.
+        names = {}
+        cursor.execute("SELECT service_name, shorthand_name FROM service;")
+        for name, shorthand in cursor:
+            names[name] = name
+            if shorthand is not None:
+                names[shorthand] = name
+
+        cursor.execute("SELECT service_name, account_name FROM account;")
+        accounts = set(cursor)
+
+        new_services = []
+        pending = []
+        imported = skipped = 0
+
+        def write_pending():
+            """ Encrypt and insert the pending accounts. """
+            cursor.executemany("INSERT INTO service VALUES(?, ?);", new_services)
+            cursor.executemany("INSERT INTO account VALUES(?, ?, ?, ?);",
+                               [(username, self.encrypt(pw), service, self.fingerprint(pw))
+                                for service, username, pw in pending])
+            new_services.clear()
+            pending.clear()
+
+        try:
+            for record in read_import_file(filepath, export_key):
+                service, shorthand, username, pw = normalise_import_record(record)
+                service_only = username is None and pw is None
+                if service is None or (not service_only and (username is None or pw is None)):
+                    skipped += 1
+                    continue
+
+                if service in names:  # Existing service (by name or shorthand).
+                    service = names[service]
+                elif shorthand is not None and shorthand != service and shorthand in names:
+                    skipped += 1  # Shorthand belongs to another service.
+                    continue
+                else:
+                    new_services.append((service, shorthand))
+                    names[service] = service
+                    if shorthand is not None:
+                        names[shorthand] = service
+
+                if service_only:
+                    continue
+                if (service, username) in accounts:
+                    skipped += 1
+                    continue
+                accounts.add((service, username))
+                pending.append((service, username, pw))
+                imported += 1
+
+                if len(pending) >= IMPORT_BATCH_SIZE:
+                    write_pending()
+
+            write_pending()
+            self.connection.commit()
+            self.reset_service_index()
+            self.forget_secrets()
+
+        except (OSError, ValueError, csv.Error, lazy_import("cryptography.fernet").InvalidToken) as e:
+            self._rollback()
+            raise VaultError("Import failed, nothing was imported. (%s)" % (str(e) or "invalid export key"))
+
+        return imported, skipped
+
+    def export_rows(self):
+        """ Stream every service and account with decrypted passwords.
+        Services without accounts are returned with a None username and password.
+
+        :return: a generator of (service, shorthand, username, password) tuples.
+        """
+        self.require_tables()
+        self.cipher()  # Unlock before streaming.
+        export_cursor = self.connection.cursor()
+        export_cursor.execute("""SELECT service.service_name, service.shorthand_name, account.account_name,
+                              account.account_pw
+                              FROM service LEFT JOIN account ON service.service_name = account.service_name;""")
+        for service, shorthand, username, enc_pw in export_cursor:
+            pw = None if enc_pw is None else self.decrypt(enc_pw).decode("utf-8", "strict")
+            yield service, shorthand, username, pw
+
+    def export(self, filepath, plain=False):
+        """ Export every service and account to a file, one chunk at a time.
+        By default the file is an encrypted archive readable by import_file() with the returned key.
+        With plain, the file is an unencrypted CSV.
+
+        :param filepath: the path of the file to create.
+        :param plain: write a plaintext CSV instead of an encrypted archive.
+        :return: the number of rows exported and the archive's key (None for a plain export).
+        """
+        self.require_tables()
+        count = 0
+        key = None
+        try:
+            # Only readable by the owner, like the session file: a plain export holds every password.
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)  # The mode only applies to new files.
+            with open(fd, "w", newline="", encoding="utf-8") as f:
+                if plain:
+                    writer = csv.writer(f)
+                    writer.writerow(("service", "shorthand", "username", "password"))
+                    for row in self.export_rows():
+                        writer.writerow(row)
+                        count += 1
+
+                else:
+                    fernet = lazy_import("cryptography.fernet")
+                    key = fernet.Fernet.generate_key()
+                    cipher = fernet.Fernet(key)
+                    f.write(EXPORT_HEADER + "\n")
+
+                    index = 0
+                    rows = []
+                    for row in self.export_rows():
+                        rows.append(row)
+                        count += 1
+                        if len(rows) == EXPORT_CHUNK_SIZE:
+                            f.write(cipher.encrypt(json.dumps({"index": index, "rows": rows}).encode()).decode() + "\n")
+                            index += 1
+                            rows = []
+                    if rows:
+                        f.write(cipher.encrypt(json.dumps({"index": index, "rows": rows}).encode()).decode() + "\n")
+                        index += 1
+                    f.write(cipher.encrypt(json.dumps({"index": index, "end": True, "count": count}).encode()).decode()
+                            + "\n")
+
+        except OSError:
+            raise VaultError("Invalid filepath provided.")
+
+        return count, None if key is None else key.decode()
+
+    # Key rotation.
+
+    def rotation_pending(self):
+        """ Check if a key rotation was interrupted and will be resumed by rotate().
+
+        :return: true if a rotation is pending, false otherwise.
+        """
+        self.require_tables()
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT 1 FROM rotation;")
+        return cursor.fetchone() is not None
+
+    def rotate(self, progress=None):
+        """ Generate a new key and re-encrypt every password with it.
+        Chunks of passwords are re-encrypted across a process pool. Each finished chunk is written
+        together with a checkpoint, and passwords can be decrypted with either key until the rotation
+        finishes, so an interrupted rotation is resumed by calling rotate() again. The new key replaces
+        the old one in a final transaction.
+
+        :param progress: called with the number of passwords rotated so far and the total, after each chunk.
+        """
+        self.require_tables()
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT key FROM encryption;")
+        old_key = self.unwrap_key(cursor.fetchone()[0])
+        cursor.execute("SELECT new_key, last_rowid FROM rotation;")
+        pending = cursor.fetchone()
+        if pending is None:
+            new_key, last_rowid = lazy_import("cryptography.fernet").Fernet.generate_key(), 0
+            cursor.execute("INSERT INTO rotation VALUES(?, ?);", (self.wrap_key(new_key), last_rowid))
+            self.connection.commit()
+        else:
+            new_key, last_rowid = self.unwrap_key(pending[0]), pending[1]
+        self.reset_cipher()  # Encrypt with the new key from now on.
+
+        cursor.execute("SELECT count(*) FROM account WHERE rowid > ?;", (last_rowid,))
+        total = cursor.fetchone()[0]
+        done = 0
+
+        chunks = self.account_chunks("account_pw", ROTATE_CHUNK_SIZE, last_rowid)
+        for rows, rotated in map_chunks(rotate_chunk, (new_key, old_key), chunks):
+            # A password changed by another process since the chunk was read isn't overwritten with its old value.
+            cursor.executemany("UPDATE account SET account_pw = ? WHERE rowid = ? AND account_pw = ?;",
+                               [(token, rowid, old_token) for (token, rowid), (_, old_token) in zip(rotated, rows)])
+            if cursor.rowcount != len(rotated):
+                # This transaction now holds the write lock, so the changed passwords can be rotated again safely.
+                written = {rowid: token for token, rowid in rotated}
+                cursor.execute("SELECT rowid, account_pw FROM account WHERE rowid BETWEEN ? AND ?;",
+                               (rows[0][0], rows[-1][0]))
+                changed = [(rowid, token) for rowid, token in cursor.fetchall() if written.get(rowid) != token]
+                cursor.executemany("UPDATE account SET account_pw = ? WHERE rowid = ?;",
+                                   rotate_chunk((new_key, old_key), changed))
+            cursor.execute("UPDATE rotation SET last_rowid = ?;", (rows[-1][0],))
+            self.connection.commit()
+
+            done += len(rotated)
+            if progress is not None:
+                progress(done, total)
+
+        cursor.execute("UPDATE encryption SET key = (SELECT new_key FROM rotation);")  # Already wrapped.
+        cursor.execute("DELETE FROM rotation;")
+        self.connection.commit()
+        self.reset_cipher()
+
+    def account_chunks(self, columns, size, after_rowid=0, where="1"):
+        """ Read the accounts in rowid order, one query per chunk, so the table is never held in memory.
+
+        :param columns: the columns to read after the rowid, e.g. "account_pw".
+        :param size: the number of accounts per chunk.
+        :param after_rowid: only read accounts after this rowid.
+        :param where: only read accounts matching this SQL condition, e.g. "account_fp IS NULL".
+        :return: a generator of chunks, each a list of (rowid, columns...) rows.
+        """
+        cursor = self.connection.cursor()
+        while True:
+            cursor.execute("SELECT rowid, %s FROM account WHERE rowid > ? AND (%s) ORDER BY rowid LIMIT ?;"
+                           % (columns, where), (after_rowid, size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield rows
+            after_rowid = rows[-1][0]
+
+    # Sync.
+
+    def replica_id(self):
+        """ Return the id this vault is known by to the vaults it syncs with. """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT id FROM replica;")
+        return cursor.fetchone()[0]
+
+    def changes(self, after_seq=0):
+        """ Return the services and accounts changed after a point in the change log.
+
+        :param after_seq: the sequence number of the last change already known.
+        :return: {(service, username or None for the service itself): change time}, and the latest sequence number.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT service_name, account_name, changed_at FROM change_log WHERE seq > ?;", (after_seq,))
+        changes = {(service, username): changed_at for service, username, changed_at in cursor}
+        cursor.execute("SELECT ifnull(max(seq), 0) FROM change_log;")
+        return changes, cursor.fetchone()[0]
+
+    def received_seq(self, peer_id):
+        """ Return how much of another vault's change log this vault has received.
+
+        :param peer_id: the other vault's replica id.
+        :return: the sequence number of the last change received, 0 if the vaults have never synced.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT received_seq FROM sync_peer WHERE peer_id = ?;", (peer_id,))
+        row = cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    def stored_row(self, key):
+        """ Return the stored state of a service or account.
+
+        :param key: (service, None) for a service, or (service, username) for an account.
+        :return: ("service", shorthand) or ("account", stored token), or None if it doesn't exist.
+        """
+        cursor = self.connection.cursor()
+        if key[1] is None:
+            cursor.execute("SELECT 'service', shorthand_name FROM service WHERE service_name = ?;", (key[0],))
+        else:
+            cursor.execute("SELECT 'account', account_pw FROM account WHERE service_name = ? AND account_name = ?;",
+                           key)
+        return cursor.fetchone()
+
+    def row_state(self, key, stored=False):
+        """ Return the current state of a service or account, comparable between vaults with different keys.
+
+        :param key: (service, None) for a service, or (service, username) for an account.
+        :param stored: the row already read by stored_row(), if any.
+        :return: ("service", shorthand) or ("account", decrypted password), or None if it doesn't exist.
+        """
+        row = self.stored_row(key) if stored is False else stored
+        if row is None or row[0] == "service":
+            return row
+        try:
+            return "account", self.decrypt(row[1])
+        except lazy_import("cryptography.fernet").InvalidToken:
+            raise VaultError("The password of %s on %s can't be decrypted. Run VERIFY." % (key[1], key[0]))
+
+    def write_state(self, key, state):
+        """ Make a service or account match a state read by row_state() from another vault.
+
+        :param key: (service, None) for a service, or (service, username) for an account.
+        :param state: the state to write, or None to delete.
+        :return: true if it was written, false if it conflicts with this vault (a shorthand in use,
+                 or an account whose service doesn't exist).
+        """
+        service, username = key
+        cursor = self.connection.cursor()
+        try:
+            if state is None and username is None:
+                cursor.execute("DELETE FROM service WHERE service_name = ?;", (service,))
+            elif state is None:
+                cursor.execute("DELETE FROM account WHERE service_name = ? AND account_name = ?;", key)
+            elif username is None:
+                cursor.execute("UPDATE service SET shorthand_name = ? WHERE service_name = ?;", (state[1], service))
+                if cursor.rowcount == 0:
+                    cursor.execute("INSERT INTO service VALUES(?, ?);", (service, state[1]))
+            else:
+                token = self.encrypt(state[1].decode())  # Under this vault's key.
+                fingerprint = self.fingerprint(state[1])
+                cursor.execute("""UPDATE account SET account_pw = ?, account_fp = ?
+                               WHERE service_name = ? AND account_name = ?;""", (token, fingerprint, service, username))
+                if cursor.rowcount == 0:
+                    cursor.execute("INSERT INTO account VALUES(?, ?, ?, ?);", (username, token, service, fingerprint))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def sync(self, other):
+        """ Merge another vault into this one and this one into it, exchanging only the services and
+        accounts changed since the two last synced. Passwords are re-encrypted under the receiving
+        vault's key. A service or account changed in both is a conflict, won by the later change.
+        A service deleted in one vault but changed in the other is kept, and copied back.
+        Each vault is changed in one transaction, and the other vault's writes wait until the sync is done.
+
+        :param other: the other vault.
+        :return: the number of rows sent to the other vault, the number received, and a description of each conflict.
+        """
+        self.require_tables()
+        other.require_tables()
+        self.cipher()  # Unlock both before taking the write locks.
+        other.cipher()
+        if self.replica_id() == other.replica_id():  # A copy of this file, which needs an id of its own.
+            other.connection.execute("UPDATE replica SET id = ?;", (os.urandom(16).hex(),))
+            other.connection.commit()
+        local_id, remote_id = self.replica_id(), other.replica_id()
+
+        def describe(key):
+            return "service %s" % key[0] if key[1] is None else "account %s on %s" % (key[1], key[0])
+
+        vaults = (self, other)
+        for vault in vaults:
+            vault.connection.commit()
+            vault.connection.execute("BEGIN IMMEDIATE;")
+        try:
+            local_changes, local_seq = self.changes(other.received_seq(local_id))
+            remote_changes, remote_seq = other.changes(self.received_seq(remote_id))
+            changes = {self: local_changes, other: remote_changes}
+
+            writes = {self: {}, other: {}}  # Vault -> {key: state to write}.
+            conflicts = []
+            for key in local_changes.keys() | remote_changes.keys():
+                local_row, remote_row = self.stored_row(key), other.stored_row(key)
+                if local_row == remote_row:  # Identical, such as in a copy of the file. Nothing to decrypt.
+                    continue
+                local_state, remote_state = self.row_state(key, local_row), other.row_state(key, remote_row)
+                if local_state == remote_state:
+                    continue
+                if key in local_changes and key in remote_changes:
+                    local_wins = local_changes[key] >= remote_changes[key]
+                    conflicts.append("Both vaults changed %s; kept the %s change, which is newer."
+                                     % (describe(key), "local" if local_wins else "other vault's"))
+                else:
+                    local_wins = key in local_changes
+                if local_wins:
+                    writes[other][key] = local_state
+                else:
+                    writes[self][key] = remote_state
+
+            # Don't delete a service the receiving vault has changed, or added accounts to, since the last sync.
+            for source, target in ((self, other), (other, self)):
+                changed = {service for service, _ in changes[target]}
+                for key, state in list(writes[target].items()):
+                    if state is None and key[1] is None and key[0] in changed:
+                        del writes[target][key]
+                        writes[source][key] = target.row_state(key)
+                        for username, _ in target.accounts(key[0]):
+                            writes[target].pop((key[0], username), None)
+                            writes[source][(key[0], username)] = target.row_state((key[0], username))
+                        conflicts.append("%s was deleted in one vault but changed in the other; it was kept."
+                                         % describe(key).capitalize())
+
+            def order(item):
+                """ Delete first, so a renamed service's shorthand is free, then write services before
+                their accounts.
+                """
+                (_, username), state = item
+                if state is None:
+                    return 0 if username is not None else 1
+                return 2 if username is None else 3
+
+            counts = {}
+            for vault in (other, self):
+                counts[vault] = 0
+                for key, state in sorted(writes[vault].items(), key=order):
+                    if vault.write_state(key, state):
+                        counts[vault] += 1
+                    else:
+                        conflicts.append("Couldn't copy %s: it clashes with the receiving vault." % describe(key))
+
+            # The other vault has now received this one's changes up to local_seq. This vault has
+            # received the other's up to its latest change, including the copies it just made.
+            other.connection.execute("INSERT OR REPLACE INTO sync_peer VALUES(?, ?, ?);",
+                                     (local_id, local_seq, time.time()))
+            remote_seq = other.changes(remote_seq)[1]
+            self.connection.execute("INSERT OR REPLACE INTO sync_peer VALUES(?, ?, ?);",
+                                    (remote_id, remote_seq, time.time()))
+            other.connection.commit()
+            self.connection.commit()
+        except BaseException:
+            for vault in vaults:
+                vault._rollback()
+            raise
+
+        for vault in vaults:
+            vault.reset_service_index()
+            vault.forget_secrets()
+        return counts[other], counts[self], conflicts
+
+    # Verification.
+
+    def keys(self):
+        """ Return the keys passwords may be encrypted under, to send to worker processes.
+
+        :return: the vault's key, followed by the new key if a rotation is in progress.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT key FROM encryption;")
+        keys = [self.unwrap_key(cursor.fetchone()[0])]
+        cursor.execute("SELECT new_key FROM rotation;")
+        pending = cursor.fetchone()
+        if pending is not None:  # Mid-rotation, passwords may be under either key.
+            keys.append(self.unwrap_key(pending[0]))
+        return keys
+
+    def breached(self, index_path, progress=None):
+        """ Find the accounts whose password is in a breach index. Passwords are read in chunks and
+        decrypted and looked up across a process pool; each worker maps the index once.
+
+        :param index_path: the path of the breach index.
+        :param progress: called with the number of passwords checked so far and the total, after each chunk.
+        :return: (service, username) of each account with a breached password.
+        """
+        self.require_tables()
+        BreachIndex(index_path).close()  # Fail here, rather than in every worker, if it isn't an index.
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT count(*) FROM account;")
+        total = cursor.fetchone()[0]
+        done = 0
+        found = []
+        chunks = self.account_chunks("service_name, account_name, account_pw", BREACH_CHUNK_SIZE)
+        for rows, breached in map_chunks(breach_chunk, (self.keys(), index_path), chunks):
+            found.extend(breached)
+            done += len(rows)
+            if progress is not None:
+                progress(done, total)
+        return found
+
+    def reused(self, progress=None):
+        """ Find passwords used by more than one account, without decrypting them: accounts with
+        equal passwords have equal fingerprints, so one GROUP BY over the fingerprint index finds them.
+        Accounts stored before fingerprints were added are fingerprinted first, once, across a process pool.
+
+        :param progress: called with the number of accounts fingerprinted so far and the total, after
+                         each chunk, if any need fingerprinting.
+        :return: the accounts sharing each reused password, as lists of (service, username), most shared first.
+        """
+        self.require_tables()
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT count(*) FROM account WHERE account_fp IS NULL;")
+        total = cursor.fetchone()[0]
+        if total:
+            done = 0
+            chunks = self.account_chunks("account_pw", FINGERPRINT_CHUNK_SIZE, where="account_fp IS NULL")
+            for rows, fingerprints in map_chunks(fingerprint_chunk, (self.keys(), self.fingerprint_key()), chunks):
+                # A password changed since the chunk was read has its new fingerprint already; keep that one.
+                cursor.executemany("UPDATE account SET account_fp = ? WHERE rowid = ? AND account_fp IS NULL;",
+                                   fingerprints)
+                self.connection.commit()
+                done += len(rows)
+                if progress is not None:
+                    progress(done, total)
+
+        cursor.execute("""SELECT json_group_array(json_array(service_name, account_name)) FROM account
+                       WHERE account_fp IS NOT NULL GROUP BY account_fp HAVING count(*) > 1
+                       ORDER BY count(*) DESC;""")
+        return [[tuple(account) for account in json.loads(accounts)] for accounts, in cursor]
+
+    def verify(self, progress=None):
+        """ Check the vault for damage: SQLite's consistency check, accounts whose service doesn't exist,
+        shorthands that clash with another service's name, the search index, and that every password is
+        a valid token under the vault's key. Passwords are read in chunks and checked across a process
+        pool, without being decrypted.
+
+        :param progress: called with the number of passwords checked so far and the total, after each chunk.
+        :return: a description of each problem found, empty if there are none.
+        """
+        self.require_tables()
+        problems = []
+        cursor = self.connection.cursor()
+
+        cursor.execute("PRAGMA quick_check;")
+        problems.extend("Database: %s" % row[0] for row in cursor.fetchall() if row[0] != "ok")
+
+        cursor.execute("PRAGMA foreign_key_check(account);")
+        for _, rowid, _, _ in cursor.fetchall():
+            cursor.execute("SELECT service_name, account_name FROM account WHERE rowid = ?;", (rowid,))
+            problems.append("Account %s of %s belongs to a service that doesn't exist." % cursor.fetchone()[::-1])
+
+        cursor.execute("""SELECT clashing.service_name, service.service_name FROM service AS clashing
+                       JOIN service ON service.service_name = clashing.shorthand_name
+                       WHERE service.rowid != clashing.rowid;""")
+        for name, other in cursor.fetchall():
+            problems.append("The shorthand of %s is the name of %s." % (name, other))
+
+        try:
+            cursor.execute("INSERT INTO search_index(search_index) VALUES('integrity-check');")
+            cursor.execute("""SELECT (SELECT count(*) FROM search_index)
+                           = (SELECT count(*) FROM service) + (SELECT count(*) FROM account);""")
+            if not cursor.fetchone()[0]:
+                problems.append("The search index is out of step with the services and accounts.")
+        except sqlite3.DatabaseError:
+            problems.append("The search index is damaged.")
+        self.connection.rollback()  # The integrity check is a write that changes nothing.
+
+        cursor.execute("SELECT count(*) FROM account;")
+        total = cursor.fetchone()[0]
+        done = 0
+        chunks = self.account_chunks("service_name, account_name, account_pw", VERIFY_CHUNK_SIZE)
+        for rows, invalid in map_chunks(verify_chunk, self.keys(), chunks):
+            problems.extend("The password of %s on %s can't be decrypted." % (username, service)
+                            for service, username in invalid)
+            done += len(rows)
+            if progress is not None:
+                progress(done, total)
+        return problems
+
+    # Database.
+
+    def create(self):
+        """ Create the tables. Generate a key, store in db.
+
+        :raises TablesExistError: if the tables already exist.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""CREATE TABLE service (
+                            service_name  text PRIMARY KEY,
+                            shorthand_name text);""")
+
+            cursor.execute("""CREATE TABLE account (
+                            account_name text,
+                            account_pw text,
+                            service_name text NOT NULL,
+                            FOREIGN KEY (service_name) REFERENCES service(service_name));""")
+
+            cursor.execute("""CREATE TABLE encryption (key text);""")
+
+            # Generate and store key.
+            key = lazy_import("cryptography.fernet").Fernet.generate_key()
+            cursor.execute("""INSERT INTO encryption VALUES(?)""", (key,))
+            self.connection.commit()
+
+        except sqlite3.OperationalError:
+            self.connection.rollback()
+            raise TablesExistError("Tables already exist.")
+
+        migrate(self.connection)  # Bring the new tables up to the current schema version.
+        self.reset_cipher()
+        self.reset_service_index()
+        self.forget_secrets()
+
+    def drop(self):
+        """ Drop the tables.
+
+        :raises TablesMissingError: if the tables don't exist.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("DROP TABLE account;")
+            cursor.execute("DROP TABLE service;")
+            cursor.execute("DROP TABLE encryption;")
+            cursor.execute("DROP TABLE IF EXISTS search_index;")  # Added by migration 2.
+            cursor.execute("DROP TABLE IF EXISTS rotation;")  # Added by migration 3.
+            cursor.execute("DROP TABLE IF EXISTS master;")  # Added by migration 4.
+            cursor.execute("DROP TABLE IF EXISTS change_log;")  # Added by migration 6.
+            cursor.execute("DROP TABLE IF EXISTS replica;")
+            cursor.execute("DROP TABLE IF EXISTS sync_peer;")
+            cursor.execute("PRAGMA user_version = 0;")
+            self.connection.commit()
+
+        except sqlite3.OperationalError:
+            self.connection.rollback()
+            raise TablesMissingError("Tables don't exist.")
+
+        self.reset_cipher()
+        self.reset_service_index()
+        self.forget_secrets()
+        self.lock()
+
+    def backup(self, filepath=None, rotate=False, progress=None):
+        """ Create a copy of the database using SQLite's online backup API.
+        Pages are copied in steps so writers are only blocked briefly.
+        In rotating mode a timestamped snapshot is written only if the vault changed since the
+        newest snapshot, and only the newest BACKUP_RETENTION snapshots are kept.
+
+        :param filepath: the directory where the backup will be created. Defaults to the vault's directory.
+        :param rotate: write a timestamped snapshot instead of overwriting (vault)_backup.db
+                       (named after the vault's file).
+        :param progress: called with (status, remaining, total) pages after each step.
+        :return: the path of the backup (None if the vault hasn't changed since the newest snapshot),
+                 and the paths of the old snapshots removed.
+        """
+        self.require_tables()
+        if filepath is None:
+            filepath = self.directory
+
+        if rotate:
+            snapshots = list_snapshots(filepath, self.stem)
+            if snapshots and os.path.getmtime(snapshots[-1]) >= self.mtime():
+                return None, []
+            target = os.path.join(filepath, self.stem + time.strftime(BACKUP_SNAPSHOT_FORMAT))
+        else:
+            target = os.path.join(filepath, "%s_backup.db" % self.stem)
+
+        try:
+            b_connection = sqlite3.connect(target)
+            with b_connection:
+                self.connection.backup(b_connection, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+            b_connection.close()
+        except sqlite3.OperationalError:
+            raise VaultError("Invalid filepath provided.")
+
+        removed = []
+        if rotate:
+            for old in list_snapshots(filepath, self.stem)[:-BACKUP_RETENTION]:
+                os.remove(old)
+                removed.append(old)
+        return target, removed
+
+    def mtime(self):
+        """ Return the last modification time of the database, including its WAL file.
+
+        :return: the modification time, or 0 for an in-memory database.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("PRAGMA database_list;")
+        db_file = [row[2] for row in cursor.fetchall() if row[1] == "main"][0]
+        if not db_file:
+            return 0
+        # Opening the vault creates an empty WAL file, which doesn't count as a change.
+        return max(os.path.getmtime(f) for f in (db_file, db_file + "-wal")
+                   if os.path.exists(f) and os.path.getsize(f) > 0)
+
+
+# ---------- Async Vault ---------- #
+
+
+class AsyncVault:
+    """ asyncio front end to a vault. Queries and decryption run on a bounded pool of worker
+    threads, each with its own Vault and connection, so they never block the event loop.
+    Concurrent lookups of the same service share a single call to a worker.
+
+    Usage:
+        async with AsyncVault("store.db") as vault:
+            accounts = await asyncio.gather(*(vault.get(service) for service in services))
+    """
+
+    def __init__(self, path, unlock=None, workers=ASYNC_WORKERS, secret_cache=None):
+        """ Start the worker pool. Each worker opens its vault on first use.
+
+        :param path: the path to the database file.
+        :param unlock: called without arguments to ask for the master password, if one is set.
+        :param workers: the number of worker threads.
+        :param secret_cache: a SecretCache shared by the workers, or None to decrypt on every get().
+        """
+        self.path = path
+        self.unlock = unlock
+        self.secret_cache = secret_cache
+        self.executor = lazy_import("concurrent.futures").ThreadPoolExecutor(workers, thread_name_prefix="pwmanager")
+        self.local = threading.local()  # The worker thread's vault.
+        self.vaults = []  # Every worker's vault, closed by close().
+        self.vaults_lock = threading.Lock()
+        self.in_flight = {}  # (function, args) -> future shared by concurrent callers.
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """ Wait for running calls to finish, then stop the workers and close their vaults. """
+        await lazy_import("asyncio").get_running_loop().run_in_executor(None, self.executor.shutdown)
+        for vault in self.vaults:
+            vault.close()
+        self.vaults.clear()
+
+    def worker_vault(self):
+        """ Return the calling worker thread's vault, opening it on first use. """
+        vault = getattr(self.local, "vault", None)
+        if vault is None:
+            # Closed by the event loop's thread.
+            vault = Vault(self.path, self.unlock, check_same_thread=False, secret_cache=self.secret_cache)
+            with self.vaults_lock:
+                self.vaults.append(vault)
+            self.local.vault = vault
+        return vault
+
+    def run(self, function, *args):
+        """ Call a function with a worker's vault followed by the arguments, e.g. run(Vault.get, "github").
+
+        :return: a future of the function's result.
+        """
+        return lazy_import("asyncio").get_running_loop().run_in_executor(
+            self.executor, lambda: function(self.worker_vault(), *args))
+
+    async def run_coalesced(self, function, *args):
+        """ Like run(), but callers asking for the same function and arguments while a call is
+        running share its result rather than each queueing their own. Only used for reads.
+        """
+        key = (function,) + args
+        future = self.in_flight.get(key)
+        if future is None:
+            future = self.run(function, *args)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await lazy_import("asyncio").shield(future)  # One caller being cancelled doesn't cancel the others.
+
+    async def get(self, service, username=None):
+        """ See Vault.get(). """
+        return await self.run_coalesced(Vault.get, service, username)
+
+    async def usernames(self, service):
+        """ See Vault.usernames(). """
+        return await self.run_coalesced(Vault.usernames, service)
+
+    async def list(self, alphabetical=False, acc=False, pattern=None, limit=None, offset=0, after=None):
+        """ See Vault.list(). The rows are returned as a list. """
+        return await self.run_coalesced(AsyncVault.read_list, alphabetical, acc, pattern, limit, offset, after)
+
+    @staticmethod
+    def read_list(vault, *options):
+        """ Read every row of Vault.list() on the worker. """
+        return list(vault.list(*options))
+
+    async def search(self, terms, page=1, page_size=SEARCH_PAGE_SIZE):
+        """ See Vault.search(). """
+        return await self.run_coalesced(Vault.search, tuple(terms), page, page_size)
+
+    async def define(self, service, shorthand=None):
+        """ See Vault.define(). """
+        return await self.run(Vault.define, service, shorthand)
+
+    async def add(self, service, username, pw):
+        """ See Vault.add(). """
+        return await self.run(Vault.add, service, username, pw)
+
+    async def update_account(self, service, username, new_username=None, pw=None):
+        """ See Vault.update_account(). """
+        return await self.run(Vault.update_account, service, username, new_username, pw)
+
+    async def update_service(self, service, new_name, new_shorthand=None):
+        """ See Vault.update_service(). """
+        return await self.run(Vault.update_service, service, new_name, new_shorthand)
+
+    async def remove_service(self, service):
+        """ See Vault.remove_service(). """
+        return await self.run(Vault.remove_service, service)
+
+    async def remove_account(self, service, username=None):
+        """ See Vault.remove_account(). """
+        return await self.run(Vault.remove_account, service, username)
+
+
+# ---------- Vault Set ---------- #
+
+
+class VaultSet:
+    """ Several vaults, each its own database file with its own key, queried together.
+    Each vault is opened on first use and kept open. Lookups fan out over a small thread pool,
+    one call per vault, and the results are merged.
+
+    Usage:
+        with VaultSet({"work": "vaults/work.db", "home": "vaults/home.db"}) as vaults:
+            for vault_name, service, shorthand, username in vaults.list(alphabetical=True):
+                ...
+    """
+
+    def __init__(self, paths, unlock=None, workers=FEDERATION_WORKERS):
+        """
+        :param paths: the path of each vault's database file, by vault name.
+        :param unlock: called with a vault's name to ask for its master password. Calls are made one at a time.
+        :param workers: the number of threads lookups fan out over.
+        """
+        self.paths = paths
+        self.unlock = unlock
+        self.workers = workers
+        self.vaults = {}  # Open vaults by name.
+        self.vaults_lock = threading.Lock()
+        self.unlock_lock = threading.Lock()  # Prompts from several workers would interleave.
+        self.executor = None  # Started by the first fan_out().
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stop the workers and close every open vault. """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for vault in self.vaults.values():
+            vault.close()
+        self.vaults.clear()
+
+    def vault(self, name):
+        """ Return the named vault, opening it on first use. """
+        with self.vaults_lock:
+            vault = self.vaults.get(name)
+            if vault is None:
+                unlock = None
+                if self.unlock is not None:
+                    unlock = lambda: self.ask_unlock(name)  # noqa: E731
+                # Used by one worker at a time, but not always the same one.
+                vault = Vault(self.paths[name], unlock, check_same_thread=False)
+                self.vaults[name] = vault
+            return vault
+
+    def ask_unlock(self, name):
+        """ Ask for a vault's master password, waiting for any other prompt to finish. """
+        with self.unlock_lock:
+            return self.unlock(name)
+
+    def fan_out(self, function, *args, skip=()):
+        """ Call function(vault, *args) on every vault at once.
+
+        :param skip: errors meaning a vault has nothing to contribute, e.g. ServiceNotFoundError.
+                     Any other error is raised.
+        :return: (vault name, result) pairs in the order of paths, leaving out the skipped vaults.
+        """
+        if self.executor is None:
+            self.executor = lazy_import("concurrent.futures").ThreadPoolExecutor(
+                self.workers, thread_name_prefix="pwmanager")
+
+        def call(name):
+            try:
+                return name, function(self.vault(name), *args)
+            except skip:
+                return None
+        return [result for result in self.executor.map(call, self.paths) if result is not None]
+
+    def accounts(self, service):
+        """ Find a service's accounts in every vault.
+
+        :param service: the service name or shorthand.
+        :return: (vault name, username) pairs.
+        :raises ServiceNotFoundError: if no vault has the service.
+        """
+        found = self.fan_out(Vault.usernames, service, skip=(ServiceNotFoundError, TablesMissingError))
+        if not found:
+            raise ServiceNotFoundError(service)
+        return [(name, username) for name, usernames in found for username in usernames]
+
+    def get(self, name, service, username=None):
+        """ Get an account's username and decrypted password from one of the vaults. See Vault.get(). """
+        return self.vault(name).get(service, username)
+
+    @staticmethod
+    def read_list(vault, *options):
+        """ Read every row of Vault.list() on the worker. """
+        return list(vault.list(*options))
+
+    def list(self, alphabetical=False, acc=False, pattern=None, limit=None, offset=0, after=None):
+        """ List the services of every vault, taking the same options as Vault.list().
+        With alphabetical the vaults' lists are merged into one order; otherwise each vault's rows
+        follow the previous vault's. Vaults without tables are left out.
+
+        :return: a list of (vault name, service, shorthand, username) tuples.
+        """
+        end = None if limit is None else offset + limit  # No vault needs to read past the end of the page.
+        found = self.fan_out(VaultSet.read_list, alphabetical, acc, pattern, end, 0, after, skip=(TablesMissingError,))
+        labelled = [[(name,) + row for row in rows] for name, rows in found]
+        if alphabetical:
+            merged = heapq.merge(*labelled, key=lambda row: (row[1], row[3] or ""))
+        else:
+            merged = itertools.chain.from_iterable(labelled)
+        return list(itertools.islice(merged, offset, end))
+
+    def search(self, terms, page=1, page_size=SEARCH_PAGE_SIZE):
+        """ Search every vault. Relevance isn't comparable between vaults, so each vault's results
+        keep their order and are interleaved: every vault's best result, then every vault's second...
+
+        :return: a list of (vault name, service, shorthand, username) tuples.
+        """
+        found = self.fan_out(Vault.search, terms, 1, page * page_size, skip=(TablesMissingError,))
+        ranks = itertools.zip_longest(*([(name,) + row for row in rows] for name, rows in found))
+        merged = [row for rank in ranks for row in rank if row is not None]
+        return merged[(page - 1) * page_size:page * page_size]
+
+
+# ---------- Main Menu ---------- #
+
+
+def menu():
+    """ Menu - use cl arguments to go to specific functions.
+    Service name and shorthand arguments are made lower case - avoids case sensitivity.
+    """
+    # Help screen if no arguments provided.
+    if len(sys.argv) == 1:
+        info()
+
+    # Define a service.
+    elif sys.argv[1].upper() == "DEFINE":
+        if len(sys.argv) == 4:
+            define(service=sys.argv[2].lower(),
+                   shorthand=sys.argv[3].lower())  # Name and shorthand.
+        elif len(sys.argv) == 3:
+            define(sys.argv[2].lower())  # Just name.
+        else:
+            print("Invalid number of arguments. Provide a name and optional shorthand.")
+
+    # Add an account for a specific service.
+    elif sys.argv[1].upper() == "ADD":
+        if len(sys.argv) != 3:
+            print("Invalid number of arguments. Provide the name of the service for the account.")
+        else:
+            add(sys.argv[2].lower())
+
+    # Update an existing service or account.
+    elif sys.argv[1].upper() == "UPDATE":
+        if len(sys.argv) == 4:
+            if sys.argv[2].lower() == "-a":
+                update_account(sys.argv[3].lower())
+            elif sys.argv[2].lower() == '-s':
+                update_service(sys.argv[3].lower())
+            else:
+                print("Invalid key. Use -a or -s.")
+        else:
+            print("Invalid number of arguments. Provide the key -s or -a, and the service.")
+
+    # Retrieve the password of an account.
+    elif sys.argv[1].upper() == "GET":
+        if len(sys.argv) == 3 and vaults is not None:
+            get_across(sys.argv[2].lower())
+        elif len(sys.argv) == 3:
+            get(sys.argv[2].lower())
+        else:
+            print("Invalid number of arguments. Provide the service of the account.")
+
+    # Delete an account or service.
+    elif sys.argv[1].upper() == "REMOVE":
+        if len(sys.argv) == 4:
+            if sys.argv[2].lower() == "-a":
+                remove_account(sys.argv[3].lower())
+            elif sys.argv[2].lower() == "-s":
+                remove_service(sys.argv[3].lower())
+
+            elif sys.argv[2].lower() == "-b":
+                remove_backup(sys.argv[3])
+            else:
+                print("Invalid key. Use -a or -s.")
+        else:
+            print("Invalid number of arguments. Provide the key -s or -a, and the service.")
+
+    # List all services (and other information).
+    elif sys.argv[1].upper() == "LS":
+        options = parse_ls_args(sys.argv[2:])
+        if options is None:
+            print("Invalid arguments. Type HELP LS for the available options.")
+        else:
+            ls(**options)
+
+    # Search services and account usernames.
+    elif sys.argv[1].upper() == "SEARCH":
+        terms = sys.argv[2:]
+        page = 1
+        if len(terms) >= 2 and terms[-2].lower() == "-p":
+            try:
+                page = int(terms[-1])
+            except ValueError:
+                page = 0
+            terms = terms[:-2]
+
+        if len(terms) == 0:
+            print("Invalid number of arguments. Provide the search terms.")
+        elif page < 1:
+            print("Invalid page. Provide a page number from 1.")
+        else:
+            search([term.lower() for term in terms], page)
+
+    # List names and shorthands for shell completion.
+    elif sys.argv[1].upper() == "COMPLETE":
+        if len(sys.argv) == 3:
+            complete(sys.argv[2])
+        else:
+            complete()
+
+    # Clear the clipboard.
+    elif sys.argv[1].upper() == "CLEAR":
+        clear()
+
+    # Display help information.
+    elif sys.argv[1].upper() == "HELP":
+        if len(sys.argv) == 3:  # Extra argument for specific information.
+            info(sys.argv[2].upper())
+        else:
+            info()
+
+    # Create the database tables.
+    elif sys.argv[1].upper() == "CREATE":
+        if len(sys.argv) == 3:
+            if sys.argv[2].upper() == "CONFIRM":
+                create()
+            else:
+                print("Type CONFIRM after CREATE.")
+        else:
+            print("Invalid number of arguments. Type CONFIRM after CREATE.")
+
+    # Drop the database tables.
+    elif sys.argv[1].upper() == "DROP":
+        if len(sys.argv) == 3:
+            if sys.argv[2].upper() == "CONFIRM":
+                drop()
+            else:
+                print("Table deletion requires confirmation. Type CONFIRM after DROP.")
+        else:
+            print("Invalid number of arguments. Type CONFIRM after DROP.")
+
+    # Set, remove or calibrate the master password.
+    elif sys.argv[1].upper() == "MASTER":
+        if len(sys.argv) == 3 and sys.argv[2].upper() == "SET":
+            set_master()
+        elif len(sys.argv) == 3 and sys.argv[2].upper() == "REMOVE":
+            remove_master()
+        elif len(sys.argv) in (3, 4) and sys.argv[2].upper() == "CALIBRATE":
+            try:
+                calibrate(int(sys.argv[3]) if len(sys.argv) == 4 else KDF_TARGET_MS)
+            except ValueError:
+                print("Invalid target. Provide the number of milliseconds.")
+        else:
+            print("Invalid arguments. Use MASTER SET, MASTER REMOVE or MASTER CALIBRATE (optional milliseconds).")
+
+    # Forget the unlocked master password.
+    elif sys.argv[1].upper() == "LOCK":
+        lock()
+
+    # Re-encrypt every password with a new key.
+    elif sys.argv[1].upper() == "ROTATE":
+        if len(sys.argv) == 3 and sys.argv[2].upper() == "CONFIRM":
+            rotate()
+        else:
+            print("Key rotation requires confirmation. Type CONFIRM after ROTATE.")
+
+    # Check the vault for damage.
+    elif sys.argv[1].upper() in ("VERIFY", "FSCK"):
+        if len(sys.argv) == 2:
+            verify()
+        else:
+            print("Invalid number of arguments.")
+
+    # Apply a batch of operations from a file or standard input.
+    elif sys.argv[1].upper() == "BATCH":
+        if len(sys.argv) == 2:
+            batch(sys.stdin)
+        elif len(sys.argv) == 3:
+            try:
+                with open(sys.argv[2], encoding="utf-8") as f:
+                    batch(f)
+            except OSError:
+                print("Invalid filepath provided.")
+        else:
+            print("Invalid number of arguments. Provide an optional filepath, otherwise standard input is read.")
+
+    # Import services and accounts from an export file.
+    elif sys.argv[1].upper() == "IMPORT":
+        if len(sys.argv) == 3:
+            import_accounts(sys.argv[2])
+        else:
+            print("Invalid number of arguments. Provide the filepath of the export file.")
+
+    # Export services and accounts to a file.
+    elif sys.argv[1].upper() == "EXPORT":
+        if len(sys.argv) == 3:
+            export_accounts(sys.argv[2])
+        elif len(sys.argv) == 4 and sys.argv[3].lower() == "-plain":
+            export_accounts(sys.argv[2], plain=True)
+        else:
+            print("Invalid number of arguments. Provide the filepath and optional -plain.")
+
+    # Start or stop the background agent.
+    elif sys.argv[1].upper() == "AGENT":
+        if os.path.realpath(vault.path) != default_vault_path():
+            print("The agent only serves the default vault.")
+        elif len(sys.argv) == 3 and sys.argv[2].upper() == "STOP":
+            agent_stop()
+        elif len(sys.argv) in (3, 4) and sys.argv[2].upper() == "START":
+            try:
+                agent_start(int(sys.argv[3]) if len(sys.argv) == 4 else AGENT_IDLE_TIMEOUT)
+            except ValueError:
+                print("Invalid timeout. Provide the number of seconds.")
+        else:
+            print("Invalid arguments. Use AGENT START (optional timeout) or AGENT STOP.")
+
+    # Find reused passwords.
+    elif sys.argv[1].upper() == "AUDIT":
+        if len(sys.argv) == 2:
+            audit()
+        else:
+            print("Invalid number of arguments.")
+
+    # Check passwords against known data breaches.
+    elif sys.argv[1].upper() == "BREACH":
+        if len(sys.argv) == 4 and sys.argv[2].upper() == "BUILD":
+            breach_build(sys.argv[3])
+        elif len(sys.argv) == 3 and sys.argv[2].upper() == "AUDIT":
+            breach_audit()
+        else:
+            print("Invalid arguments. Provide BUILD and the downloaded file, or AUDIT.")
+
+    # Merge with another vault.
+    elif sys.argv[1].upper() == "SYNC":
+        if len(sys.argv) == 3:
+            sync(sys.argv[2])
+        else:
+            print("Invalid number of arguments. Provide the vault name or filepath to sync with.")
+
+    # List the vaults.
+    elif sys.argv[1].upper() == "VAULTS":
+        if len(sys.argv) == 2:
+            list_vaults()
+        else:
+            print("Invalid number of arguments.")
+
+    elif sys.argv[1].upper() == "BACKUP":
+        if len(sys.argv) == 2:
+            backup()
+        elif len(sys.argv) == 3 and sys.argv[2].lower() == "-r":
+            backup(rotate=True)
+        elif len(sys.argv) == 4 and sys.argv[2].lower() == "-r":
+            backup(sys.argv[3], rotate=True)
+        elif len(sys.argv) == 3:
+            backup(sys.argv[2])
+        elif len(sys.argv) == 4 & sys.argv[2].upper() == "REMOVE":
+            # TODO: Remove the backup at the specified file path.
+            #  CM-Line Form 1: pw backup remove filepath   - verbose
+            #  CM-Line Form 2: pw remove -b filepath   - makes use of the remove keyword already defined.
+            #    ... so, just alter the "if arg == remove" part.
+            #    ... consider the db connection, what happens if the filepath doesn't have a db?
+            #    - we dont want to create a new one.
+            print("")
+
+        else:
+            print("Invalid number of arguments.")
+
+    else:
+        print("Invalid keyword. Type HELP for more information.")
+
+
+# ---------- Utility Functions ---------- #
+
+
+def ask_master_password(name=None):
+    """ Ask for the master password. Used by the vault when it needs to be unlocked.
+
+    :param name: the name of the vault, when several are open.
+    """
+    if name is None:
+        return getpass.getpass("Enter Master Password\n > ")
+    return getpass.getpass("Enter Master Password (%s)\n > " % name)
+
+
+def choose_account(usernames):
+    """ Ask which of a service's accounts to use.
+
+    :param usernames: the usernames of the service's accounts.
+    :return: the chosen username, or None if the choice was invalid.
+    """
+    print("Which account? (enter number)")
+    for i in range(0, len(usernames)):
+        print("[%d] %s" % (i+1, usernames[i]))
+    try:
+        acc = int(input(" > "))
+    except ValueError:
+        print("Invalid input.")
+        return None
+    if not 1 <= acc <= len(usernames):
+        print("Invalid choice.")
+        return None
+    return usernames[acc-1]
+
+
+def service_suggestion(name):
+    """ Return a hint listing the services closest to a name that wasn't found.
+
+    :param name: the name that wasn't found.
+    :return: the hint, or an empty string if nothing is close.
+    """
+    matches = vault.suggest(name)
+    if not matches:
+        return ""
+    return " Did you mean: %s?" % ", ".join(matches)
+
+
+def complete(prefix=""):
+    """ Print the service names and shorthands starting with a prefix, one per line.
+    Intended for shell tab completion.
+
+    :param prefix: the prefix to complete.
+    """
+    try:
+        keys = vault.complete(prefix.lower())
+    except TablesMissingError:
+        return
+    for key in keys:
+        print(key)
+
+
+def define(service, shorthand=None):
+    """ Define a service using a name and optional shorthand.
+    Add it to the database if there are no naming conflicts.
+    Service name and shorthand are converted to lowercase to avoid case sensitivity.
+
+    :param service: the name of the service.
+    :param shorthand: the (optional) shorthand of the name, for ease of use.
+    """
+    vault.define(service, shorthand)
+    if shorthand is None:
+        print("Service '%s' added." % service)
+    else:
+        print("Service '%s' (%s) added." % (service, shorthand))
+
+
+def add(service):
+    """ Check a service exists. Ask for username and password. Store the account.
+
+    :param service: the service to create an account for (either name or shorthand).
+    """
+    try:
+        usernames = vault.usernames(service)
+    except ServiceNotFoundError:
+        print("Service doesn't exist. Define a service using the DEFINE keyword." + service_suggestion(service))
+        return
+
+    username = input("Enter Username\n > ")
+    # Check email doesn't already exist for the service..
+    if username in usernames:
+        print("An account with this username already exists.")
+        return
+
+    pw = getpass.getpass("Enter Password\n > ")
+    if not breach_confirm(pw):
+        return
+    vault.add(service, username, pw)
+    print("Account added.")
+
+
+def get(service):
+    """ Get the account for a specific service using its name or shorthand.
+    Multiple accounts require input to determine what account's password to return.
+
+    :param service: name or shorthand of the service.
+    """
+    try:
+        username, pw = vault.get(service)
+    except ServiceNotFoundError:
+        print("Service doesn't exist." + service_suggestion(service))
+        return
+    except AmbiguousAccountError as e:
+        username = choose_account(e.usernames)
+        if username is None:
+            return
+        lazy_import("pyperclip").copy(vault.get(service, username)[1])
+        print("Password copied to clipboard.")
+        return
+
+    lazy_import("pyperclip").copy(pw)
+    print("Password copied to clipboard. (username: %s)" % username)
+
+
+def update_account(service):
+    """ Update an account with a new username and password.
+
+    :param service: the service to which the account belongs.
+    """
+    try:
+        usernames = vault.usernames(service)
+    except ServiceNotFoundError:
+        usernames = []
+
+    if len(usernames) == 0:
+        print("Account or service doesn't exist.")
+        return
+    elif len(usernames) == 1:
+        old_name = usernames[0]
+    else:
+        old_name = choose_account(usernames)
+        if old_name is None:
+            return
+
+    username = input("Enter Username\n > ")
+    # If the username is different from the current one, check that it doesn't conflict.
+    if username != old_name and username in usernames:
+        print("This username is already associated with another account.")
+        return
+
+    pw = getpass.getpass("Enter Password\n > ")
+    if not breach_confirm(pw):
+        return
+    vault.update_account(service, old_name, username, pw)
+    print("Account updated. (%s -> %s)" % (old_name, username))
+
+
+def update_service(service):
+    """ Update a service with a new name and (optional) shorthand.
+
+    :param service: the service to be updated.
+    """
+    vault.require_tables()
+    if vault.service_info(service) is None:
+        print("Service doesn't exist.")
+        return
+
+    new_name = input("New Service Name:\n > ").lower()
+    new_short = input("New Shorthand Name: (press enter to skip)\n > ").lower()
+    vault.update_service(service, new_name, new_short or None)
+    print("Service updated.")
+
+
+def remove_service(service_lookup):
+    """ Remove a service and any associated accounts.
+
+    :param service_lookup: the service's name or shorthand.
+    """
+    try:
+        vault.remove_service(service_lookup)
+    except ServiceNotFoundError:
+        print("Service doesn't exist." + service_suggestion(service_lookup))
+        return
+    print("Service (and associated accounts) deleted.")
+
+
+def remove_account(service):
+    """ Remove the account for a service. If there are multiple, let the user choose.
+
+    :param service: the account's service name/shorthand.
+    """
+    try:
+        username = vault.remove_account(service)
+    except (ServiceNotFoundError, AccountNotFoundError):
+        print("No related account.")
+        return
+    except AmbiguousAccountError as e:
+        username = choose_account(e.usernames)
+        if username is None:
+            return
+        vault.remove_account(service, username)
+    print("Account deleted. (%s)" % username)
+
+
+def remove_backup(filepath):
+    """ Delete the vault's backup in a directory.
+
+    :param filepath: the directory holding the backup, named after the vault, e.g. store_backup.db.
+    """
+    backup_path = os.path.join(filepath, "%s_backup.db" % vault.stem)
+    try:
+        os.remove(backup_path)
+        print("Backup removed successfully.")
+    except FileNotFoundError:
+        print("The file doesn't exist at the specified filepath.")
+
+
+def parse_ls_args(args):
+    """ Read the LS options from the command line arguments.
+
+    :param args: the arguments after the LS keyword.
+    :return: the keyword arguments for ls(), or None if they're invalid.
+    """
+    options = {"alphabetical": "-a" in args, "acc": "-u" in args, "as_json": "--json" in args}
+    valued = {"--limit": "limit", "--offset": "offset", "--filter": "pattern", "--after": "after"}
+    for i, arg in enumerate(args):
+        if arg in valued:
+            if i + 1 == len(args):
+                return None
+            options[valued[arg]] = args[i+1]
+
+    try:
+        for option in ("limit", "offset"):
+            if option in options:
+                options[option] = int(options[option])
+                if options[option] < 0:
+                    return None
+    except ValueError:
+        return None
+    return options
+
+
+def ls(alphabetical=False, acc=False, pattern=None, limit=None, offset=0, after=None, as_json=False):
+    """ List all services and relevant information.
+
+    :param alphabetical: display services alphabetically (on service name).
+    :param acc: display all related account usernames.
+    :param pattern: only display rows whose name, shorthand or username contains this text.
+    :param limit: the maximum number of rows to display.
+    :param offset: the number of rows to skip.
+    :param after: only display services whose name sorts after this one.
+    :param as_json: display one JSON object per line instead.
+    """
+    if vaults is not None:
+        rows = vaults.list(alphabetical, acc, pattern, limit, offset, after)
+    else:
+        rows = ((None,) + row for row in vault.list(alphabetical, acc, pattern, limit, offset, after))
+
+    count = 0
+    for vault_name, name, shorthand, username in rows:
+        count += 1
+        if as_json:
+            row = {"service": name, "shorthand": shorthand}
+            if acc:
+                row["username"] = username
+            if vault_name is not None:
+                row["vault"] = vault_name
+            print(json.dumps(row))
+            continue
+
+        line = name if shorthand is None else "%s (%s)" % (name, shorthand)
+        if username is not None:
+            line += ": %s" % username
+        if vault_name is not None:
+            line = "[%s] %s" % (vault_name, line)
+        print("  - %s" % line)
+
+    if count == 0 and not as_json:
+        print("No services.")
+
+
+def search(terms, page=1):
+    """ Search service names, shorthands and account usernames using the full-text index.
+    Every term must match the start of a word. Results are ranked by relevance and paginated.
+
+    :param terms: the search terms.
+    :param page: the page of results to display, starting from 1.
+    """
+    if vaults is not None:
+        rec = vaults.search(terms, page)
+    else:
+        rec = [(None,) + row for row in vault.search(terms, page)]
+    if len(rec) == 0:
+        print("No results.")
+        return
+
+    for vault_name, name, shorthand, username in rec:
+        line = name if shorthand is None else "%s (%s)" % (name, shorthand)
+        if username is not None:
+            line += ": %s" % username
+        if vault_name is not None:
+            line = "[%s] %s" % (vault_name, line)
+        print("  - %s" % line)
+    if len(rec) == SEARCH_PAGE_SIZE:
+        print("Page %d. Use -p %d for more results." % (page, page + 1))
+
+
+def clear():
+    """ Empty the clipboard. """
+    lazy_import("pyperclip").copy('')
+    print("Clipboard cleared.")
+
+
+def info(keyword=None):
+    """ Display overview help information,
+     or information for an optional keyword.
+     """
+    if keyword is None:  # Overview information.
+        print(" A simple command line-based password management system.\n"
+              " To get started, use the CREATE keyword to setup the database along with CONFIRM.\n Then, define"
+              " a service using DEFINE, add accounts to a service using ADD, and get the password to an account"
+              " using GET.\n Below are all keywords. Type HELP KEYWORD for more information on a particular keyword."
+              "\n  - DEFINE\n  - ADD\n  - GET\n  - UPDATE\n  - REMOVE\n  - LS\n  - CLEAR\n  - CREATE\n  - DROP"
+              "\n  - BACKUP\n  - IMPORT\n  - EXPORT\n  - BATCH\n  - ROTATE\n  - MASTER\n  - LOCK\n  - AGENT\n  - SEARCH"
+              "\n  - COMPLETE\n  - VERIFY\n  - VAULTS\n  - SYNC\n  - BREACH\n  - AUDIT\n"
+              " Prefix any keyword with --vault NAME to use another vault (HELP VAULTS), or with --profile to see"
+              " where its time goes (HELP PROFILE).")
+
+    elif keyword == "DEFINE":
+        print("-----> %s Help\n Add a service with a name and optional shorthand keyword. Service name"
+              " and shorthand must not already be defined.\n Service name and shorthand can be the same.\n"
+              " Form: DEFINE servicename\n Form: DEFINE servicename shorthand" % keyword)
+
+    elif keyword == "ADD":
+        print("-----> %s Help\n Add an account for a specific service. Provide a username and password.\n"
+              " The username must not already be associated with the specific service.\n"
+              " Form: ADD (service name or shorthand)" % keyword)
+
+    elif keyword == "GET":
+        print("-----> %s Help\n Copy the password of an account to the clipboard using the service name or shorthand.\n"
               " Multiple accounts for a service require the user to choose the account.\n"
               " Form: GET (service name or shorthand)" % keyword)
 
-    elif keyword == "UPDATE":
-        print("-----> %s Help\n Modify a service's or account's information. Service modification updates associated"
-              " accounts.\n Service Form: UPDATE -s (servicename or shorthand)\n"
-              " Account Form: UPDATE -a (servicename or shorthand)" % keyword)
+    elif keyword == "UPDATE":
+        print("-----> %s Help\n Modify a service's or account's information. Service modification updates associated"
+              " accounts.\n Service Form: UPDATE -s (servicename or shorthand)\n"
+              " Account Form: UPDATE -a (servicename or shorthand)" % keyword)
+
+    elif keyword == "REMOVE":
+        print("-----> %s Help\n Remove a service or account. Removing a service deletes all associated accounts.\n"
+              " Deleting an account from a service with multiple accounts will require the user to specify the account."
+              "\n Service Form: REMOVE -s (servicename or shorthand)\n"
+              " Account Form: REMOVE -a (servicename or shorthand)" % keyword)
+
+    elif keyword == "LS":
+        print("-----> %s Help\n List all services and their respective shorthands.\n Provide -a to order alphabetically"
+              " by service name, and -u to list all respective account usernames.\n"
+              " Provide --filter text to only list names, shorthands and usernames containing the text.\n"
+              " Page with --limit n and --offset n, or with --after servicename to continue from a service.\n"
+              " Provide --json to print one JSON object per line.\n"
+              " Form: LS (optional -a, -u, --filter text, --limit n, --offset n, --after servicename, --json)"
+              % keyword)
+
+    elif keyword == "SEARCH":
+        print("-----> %s Help\n Search service names, shorthands and account usernames. Every term must match the"
+              " start of a word.\n Results are ranked by relevance, %d per page. Provide -p to choose the page.\n"
+              " Form: SEARCH terms (optional -p page)" % (keyword, SEARCH_PAGE_SIZE))
+
+    elif keyword == "COMPLETE":
+        print("-----> %s Help\n Print the service names and shorthands starting with a prefix, one per line.\n"
+              " Intended for shell tab completion.\n"
+              " Form: COMPLETE (optional prefix)" % keyword)
+
+    elif keyword in ("VERIFY", "FSCK"):
+        print("-----> %s Help\n Check the vault for damage: the database file, accounts whose service is missing,"
+              " clashing names, the search index,\n and that every password can be decrypted with the vault's key."
+              " Problems are listed and the exit status is 1.\n"
+              " Form: VERIFY\n Form: FSCK" % keyword)
+
+    elif keyword == "VAULTS":
+        print("-----> %s Help\n List the vaults. Each vault is its own database file with its own key (and master"
+              " password).\n The default vault is store.db; named vaults are kept in the %s directory beside it.\n"
+              " Prefix any keyword with --vault NAME (or set PW_VAULT) to use a named vault, e.g. --vault work CREATE"
+              " CONFIRM.\n --vault also accepts the path of a .db file, such as a backup.\n"
+              " GET, LS and SEARCH can search several vaults at once: --vault all, or names separated by commas.\n"
+              " Form: VAULTS\n Form: --vault NAME KEYWORD (arguments)\n Form: --vault all GET (service)"
+              % (keyword, VAULTS_DIRECTORY))
+
+    elif keyword == "SYNC":
+        print("-----> %s Help\n Merge the vault with another vault file both ways, such as a copy kept on another"
+              " machine.\n Only services and accounts changed since the vaults last synced are exchanged, and"
+              " passwords are\n re-encrypted with the receiving vault's key. If both vaults changed the same service"
+              " or account,\n the newer change is kept and the conflict is reported.\n"
+              " If the file doesn't exist, a new vault with its own key is created there.\n"
+              " Form: SYNC (vault name or filepath)" % keyword)
+
+    elif keyword == "AUDIT":
+        print("-----> %s Help\n List the passwords used by more than one account, without decrypting them. Each"
+              " password is stored with a\n keyed fingerprint, and accounts with equal fingerprints share a password."
+              " Accounts stored by older\n versions are fingerprinted the first time. Reused passwords are listed"
+              " and the exit status is 1.\n"
+              " Form: AUDIT" % keyword)
+
+    elif keyword == "BREACH":
+        print("-----> %s Help\n Check passwords against known data breaches, offline. BUILD makes a breach index from"
+              " the\n SHA-1 Pwned Passwords download (one hash per line, with or without counts). It's saved as %s"
+              "\n beside the script, or at PW_BREACH_INDEX. Once built, ADD and UPDATE warn when a new password is in"
+              " it.\n AUDIT checks every stored password; breached accounts are listed and the exit status is 1.\n"
+              " Form: BREACH BUILD (downloaded file)\n Form: BREACH AUDIT" % (keyword, BREACH_INDEX_FILE))
+
+    elif keyword == "PROFILE":
+        print("-----> %s Help\n Time a command: imports, opening the database, each SQL statement (with the rows"
+              " it read or changed) and each encryption, decryption and key derivation.\n"
+              " The trace is printed to standard error. Set PW_TRACE to the path of a file to append each trace to it"
+              " as a line of JSON instead,\n or to 1 to trace every command without --profile.\n"
+              " --profile=file also writes cProfile statistics to the file (read them with python -m pstats file).\n"
+              " Form: --profile KEYWORD (arguments)\n Form: --profile=file KEYWORD (arguments)" % keyword)
+
+    elif keyword == "CLEAR":
+        print("-----> %s Help\n Clear the clipboard.\n"
+              " Form: CLEAR" % keyword)
+
+    elif keyword == "CREATE":
+        print("-----> %s Help\n Create the database tables in the PWManager directory."
+              " Requires confirmation upon use.\n"
+              " Form: CREATE confirm" % keyword)
+
+    elif keyword == "DROP":
+        print("-----> %s Help\n Drop the database tables. Requires confirmation upon use.\n"
+              " Form: DROP confirm" % keyword)
+
+    elif keyword == "BACKUP":
+        print("-----> %s Help\nBackup the database. Pass an optional filepath. Otherwise defaults to same directory.\n"
+              "Provide -r to write a timestamped snapshot instead, only if the database changed since the last one.\n"
+              "The newest %d snapshots are kept.\n"
+              "Form: BACKUP (optional filepath)\n"
+              "Form: BACKUP -r (optional filepath)" % (keyword, BACKUP_RETENTION))
+
+    elif keyword == "IMPORT":
+        print("-----> %s Help\n Import services and accounts from a CSV, JSON or JSONL export file.\n"
+              " Columns are matched by name (service/name/title, shorthand, username/login_username,"
+              " password/login_password).\n Conflicting names and existing accounts are skipped.\n"
+              " Form: IMPORT filepath" % keyword)
+
+    elif keyword == "EXPORT":
+        print("-----> %s Help\n Export all services and accounts to an encrypted archive that can be read by IMPORT.\n"
+              " The key needed to import the archive is printed once. Provide -plain to write an unencrypted CSV.\n"
+              " Form: EXPORT filepath (optional -plain)" % keyword)
+
+    elif keyword == "ROTATE":
+        print("-----> %s Help\n Generate a new key and re-encrypt every password with it. Requires confirmation.\n"
+              " An interrupted rotation is resumed by running ROTATE again.\n"
+              " Form: ROTATE confirm" % keyword)
+
+    elif keyword == "MASTER":
+        print("-----> %s Help\n Protect the key with a master password, derived with scrypt. The cost is calibrated"
+              " so unlocking takes about %d ms on this host.\n Once unlocked, the master password is remembered for"
+              " %d seconds. CALIBRATE shows the timings without changing anything.\n"
+              " Form: MASTER SET\n Form: MASTER REMOVE\n Form: MASTER CALIBRATE (optional milliseconds)"
+              % (keyword, KDF_TARGET_MS, SESSION_TIMEOUT))
+
+    elif keyword == "LOCK":
+        print("-----> %s Help\n Forget the unlocked master password, so it's asked for on next use."
+              " A running agent is stopped.\n"
+              " Form: LOCK" % keyword)
+
+    elif keyword == "BATCH":
+        print("-----> %s Help\n Apply operations read one JSON object per line, all in a single transaction.\n"
+              " If any operation fails, none are applied. Reads standard input unless a filepath is given.\n"
+              ' Operations: {"op": "define", "service", "shorthand"},'
+              ' {"op": "add", "service", "username", "password"},\n'
+              ' {"op": "update", "service", "username", "new_username", "password"},'
+              ' {"op": "update_service", "service", "new_service", "new_shorthand"},\n'
+              ' {"op": "remove", "service", optional "username"}\n'
+              " Form: BATCH (optional filepath)" % keyword)
+
+    elif keyword == "AGENT":
+        print("-----> %s Help\n Start a background agent that keeps the database open and the key loaded.\n"
+              " While it runs, GET, LS and ADD are served by the agent. It exits after %d idle seconds by default,\n"
+              " on LOCK, and when the unlocked master password expires.\n"
+              " Form: AGENT START (optional timeout in seconds)\n Form: AGENT STOP" % (keyword, AGENT_IDLE_TIMEOUT))
+
+    else:
+        print("Invalid keyword.")
+
+
+# ---------- Master Password ---------- #
+
+
+def set_master():
+    """ Set or change the master password. The scrypt cost is calibrated to KDF_TARGET_MS on this host. """
+    vault.require_tables()
+    vault.cipher()  # Ask for the current master password, if there is one, before the new one.
+
+    pw = getpass.getpass("Enter New Master Password\n > ")
+    if pw != "" and getpass.getpass("Confirm New Master Password\n > ") != pw:
+        print("Passwords don't match.")
+        return
+
+    n, elapsed = vault.set_master(pw)
+    print("Master password set. (scrypt n=%d, %.0f ms to unlock)" % (n, elapsed))
+
+
+def remove_master():
+    """ Remove the master password, storing the key unencrypted again. """
+    vault.remove_master()
+    print("Master password removed.")
+
+
+def lock():
+    """ Forget the unlocked session, so the master password is asked for again.
+    A running agent holds the key itself, so it's stopped too.
+    """
+    if vault.lock():
+        print("Session locked.")
+    else:
+        print("No unlocked session.")
+    if agent_request({"op": "lock"}) is not None:
+        print("Agent stopped.")
+
+
+def calibrate(target_ms=KDF_TARGET_MS):
+    """ Print how long scrypt takes on this host at increasing costs.
+
+    :param target_ms: the target unlock time in milliseconds.
+    """
+    for n, elapsed in calibrate_kdf(target_ms):
+        print("  - n=%d: %.0f ms" % (n, elapsed))
+    print("MASTER SET would use n=%d for a %d ms target." % (n, target_ms))
+
+
+# ---------- Batch Functions ---------- #
+
+
+def batch(f):
+    """ Apply a stream of operations, one JSON object per line, in a single transaction.
+    If any operation fails the whole batch is rolled back and nothing is written.
+
+    :param f: the file to read the operations from.
+    """
+    results = vault.batch(f)
+    failed = 0
+    for number, succeeded, description in results:
+        if succeeded:
+            print("[%d] %s" % (number, description))
+        else:
+            failed += 1
+            print("[%d] Failed: %s" % (number, description))
+
+    if failed:
+        print("%d of %d operations failed. Batch rolled back, no changes were made." % (failed, len(results)))
+    else:
+        print("Batch complete. (%d operations)" % len(results))
+
+
+# ---------- Import Functions ---------- #
+
+
+def read_import_file(filepath, export_key=None):
+    """ Stream the records of an export file as dicts.
+    CSV files need a header row. JSON files may be a list of objects or a Bitwarden-style
+    export ({"items": [...]} with nested "login" objects). JSONL files hold one object per line.
+
+    :param filepath: the path to the export file.
+    :param export_key: called without arguments to ask for the key of an EXPORT archive.
+    :return: a generator of records.
+    :raises ValueError: if the file isn't in one of these forms.
+    """
+    extension = os.path.splitext(filepath)[1].lower()
+    with open(filepath, newline="", encoding="utf-8") as f:
+        if f.readline().strip() == EXPORT_HEADER:
+            if export_key is None:
+                raise ValueError("the file is an encrypted export archive and no key was provided")
+            yield from read_export_archive(f, export_key())
+            return
+        f.seek(0)
+
+        if extension == ".jsonl":
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("line %d isn't a JSON object" % number)
+                    yield record
+
+        elif extension == ".json":
+            data = json.load(f)
+            if isinstance(data, dict):
+                data = data.get("items", [])
+            if not isinstance(data, list):
+                raise ValueError("expected a list of objects")
+            for number, item in enumerate(data, 1):
+                if not isinstance(item, dict):
+                    raise ValueError("item %d isn't a JSON object" % number)
+                if isinstance(item.get("login"), dict):  # Bitwarden nests the credentials.
+                    item = dict(item, **item["login"])
+                yield item
+
+        else:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def normalise_import_record(record):
+    """ Map a record from an export file onto service, shorthand, username and password.
+
+    :param record: a dict read from the export file.
+    :return: a (service, shorthand, username, password) tuple. Missing fields are None.
+    """
+    lowered = {str(k).strip().lower(): v for k, v in record.items() if k is not None}
+    fields = []
+    for field in ("service", "shorthand", "username", "password"):
+        value = None
+        for alias in IMPORT_FIELDS[field]:
+            if lowered.get(alias):
+                value = str(lowered[alias])
+                break
+        fields.append(value)
+
+    # Only the names are tidied up. Usernames and passwords are credentials and are kept exactly as read.
+    service, shorthand, username, password = fields
+    if service is not None:
+        service = service.strip().lower()
+    if shorthand is not None:
+        shorthand = shorthand.strip().lower()
+    return service, shorthand, username, password
+
+
+def import_accounts(filepath):
+    """ Import services and accounts from an export file in a single transaction.
+    Records with conflicting or missing names are skipped.
+
+    :param filepath: the path to the export file (.csv, .json, .jsonl or an EXPORT archive).
+    """
+    start = time.perf_counter()
+    imported, skipped = vault.import_file(filepath, lambda: getpass.getpass("Enter Export Key\n > "))
+    elapsed = time.perf_counter() - start
+    print("Imported %d accounts, skipped %d. (%.2fs, %.0f rows/sec)"
+          % (imported, skipped, elapsed, imported / elapsed if elapsed > 0 else 0))
+
 
-    elif keyword == "REMOVE":
-        print("-----> %s Help\n Remove a service or account. Removing a service deletes all associated accounts.\n"
-              " Deleting an account from a service with multiple accounts will require the user to specify the account."
-              "\n Service Form: REMOVE -s (servicename or shorthand)\n"
-              " Account Form: REMOVE -a (servicename or shorthand)" % keyword)
+# ---------- Export Functions ---------- #
 
-    elif keyword == "LS":
-        print("-----> %s Help\n List all services and their respective shorthands.\n Provide -a to order alphabetically"
-              " by service name, and -u to list all respective account usernames.\n"
-              " Form: LS (optional -s and/or -u)" % keyword)
 
-    elif keyword == "CLEAR":
-        print("-----> %s Help\n Clear the clipboard.\n"
-              " Form: CLEAR" % keyword)
+def read_export_archive(f, key):
+    """ Stream the records of an encrypted export archive.
+    Each line after the header is a Fernet token of one JSON chunk. Chunks are numbered
+    and the archive ends with a marker holding the row count, so reordered, missing or
+    truncated chunks are rejected.
 
-    elif keyword == "CREATE":
-        print("-----> %s Help\n Create the database tables in the PWManager directory."
-              " Requires confirmation upon use.\n"
-              " Form: CREATE confirm" % keyword)
+    :param f: the archive file, positioned after the header line.
+    :param key: the export key printed when the archive was created.
+    :return: a generator of record dicts.
+    :raises ValueError: if the archive is damaged, incomplete or malformed.
+    """
+    cipher = lazy_import("cryptography.fernet").Fernet(key.strip().encode())
+    expected_index = 0
+    count = 0
+    for line in f:
+        chunk = json.loads(cipher.decrypt(line.strip().encode()))
+        try:
+            index = chunk["index"]
+            end = chunk.get("end")
+            if end:
+                total = chunk["count"]
+            else:
+                rows = [{"service": service, "shorthand": shorthand, "username": username, "password": pw}
+                        for service, shorthand, username, pw in chunk["rows"]]
+        except (KeyError, TypeError, AttributeError, ValueError):  # ValueError for a row of the wrong length.
+            raise ValueError("export archive has a malformed chunk")
+
+        if index != expected_index:
+            raise ValueError("export archive chunks are out of order")
+        expected_index += 1
+        if end:
+            if total != count:
+                raise ValueError("export archive is incomplete")
+            return
 
-    elif keyword == "DROP":
-        print("-----> %s Help\n Drop the database tables. Requires confirmation upon use.\n"
-              " Form: DROP confirm" % keyword)
+        count += len(rows)
+        yield from rows
 
-    elif keyword == "BACKUP":
-        print("-----> %s Help\nBackup the database. Pass an optional filepath. Otherwise defaults to same directory.\n"
-              "Form: BACKUP (optional filepath)" % keyword)
+    raise ValueError("export archive is truncated")
 
-    else:
-        print("Invalid keyword.")
 
+def export_accounts(filepath, plain=False):
+    """ Export every service and account to a file.
+    By default the file is an encrypted archive readable by IMPORT with the key printed here.
+    With plain, the file is an unencrypted CSV.
+
+    :param filepath: the path of the file to create.
+    :param plain: write a plaintext CSV instead of an encrypted archive.
+    """
+    count, key = vault.export(filepath, plain)
+    if key is not None:
+        print("Export key (required to IMPORT the archive): %s" % key)
+    print("Exported %d rows to %s." % (count, filepath))
+
+
+# ---------- Agent Functions ---------- #
+
+
+def agent_socket_path():
+    """ Return the path of the agent's socket. Defaults to the PWManager directory,
+    overridden by the PW_AGENT_SOCK environment variable.
+
+    :return: the socket path.
+    """
+    if "PW_AGENT_SOCK" in os.environ:
+        return os.environ["PW_AGENT_SOCK"]
+    return os.path.join(os.path.split(os.path.realpath(__file__))[0], "agent.sock")
 
-# ---------- Database Functions ---------- #
 
-def create(db_connection):
-    """ Create the tables. Generate a key, store in db.
+def agent_request(request):
+    """ Send a request to the running agent and return its reply.
 
-    :param db_connection: the database connection which will store the tables."""
-    db_cursor = db_connection.cursor()
+    :param request: the request dict.
+    :return: the reply dict, or None if no agent is listening.
+    """
     try:
-        db_cursor.execute("""CREATE TABLE service (
-                        service_name  text PRIMARY KEY,
-                        shorthand_name text);""")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(agent_socket_path())
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                return json.loads(f.readline())
+    except (OSError, AttributeError, ValueError):  # No agent, stale socket or no AF_UNIX.
+        return None
 
-        db_cursor.execute("""CREATE TABLE account (
-                        account_name text,
-                        account_pw text,
-                        service_name text NOT NULL,
-                        FOREIGN KEY (service_name) REFERENCES service(service_name));""")
 
-        db_cursor.execute("""CREATE TABLE encryption (key text);""")
+def agent_handle(request):
+    """ Serve a single agent request against the open vault.
+    Interactive choices (which account, username, password) are made by the client,
+    which repeats the request with the extra field filled in.
 
-        # Generate and store key.
-        key = Fernet.generate_key()
-        db_cursor.execute("""INSERT INTO encryption VALUES(?)""", (key,))
+    :param request: the request dict.
+    :return: the reply dict.
+    """
+    op = request.get("op")
 
-        db_connection.commit()
-        print("Tables created.")
+    if op == "ping":
+        return {"ok": True}
 
-    except sqlite3.OperationalError:
-        print("Tables already exist.")
+    elif op == "get":
+        try:
+            username, pw = vault.get(request["service"], request.get("account"))
+        except ServiceNotFoundError:
+            return {"error": "Service doesn't exist." + service_suggestion(request["service"])}
+        except AmbiguousAccountError as e:
+            return {"accounts": e.usernames}
+        return {"username": username, "password": pw}
+
+    elif op == "ls":
+        options = parse_ls_args(request["args"])
+        if options is None:
+            return {"error": "Invalid arguments. Type HELP LS for the available options.\n"}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            ls(**options)
+        return {"output": output.getvalue()}
+
+    elif op == "add":
+        try:
+            usernames = vault.usernames(request["service"])
+        except ServiceNotFoundError:
+            return {"error": "Service doesn't exist. Define a service using the DEFINE keyword."
+                             + service_suggestion(request["service"])}
+        if "username" not in request:
+            return {"ok": True}
+
+        if request["username"] in usernames:
+            return {"error": "An account with this username already exists."}
+        if "password" in request:
+            vault.add(request["service"], request["username"], request["password"])
+        return {"ok": True}
 
+    return {"error": "Unknown request."}
 
-def drop(db_connection):
-    """ Drop the tables.
 
-     :param db_connection: the database connection which will drop the tables."""
-    db_cursor = db_connection.cursor()
+class AgentHandler(socketserver.StreamRequestHandler):
+    """ Read one JSON request line from a client and write back one JSON reply line. """
 
+    def handle(self):
+        self.server.last_request = time.monotonic()
+        if agent_expired():  # No reply, so the client falls back to asking for the master password.
+            self.server.stopping = True
+            return
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("op") in ("stop", "lock"):
+                self.server.stopping = True
+                reply = {"ok": True}
+            else:
+                reply = agent_handle(request)
+        except VaultError as e:
+            reply = {"error": str(e)}
+        except (ValueError, KeyError, IndexError, sqlite3.Error) as e:
+            reply = {"error": "Agent error. (%s)" % e}
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+def agent_expired():
+    """ Check whether the agent's unlocked master password has expired, after which it mustn't serve requests.
+
+    :return: true if the session has expired, false otherwise (or if no master password is set).
+    """
+    return vault.session_expires is not None and time.time() >= vault.session_expires
+
+
+def agent_start(timeout=AGENT_IDLE_TIMEOUT):
+    """ Start the agent in the background. It keeps the database open and the key loaded,
+    serving GET, LS and ADD for the CLI over a Unix domain socket until it has been idle
+    for the timeout, is locked, or the unlocked master password expires.
+
+    :param timeout: seconds without a request before the agent exits.
+    """
+    if not hasattr(socket, "AF_UNIX") or not hasattr(os, "fork"):
+        print("The agent requires Unix domain sockets.")
+        return
+    vault.require_tables()
+    if agent_request({"op": "ping"}) is not None:
+        print("Agent already running.")
+        return
+
+    sock_path = agent_socket_path()
+    if os.path.exists(sock_path):  # Left behind by an agent that didn't exit cleanly.
+        os.remove(sock_path)
+
+    vault.cipher()  # Unlock before detaching.
+    vault.secret_cache = SecretCache()  # Repeated GETs of a service skip the query and decryption.
+    vault.service_index()  # Load the index up front so completions and suggestions don't wait for it.
+    old_umask = os.umask(0o177)  # Socket is only accessible by the owner.
     try:
-        db_cursor.execute("DROP TABLE account;")
-        db_cursor.execute("DROP TABLE service;")
-        db_cursor.execute("DROP TABLE encryption;")
-        db_connection.commit()
-        print("Tables deleted.")
+        server = socketserver.UnixStreamServer(sock_path, AgentHandler)
+    finally:
+        os.umask(old_umask)
+
+    pid = os.fork()
+    if pid != 0:
+        if vault.session_expires is None:
+            print("Agent started. (pid %d, idle timeout %ds)" % (pid, timeout))
+        else:
+            print("Agent started. (pid %d, idle timeout %ds, stops when the session expires in %.0fs)"
+                  % (pid, timeout, vault.session_expires - time.time()))
+        sys.stdout.flush()
+        os._exit(0)
+
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):  # Detach from the terminal.
+        os.dup2(devnull, fd)
+    server.timeout = 1  # Wake up regularly to check the idle timeout.
+    server.last_request = time.monotonic()
+    server.stopping = False
+    try:
+        while not server.stopping and not agent_expired() and time.monotonic() - server.last_request < timeout:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(sock_path)
+        vault.close()  # Wipes the cached passwords.
+
+
+def agent_stop():
+    """ Ask the running agent to exit. """
+    if agent_request({"op": "stop"}) is None:
+        print("Agent is not running.")
+    else:
+        print("Agent stopped.")
+
+
+def agent_dispatch():
+    """ Forward GET, LS and ADD to a running agent instead of opening the database.
+
+    :return: true if the command was served by the agent, false otherwise.
+    """
+    if len(sys.argv) < 2 or sys.argv[1].upper() not in AGENT_KEYWORDS:
+        return False
+    if not os.path.exists(agent_socket_path()):
+        return False
+    keyword = sys.argv[1].upper()
+
+    if keyword == "GET":
+        if len(sys.argv) != 3:
+            return False
+        request = {"op": "get", "service": sys.argv[2].lower()}
+        reply = agent_request(request)
+        if reply is None:
+            return False
+
+        if "accounts" in reply:
+            print("Which account? (enter number)")
+            for i in range(0, len(reply["accounts"])):
+                print("[%d] %s" % (i+1, reply["accounts"][i]))
+            try:
+                acc = int(input(" > "))
+                if not 1 <= acc <= len(reply["accounts"]):
+                    print("Invalid choice.")
+                    return True
+                request["account"] = reply["accounts"][acc-1]
+                reply = agent_request(request)
+            except ValueError:
+                print("Invalid input.")
+                return True
+
+        if "error" in reply:
+            print(reply["error"])
+        else:
+            lazy_import("pyperclip").copy(reply["password"])
+            print("Password copied to clipboard. (username: %s)" % reply["username"])
+
+    elif keyword == "LS":
+        reply = agent_request({"op": "ls", "args": sys.argv[2:]})
+        if reply is None:
+            return False
+        print(reply.get("output", reply.get("error")), end="")
+
+    elif keyword == "ADD":
+        if len(sys.argv) != 3:
+            return False
+        request = {"op": "add", "service": sys.argv[2].lower()}
+        reply = agent_request(request)
+        if reply is None:
+            return False
+
+        if "error" not in reply:
+            request["username"] = input("Enter Username\n > ")
+            reply = agent_request(request)
+        if "error" not in reply:
+            request["password"] = getpass.getpass("Enter Password\n > ")
+            if not breach_confirm(request["password"]):  # Checked here, since the agent can't ask.
+                return True
+            reply = agent_request(request)
+        print(reply.get("error", "Account added."))
+
+    return True
+
+
+# ---------- Process Pool ---------- #
+
+
+def map_chunks(function, arg, chunks):
+    """ Call function(arg, chunk) for each chunk across a process pool. Chunks are read as workers
+    become free, so every worker is kept busy without reading all of them into memory.
+
+    :param function: a module-level function, so it can be sent to the workers.
+    :param arg: the first argument of every call, e.g. keys.
+    :param chunks: an iterable of chunks.
+    :return: a generator of (chunk, result) pairs, in the order of the chunks.
+    """
+    workers = os.cpu_count() or 1
+    with lazy_import("concurrent.futures").ProcessPoolExecutor(workers) as executor:
+        in_flight = collections.deque()  # (chunk, future) in the order the chunks were read.
+        for chunk in chunks:
+            in_flight.append((chunk, executor.submit(function, arg, chunk)))
+            if len(in_flight) == 2 * workers:
+                chunk, future = in_flight.popleft()
+                yield chunk, future.result()
+        while in_flight:
+            chunk, future = in_flight.popleft()
+            yield chunk, future.result()
+
+
+# ---------- Key Rotation ---------- #
+
+
+def rotate_chunk(keys, rows):
+    """ Re-encrypt a chunk of passwords under the new key. Runs in a worker process.
+
+    :param keys: the new key followed by the old key.
+    :param rows: (rowid, stored token) pairs.
+    :return: (new token, rowid) pairs, ready for the UPDATE statement.
+    """
+    fernet = lazy_import("cryptography.fernet")
+    cipher = fernet.MultiFernet([fernet.Fernet(key) for key in keys])
+    return [(pack_token(cipher.rotate(unpack_token(token))), rowid) for rowid, token in rows]
+
+
+def rotate():
+    """ Generate a new key and re-encrypt every password with it, showing progress.
+    An interrupted rotation is resumed by running ROTATE again.
+    """
+    def progress(done, total):
+        """ Report the number of passwords rotated so far. """
+        print("\rRotated %d/%d passwords... " % (done, total), end="")
+
+    if vault.rotation_pending():
+        print("Resuming interrupted rotation.")
+    vault.rotate(progress)
+    print("\nKey rotated.")
+
+
+# ---------- Verification ---------- #
+
+
+def verify_chunk(keys, rows):
+    """ Check that each password in a chunk is a valid token under one of the keys. Runs in a worker
+    process. Only the tokens' signatures are checked, so no password is decrypted.
+
+    :param keys: the vault's key, followed by the new key if a rotation is in progress.
+    :param rows: (rowid, service, username, token) rows.
+    :return: (service, username) of each account whose token is invalid.
+    """
+    fernet = lazy_import("cryptography.fernet")
+    ciphers = [fernet.Fernet(key) for key in keys]
+    invalid = []
+    for _, service, username, token in rows:
+        for cipher in ciphers:
+            try:
+                cipher.extract_timestamp(unpack_token(token))
+                break
+            except (fernet.InvalidToken, TypeError, ValueError):  # TypeError for a missing password.
+                pass
+        else:
+            invalid.append((service, username))
+    return invalid
+
+
+def verify():
+    """ Check the vault for damage, showing progress. Exits with status 1 if there are problems. """
+    def progress(done, total):
+        """ Report the number of passwords checked so far. """
+        print("\rChecked %d/%d passwords... " % (done, total), end="")
+
+    problems = vault.verify(progress)
+    print()
+    for problem in problems:
+        print(" - %s" % problem)
+    if problems:
+        sys.exit("%d problem%s found." % (len(problems), "" if len(problems) == 1 else "s"))
+    print("No problems found.")
+
+
+# ---------- Breach Check ---------- #
+
+
+_breach_indexes = {}  # Breach indexes opened by this process, by path.
+
+
+def breach_index_path():
+    """ Return the path of the breach index. Defaults to the PWManager directory,
+    overridden by the PW_BREACH_INDEX environment variable.
+
+    :return: the index path.
+    """
+    if "PW_BREACH_INDEX" in os.environ:
+        return os.environ["PW_BREACH_INDEX"]
+    return os.path.join(os.path.split(os.path.realpath(__file__))[0], BREACH_INDEX_FILE)
+
+
+def breach_confirm(pw):
+    """ Check a new password against the breach index, if there is one, and ask whether to use it
+    anyway if it's been breached or the index can't be read.
+
+    :param pw: the password.
+    :return: true to go ahead and store the password.
+    """
+    if not os.path.exists(breach_index_path()):
+        return True
+    try:
+        with trace("breach", "lookup"), BreachIndex(breach_index_path()) as index:
+            if pw not in index:
+                return True
+        question = "This password appears in a known data breach. Use it anyway?"
+    except VaultError as e:  # E.g. an index left empty by an interrupted copy.
+        question = "%s\nThe password couldn't be checked against it. Use it anyway?" % e
+    answer = input(question + " (y/n)\n > ")
+    if answer.lower() in ("y", "yes"):
+        return True
+    print("Password not stored.")
+    return False
+
+
+def breach_chunk(arg, rows):
+    """ Decrypt a chunk of passwords and look each up in the breach index. Runs in a worker process.
+
+    :param arg: the keys (see Vault.keys()) and the path of the breach index.
+    :param rows: (rowid, service, username, token) rows.
+    :return: (service, username) of each account whose password is in the index.
+    """
+    keys, index_path = arg
+    fernet = lazy_import("cryptography.fernet")
+    cipher = fernet.MultiFernet([fernet.Fernet(key) for key in keys])
+    if index_path not in _breach_indexes:  # Kept open for the worker's later chunks.
+        _breach_indexes[index_path] = BreachIndex(index_path)
+    index = _breach_indexes[index_path]
+    breached = []
+    for _, service, username, token in rows:
+        try:
+            pw = cipher.decrypt(unpack_token(token))
+        except (fernet.InvalidToken, TypeError):  # Reported by VERIFY.
+            continue
+        if pw in index:
+            breached.append((service, username))
+    return breached
+
+
+def breach_build(filepath):
+    """ Build the breach index from a Pwned Passwords SHA-1 download, showing progress.
+
+    :param filepath: the path of the downloaded file.
+    """
+    def progress(read):
+        """ Report the number of hashes read so far. """
+        print("\rRead %d hashes... " % read, end="")
+
+    try:
+        count = build_breach_index(filepath, breach_index_path(), progress)
+    except FileNotFoundError:
+        print("Invalid filepath provided.")
+        return
+    print("\nBuilt a breach index of %d hashes at %s." % (count, breach_index_path()))
+
+
+def breach_audit():
+    """ Check every password in the vault against the breach index, showing progress.
+    Exits with status 1 if any has been breached.
+    """
+    def progress(done, total):
+        """ Report the number of passwords checked so far. """
+        print("\rChecked %d/%d passwords... " % (done, total), end="")
+
+    if not os.path.exists(breach_index_path()):
+        print("There's no breach index. Build one with BREACH BUILD.")
+        return
+    breached = vault.breached(breach_index_path(), progress)
+    print()
+    for service, username in breached:
+        print(" - %s on %s" % (username, service))
+    if breached:
+        sys.exit("%d breached password%s found. Change them with UPDATE -a."
+                 % (len(breached), "" if len(breached) == 1 else "s"))
+    print("No breached passwords found.")
+
+
+# ---------- Reuse Audit ---------- #
+
+
+def fingerprint_chunk(keys, rows):
+    """ Decrypt and fingerprint a chunk of passwords. Runs in a worker process.
+
+    :param keys: the keys (see Vault.keys()) and the fingerprint key.
+    :param rows: (rowid, stored token) pairs.
+    :return: (fingerprint, rowid) pairs, ready for the UPDATE statement. Passwords that can't be
+             decrypted are left out, for VERIFY to report.
+    """
+    keys, fingerprint_key = keys
+    fernet = lazy_import("cryptography.fernet")
+    cipher = fernet.MultiFernet([fernet.Fernet(key) for key in keys])
+    fingerprints = []
+    for rowid, token in rows:
+        try:
+            pw = cipher.decrypt(unpack_token(token))
+        except (fernet.InvalidToken, TypeError):
+            continue
+        fingerprints.append((hmac.new(fingerprint_key, pw, hashlib.sha256).digest()[:FINGERPRINT_SIZE], rowid))
+    return fingerprints
+
+
+def audit():
+    """ List the passwords used by more than one account. Exits with status 1 if there are any. """
+    def progress(done, total):
+        """ Report the number of passwords fingerprinted so far. """
+        print("\rFingerprinted %d/%d passwords... " % (done, total), end="\n" if done == total else "")
+
+    groups = vault.reused(progress)
+    for n, accounts in enumerate(groups, 1):
+        print(" - Password %d is used by %s" % (n, ", ".join("%s on %s" % (username, service)
+                                                           for service, username in accounts)))
+    if groups:
+        sys.exit("%d password%s reused. Change them with UPDATE -a."
+                 % (len(groups), " is" if len(groups) == 1 else "s are"))
+    print("No reused passwords found.")
+
+
+# ---------- Database Functions ---------- #
+
+def create():
+    """ Create the tables. """
+    vault.create()
+    print("Tables created.")
 
-    except sqlite3.OperationalError:
-        print("Tables don't exist.")
 
+def drop():
+    """ Drop the tables. """
+    vault.drop()
+    print("Tables deleted.")
 
-def backup(filepath=None):
+
+def backup(filepath=None, rotate=False):
     """
-    Create a copy of the database at the provided filepath.
+    Create a copy of the database at the provided filepath, reporting progress.
+    In rotating mode a timestamped snapshot is written only if the vault changed since the
+    newest snapshot, and only the newest BACKUP_RETENTION snapshots are kept.
     :param filepath: The filepath where the backup will be created.
+    :param rotate: Write a timestamped snapshot instead of overwriting (vault)_backup.db.
+    """
+    def progress(status, remaining, total):
+        """ Report the number of pages copied so far. """
+        print("\rCopied %d/%d pages... " % (total - remaining, total), end="")
+
+    target, removed = vault.backup(filepath, rotate, progress)
+    if target is None:
+        latest = list_snapshots(filepath or vault.directory, vault.stem)[-1]
+        print("No changes since the last snapshot. (%s)" % os.path.basename(latest))
+        return
+
+    print("\nBackup complete. (%s)" % target)
+    for old in removed:
+        print("Removed old snapshot. (%s)" % os.path.basename(old))
+
+
+def list_snapshots(filepath, stem="store"):
+    """ List the rotating snapshots of a vault in a directory, oldest first.
+
+    :param filepath: the directory holding the snapshots.
+    :param stem: the vault's file name without the extension.
+    :return: the snapshot paths.
+    """
+    try:
+        files = os.listdir(filepath)
+    except OSError:
+        return []
+    # The timestamp format sorts chronologically.
+    return [os.path.join(filepath, f) for f in sorted(files)
+            if f.startswith(stem + "_backup_") and f.endswith(".db")]
+
+
+# ---------- Multiple Vaults ---------- #
+
+
+def default_vault_path():
+    """ Return the path of the default vault, store.db next to the script. """
+    return os.path.join(os.path.split(os.path.realpath(__file__))[0], "store.db")
+
+
+def vault_option():
+    """ Read which vaults to use: --vault before the keyword (removed from the arguments),
+    or else the PW_VAULT environment variable.
+
+    :return: the selection (see vault_paths()), or None for the default vault.
     """
+    if len(sys.argv) > 2 and sys.argv[1] == "--vault":
+        del sys.argv[1]
+        return sys.argv.pop(1)
+    return os.environ.get("PW_VAULT") or None
 
-    if filepath is None:
-        # Default to the PWManager directory.
-        b_file_path = os.path.realpath(__file__)
-        filepath = os.path.split(b_file_path)[0]
+
+def valid_vault_name(name):
+    """ Return true if a name can be used for a vault. Names are letters, digits and hyphens,
+    so they can't be mistaken for a backup's file name.
+    """
+    return name.isascii() and name.replace("-", "").isalnum() and name not in ("all", "default")
+
+
+def named_vaults():
+    """ Return the path of every named vault by name, in name order. """
+    directory = os.path.join(os.path.split(default_vault_path())[0], VAULTS_DIRECTORY)
+    try:
+        files = sorted(os.listdir(directory))
+    except OSError:
+        return {}
+    paths = {}
+    for f in files:
+        name, extension = os.path.splitext(f)
+        if extension == ".db" and valid_vault_name(name):  # Not a backup.
+            paths[name] = os.path.join(directory, f)
+    return paths
+
+
+def vault_paths(selection, create=False):
+    """ Resolve a selection of vaults to their database files. A selection is "default" (store.db
+    next to the script), the name of a vault in VAULTS_DIRECTORY, the path of a .db file such as a
+    backup, "all" for the default and every named vault, or several of these separated by commas.
+
+    :param selection: the selection, or None for the default vault.
+    :param create: allow a named vault that doesn't exist yet, to CREATE it.
+    :return: the path of each selected vault's database, by name.
+    :raises VaultError: if a selected vault doesn't exist or a name is invalid.
+    """
+    if selection is None:
+        return {"default": default_vault_path()}
+
+    named = named_vaults()
+    paths = {}
+    for part in selection.split(","):
+        if part in ("all", "default"):
+            paths["default"] = default_vault_path()
+            if part == "all":
+                paths.update(named)
+        elif part.endswith(".db") or os.sep in part:
+            if not os.path.isfile(part):
+                raise VaultError("No vault file at %s." % part)
+            paths[part] = part
+        elif not valid_vault_name(part):
+            raise VaultError("Invalid vault name. Use letters, digits and hyphens.")
+        elif part in named:
+            paths[part] = named[part]
+        elif create:
+            directory = os.path.join(os.path.split(default_vault_path())[0], VAULTS_DIRECTORY)
+            os.makedirs(directory, exist_ok=True)
+            paths[part] = os.path.join(directory, part + ".db")
+        else:
+            raise VaultError("Vault '%s' doesn't exist. Create it with --vault %s CREATE CONFIRM." % (part, part))
+    return paths
+
+
+def list_vaults():
+    """ List the default vault and every named vault. """
+    print("  - default (%s)" % default_vault_path())
+    for name, path in named_vaults().items():
+        print("  - %s (%s)" % (name, path))
+
+
+def get_across(service):
+    """ Get the account for a service from whichever of the selected vaults holds it.
+    Several accounts, in one vault or across several, require input to choose between them.
+
+    :param service: name or shorthand of the service.
+    """
     try:
-        b_connection = sqlite3.connect(os.path.join(filepath, "store_backup.db"))
-        create(b_connection)  # Create the tables in the backup database.
-        b_cursor = b_connection.cursor()
-
-        # Copy data from SERVICE table.
-        cursor.execute("SELECT * FROM service;")
-        for row in cursor.fetchall():
-            b_cursor.execute("INSERT INTO service VALUES(?, ?)", (row[0], row[1]))
-        print("Copied service data... ", end="")
-
-        # Copy data from ACCOUNT table.
-        cursor.execute("SELECT * FROM account;")
-        for row in cursor.fetchall():
-            b_cursor.execute("INSERT INTO account VALUES(?, ?, ?)", (row[0], row[1], row[2]))
-        print("Copied account data... ", end="")
-
-        # Copy data from ENCRYPTION table.
-        cursor.execute("SELECT * FROM encryption;")
-        for row in cursor.fetchall():
-            b_cursor.execute("INSERT INTO encryption VALUES(?)", (row[0],))
-        print("Copied encryption data...")
-
-        b_connection.commit()
-        print("Backup complete.")
+        found = vaults.accounts(service)
+    except ServiceNotFoundError:
+        print("Service doesn't exist in any of the vaults.")
+        return
+    if not found:
+        print("This service doesn't have any associated accounts.")
+        return
 
+    name, username = found[0]
+    if len(found) > 1:
+        labels = ["%s (%s)" % (username, name) for name, username in found]
+        choice = choose_account(labels)
+        if choice is None:
+            return
+        name, username = found[labels.index(choice)]
+
+    lazy_import("pyperclip").copy(vaults.get(name, service, username)[1])
+    print("Password copied to clipboard. (username: %s, vault: %s)" % (username, name))
+
+
+def sync(target):
+    """ Merge the vault with another vault, both ways, exchanging only what changed since they last synced.
+    A vault is created if the file doesn't exist, so SYNC also makes a copy with its own key.
+
+    :param target: the name of a vault, or the path of a vault's .db file.
+    """
+    if target.endswith(".db") or os.sep in target:
+        path = target
+    else:
+        paths = vault_paths(target, create=True)
+        if len(paths) != 1:
+            print("SYNC takes one vault.")
+            return
+        path = next(iter(paths.values()))
+    if os.path.realpath(path) == os.path.realpath(vault.path):
+        print("A vault can't be synced with itself.")
+        return
+
+    try:
+        other = Vault(path, unlock=lambda: ask_master_password(target))
     except sqlite3.OperationalError:
         print("Invalid filepath provided.")
-        # This is a catch-all. Also excepts when you backup without having created the store.db tables.
+        return
+    with other:
+        if not other.tables_exist():
+            other.create()
+            print("Created a new vault at %s." % path)
+        sent, received, conflicts = vault.sync(other)
+    for conflict in conflicts:
+        print(" - %s" % conflict)
+    print("Sync complete. Sent %d rows, received %d rows, %d conflicts." % (sent, received, len(conflicts)))
+
+
+# ---------- Schema Migrations ---------- #
+
+
+def migrate_v1(db_cursor):
+    """ Index shorthands, make accounts unique per service and cascade service changes to accounts.
+    The account table is rebuilt since SQLite can't alter constraints in place. No password is
+    dropped: accounts left behind by an interrupted rename get their service back, and all but the
+    first of a service's accounts with the same username are renamed "username (duplicate n)".
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("CREATE UNIQUE INDEX service_shorthand ON service(shorthand_name);")
+
+    db_cursor.execute("""INSERT INTO service(service_name)
+                    SELECT DISTINCT service_name FROM account
+                    WHERE service_name NOT IN (SELECT service_name FROM service);""")
+    db_cursor.execute("SELECT service_name, account_name FROM account;")
+    taken = set(db_cursor.fetchall())
+    db_cursor.execute("""SELECT rowid, service_name, account_name FROM account WHERE account_name IS NOT NULL
+                    AND rowid NOT IN (SELECT min(rowid) FROM account GROUP BY service_name, account_name);""")
+    for rowid, service, username in db_cursor.fetchall():
+        n = 2
+        while (service, "%s (duplicate %d)" % (username, n)) in taken:
+            n += 1
+        taken.add((service, "%s (duplicate %d)" % (username, n)))
+        db_cursor.execute("UPDATE account SET account_name = ? WHERE rowid = ?;",
+                          ("%s (duplicate %d)" % (username, n), rowid))
+
+    # The UNIQUE constraint is backed by an index on (service_name, account_name).
+    db_cursor.execute("""CREATE TABLE account_new (
+                    account_name text,
+                    account_pw text,
+                    service_name text NOT NULL,
+                    UNIQUE (service_name, account_name),
+                    FOREIGN KEY (service_name) REFERENCES service(service_name)
+                        ON DELETE CASCADE ON UPDATE CASCADE);""")
+    db_cursor.execute("INSERT INTO account_new SELECT account_name, account_pw, service_name FROM account;")
+    db_cursor.execute("DROP TABLE account;")
+    db_cursor.execute("ALTER TABLE account_new RENAME TO account;")
+
+
+def migrate_v2(db_cursor):
+    """ Add a full-text index over service names, shorthands and account usernames.
+    Services are indexed under the negated rowid and accounts under their own rowid.
+    Triggers keep the index in step with both tables.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("""CREATE VIRTUAL TABLE search_index USING fts5(service_name, shorthand_name, account_name);""")
+
+    db_cursor.execute("""CREATE TRIGGER service_search_insert AFTER INSERT ON service BEGIN
+                    INSERT INTO search_index(rowid, service_name, shorthand_name)
+                    VALUES (-new.rowid, new.service_name, new.shorthand_name);
+                    END;""")
+    db_cursor.execute("""CREATE TRIGGER service_search_update AFTER UPDATE ON service BEGIN
+                    UPDATE search_index SET service_name = new.service_name, shorthand_name = new.shorthand_name
+                    WHERE rowid = -old.rowid;
+                    END;""")
+    db_cursor.execute("""CREATE TRIGGER service_search_delete AFTER DELETE ON service BEGIN
+                    DELETE FROM search_index WHERE rowid = -old.rowid;
+                    END;""")
+
+    db_cursor.execute("""CREATE TRIGGER account_search_insert AFTER INSERT ON account BEGIN
+                    INSERT INTO search_index(rowid, service_name, account_name)
+                    VALUES (new.rowid, new.service_name, new.account_name);
+                    END;""")
+    db_cursor.execute("""CREATE TRIGGER account_search_update AFTER UPDATE OF service_name, account_name ON account
+                    BEGIN
+                    UPDATE search_index SET service_name = new.service_name, account_name = new.account_name
+                    WHERE rowid = old.rowid;
+                    END;""")
+    db_cursor.execute("""CREATE TRIGGER account_search_delete AFTER DELETE ON account BEGIN
+                    DELETE FROM search_index WHERE rowid = old.rowid;
+                    END;""")
+
+    rebuild_search_index(db_cursor)
+
+
+def rebuild_search_index(db_cursor):
+    """ Repopulate the full-text index from the service and account tables.
+    Needed whenever a migration rebuilds either table, since their rowids change.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("DELETE FROM search_index;")
+    db_cursor.execute("""INSERT INTO search_index(rowid, service_name, shorthand_name)
+                    SELECT -rowid, service_name, shorthand_name FROM service;""")
+    db_cursor.execute("""INSERT INTO search_index(rowid, service_name, account_name)
+                    SELECT rowid, service_name, account_name FROM account;""")
+
+
+def migrate_v3(db_cursor):
+    """ Add the table holding the new key and checkpoint of an unfinished key rotation.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("CREATE TABLE rotation (new_key text, last_rowid integer);")
+
+
+def migrate_v4(db_cursor):
+    """ Add the table holding the scrypt parameters of the master password.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("CREATE TABLE master (salt blob, n integer, r integer, p integer);")
+
+
+def migrate_v5(db_cursor):
+    """ Store passwords as raw Fernet tokens in BLOBs instead of base64, about a quarter smaller.
+    Values are converted in place, so rowids and the search index are unchanged. Values that
+    aren't valid base64 are left as they are for VERIFY to report.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    last_rowid = 0
+    while True:
+        db_cursor.execute("SELECT rowid, account_pw FROM account WHERE rowid > ? ORDER BY rowid LIMIT ?;",
+                          (last_rowid, MIGRATE_CHUNK_SIZE))
+        rows = db_cursor.fetchall()
+        if not rows:
+            return
+        packed = []
+        for rowid, token in rows:
+            try:
+                packed.append((pack_token(token), rowid))
+            except (TypeError, ValueError):
+                pass
+        db_cursor.executemany("UPDATE account SET account_pw = ? WHERE rowid = ?;", packed)
+        last_rowid = rows[-1][0]
+
+
+def change_log_sql(service, account):
+    """ Return the trigger statements logging a change to a service (account NULL) or an account.
+
+    :param service: the SQL expression of the service name, e.g. "new.service_name".
+    :param account: the SQL expression of the account name, or "NULL" for the service itself.
+    """
+    return ("""DELETE FROM change_log WHERE service_name = %s AND account_name IS %s;
+            INSERT INTO change_log(service_name, account_name, changed_at) VALUES (%s, %s, %s);"""
+            % (service, account, service, account, CHANGE_LOG_NOW))
+
+
+def migrate_v6(db_cursor):
+    """ Track changes for SYNC. Triggers keep a change log holding the latest change to each service
+    and account, deletions included, numbered in order. Each vault gets a random replica id, and
+    sync_peer records how much of each other vault's log it has received. Existing services and
+    accounts are logged as changed now, so a vault's first sync with another exchanges everything.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("""CREATE TABLE change_log (
+                    seq integer PRIMARY KEY AUTOINCREMENT,
+                    service_name text NOT NULL,
+                    account_name text,
+                    changed_at real NOT NULL);""")
+    db_cursor.execute("CREATE INDEX change_log_key ON change_log(service_name, account_name);")
+    db_cursor.execute("CREATE TABLE replica (id text NOT NULL);")
+    db_cursor.execute("INSERT INTO replica VALUES(?);", (os.urandom(16).hex(),))
+    db_cursor.execute("""CREATE TABLE sync_peer (
+                    peer_id text PRIMARY KEY,
+                    received_seq integer NOT NULL,
+                    synced_at real NOT NULL);""")
+
+    # A rename is logged as a change to both names. Logging the same key twice leaves one entry.
+    db_cursor.execute("CREATE TRIGGER service_log_insert AFTER INSERT ON service BEGIN %s END;"
+                      % change_log_sql("new.service_name", "NULL"))
+    db_cursor.execute("CREATE TRIGGER service_log_update AFTER UPDATE ON service BEGIN %s %s END;"
+                      % (change_log_sql("old.service_name", "NULL"), change_log_sql("new.service_name", "NULL")))
+    db_cursor.execute("CREATE TRIGGER service_log_delete AFTER DELETE ON service BEGIN %s END;"
+                      % change_log_sql("old.service_name", "NULL"))
+    db_cursor.execute("CREATE TRIGGER account_log_insert AFTER INSERT ON account BEGIN %s END;"
+                      % change_log_sql("new.service_name", "new.account_name"))
+    db_cursor.execute("""CREATE TRIGGER account_log_update AFTER UPDATE OF service_name, account_name, account_pw
+                    ON account BEGIN %s %s END;"""
+                      % (change_log_sql("old.service_name", "old.account_name"),
+                         change_log_sql("new.service_name", "new.account_name")))
+    db_cursor.execute("CREATE TRIGGER account_log_delete AFTER DELETE ON account BEGIN %s END;"
+                      % change_log_sql("old.service_name", "old.account_name"))
+
+    db_cursor.execute("INSERT INTO change_log(service_name, account_name, changed_at) SELECT service_name, NULL, %s"
+                      " FROM service;" % CHANGE_LOG_NOW)
+    db_cursor.execute("INSERT INTO change_log(service_name, account_name, changed_at) SELECT service_name,"
+                      " account_name, %s FROM account;" % CHANGE_LOG_NOW)
+
+
+def migrate_v7(db_cursor):
+    """ Add a keyed fingerprint of each password, indexed with the account's names so AUDIT can find
+    reused passwords from the index alone. Fingerprints need the passwords decrypted, so existing
+    accounts are left without one until AUDIT fills them in. The key is generated here (so new vaults
+    have one from the start), unless a master password is set: it can't be wrapped until the vault is
+    unlocked, so it's generated on first use instead.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("ALTER TABLE account ADD COLUMN account_fp blob;")
+    db_cursor.execute("CREATE INDEX account_fingerprint ON account(account_fp, service_name, account_name);")
+    db_cursor.execute("ALTER TABLE encryption ADD COLUMN fingerprint_key blob;")
+    db_cursor.execute("UPDATE encryption SET fingerprint_key = ? WHERE NOT EXISTS (SELECT * FROM master);",
+                      (os.urandom(32),))
+
+
+def migrate_v8(db_cursor):
+    """ Stop logging re-encryption as a change for SYNC. A password's token changes whenever ROTATE
+    re-encrypts it, and its fingerprint changes when AUDIT fills one in, but the password itself has
+    only changed when both do. Otherwise a rotated vault's old passwords would win sync conflicts.
+
+    :param db_cursor: the cursor of the database being migrated.
+    """
+    db_cursor.execute("DROP TRIGGER account_log_update;")
+    db_cursor.execute("""CREATE TRIGGER account_log_update AFTER UPDATE OF service_name, account_name, account_pw
+                    ON account WHEN old.service_name IS NOT new.service_name OR old.account_name IS NOT new.account_name
+                    OR (old.account_pw IS NOT new.account_pw AND old.account_fp IS NOT new.account_fp)
+                    BEGIN %s %s END;"""
+                      % (change_log_sql("old.service_name", "old.account_name"),
+                         change_log_sql("new.service_name", "new.account_name")))
+
+
+# Migration N upgrades the schema from user_version N-1 to N. Only ever append to this list.
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6, migrate_v7, migrate_v8]
+
+
+def migrate(db_connection):
+    """ Apply any migrations the database hasn't had yet, each in its own transaction.
+    The schema version is tracked with PRAGMA user_version.
+
+    :param db_connection: the database connection to migrate.
+    """
+    version = db_connection.execute("PRAGMA user_version;").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        db_connection.commit()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("BEGIN IMMEDIATE;")
+        try:
+            # Another connection may have applied it while this one waited for the write lock.
+            if db_cursor.execute("PRAGMA user_version;").fetchone()[0] < number:
+                migration(db_cursor)
+                db_cursor.execute("PRAGMA user_version = %d;" % number)
+            db_connection.commit()
+        except sqlite3.Error:
+            db_connection.rollback()
+            raise
+
+    # Migrations that rewrite rows leave the old pages free. Return them to the file system, so the
+    # file and its backups shrink, unless another connection is busy; the space is reused either way.
+    try:
+        db_connection.execute("VACUUM;")
+    except sqlite3.OperationalError:
+        pass
 
 
 # ---------- Run ---------- #
 
+
+def main():
+    """ Run the keyword given on the command line. """
+    global vault, vaults
+    start_trace()
+    vaults = None  # A VaultSet, when several vaults are selected.
+    try:
+        selection = vault_option()
+        # Agent serves the default vault without opening the db.
+        if selection is not None or not agent_dispatch():
+            keyword = sys.argv[1].upper() if len(sys.argv) > 1 else "HELP"
+            try:
+                if keyword not in OFFLINE_KEYWORDS:
+                    paths = vault_paths(selection, create=keyword == "CREATE")
+                    with trace("connect", ", ".join(paths)):
+                        if len(paths) == 1:
+                            vault = Vault(next(iter(paths.values())), unlock=ask_master_password)
+                        elif keyword in FEDERATED_KEYWORDS:
+                            vaults = VaultSet(paths, unlock=ask_master_password)
+                        else:
+                            raise VaultError("Only %s can use several vaults at once." % ", ".join(FEDERATED_KEYWORDS))
+                with trace("command", keyword):
+                    menu()
+            except MasterPasswordError as e:
+                sys.exit(str(e))
+            except VaultError as e:
+                print(e)
+    finally:
+        if vaults is not None:
+            vaults.close()
+        finish_trace()
+
+
 if __name__ == "__main__":
-    full_path = os.path.realpath(__file__)
-    path = os.path.split(full_path)[0]  # [0] is path, [1] is file.
-    connection = sqlite3.connect(os.path.join(path, "store.db"))
-    cursor = connection.cursor()
-    menu()
+    main()
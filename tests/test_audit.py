@@ -0,0 +1,84 @@
+""" Tests of AUDIT's password fingerprints. """
+import collections
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+
+class AuditTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "store.db")
+        self.vault = pwmanager.Vault(self.path)
+        self.vault.create()
+        self.vault.define("github")
+
+    def tearDown(self):
+        self.vault.close()
+        self.directory.cleanup()
+
+    def test_reused(self):
+        self.vault.add("github", "me", "same")
+        self.vault.add("github", "you", "same")
+        self.vault.add("github", "them", "different")
+        self.assertEqual(self.vault.reused(), [[("github", "me"), ("github", "you")]])
+
+    def forget_fingerprint_key(self):
+        """ Make the vault look like one migrated with a master password set, whose key is made on first use. """
+        self.vault.connection.execute("UPDATE encryption SET fingerprint_key = NULL;")
+        self.vault.connection.commit()
+        self.vault.reset_cipher()
+
+    def test_key_survives_rolled_back_batch(self):
+        self.forget_fingerprint_key()
+        ops = [{"op": "add", "service": "github", "username": "me", "password": "same"},
+               {"op": "remove", "service": "missing"}]
+        results = self.vault.batch(json.dumps(op) for op in ops)
+        self.assertFalse(all(succeeded for _, succeeded, _ in results))
+        self.vault.add("github", "me", "same")
+        self.vault.close()
+
+        self.vault = pwmanager.Vault(self.path)  # A later process, which reads the key from the database.
+        self.vault.add("github", "you", "same")
+        self.assertEqual(self.vault.reused(), [[("github", "me"), ("github", "you")]])
+
+    def test_key_read_once(self):
+        self.forget_fingerprint_key()
+        path = os.path.join(self.directory.name, "import.jsonl")
+        with open(path, "w") as f:
+            for i in range(100):
+                f.write(json.dumps({"service": "github", "username": "user%d" % i, "password": "pw%d" % i}) + "\n")
+
+        statements = collections.Counter()
+        self.vault.connection.set_trace_callback(lambda sql: statements.update([sql.split(" FROM")[0]]))
+        self.assertEqual(self.vault.import_file(path), (100, 0))
+        self.assertLessEqual(statements["SELECT fingerprint_key"], 2)  # Before and after generating it.
+        self.assertLessEqual(statements["PRAGMA data_version;"], 1)
+
+    def test_backfill_keeps_newer_fingerprint(self):
+        self.vault.add("github", "me", "same")
+        self.vault.add("github", "you", "different")
+        self.vault.connection.execute("UPDATE account SET account_fp = NULL;")  # Stored before fingerprints.
+        self.vault.connection.commit()
+
+        def map_with_change(function, arg, chunks):
+            """ Change a password in another process after its chunk has been read, before it's written. """
+            for chunk in chunks:
+                result = function(arg, chunk)
+                with pwmanager.Vault(self.path) as other:
+                    other.update_account("github", "you", pw="same")
+                yield chunk, result
+
+        with mock.patch.object(pwmanager, "map_chunks", map_with_change):
+            self.assertEqual(self.vault.reused(), [[("github", "me"), ("github", "you")]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+""" Tests of the breach index: building one from a download, lookups, and damaged files. """
+import hashlib
+import itertools
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+
+def password_in_bucket(prefix):
+    """ Return a password whose SHA-1 hash starts with the given two bytes. """
+    for n in itertools.count():
+        password = "pw%d" % n
+        if hashlib.sha1(password.encode()).digest()[:2] == prefix:
+            return password
+
+
+class BreachIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.first = password_in_bucket(b"\x00\x00")  # The first and last buckets of the fanout table.
+        cls.last = password_in_bucket(b"\xff\xff")
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "breach.idx")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def build(self, passwords):
+        """ Build an index from a download of the passwords' hashes, with a few runs to merge. """
+        source = os.path.join(self.directory.name, "pwned.txt")
+        with open(source, "w") as f:
+            for n, password in enumerate(passwords):
+                digest = hashlib.sha1(password.encode()).hexdigest()
+                f.write("%s:%d\n" % (digest.upper() if n % 2 else digest, n + 1))
+        with mock.patch.object(pwmanager, "BREACH_RUN_SIZE", 2):
+            return pwmanager.build_breach_index(source, self.path)
+
+    def test_lookup(self):
+        breached = ["password", "123456", self.first, self.last, "password"]  # Duplicates are merged.
+        self.assertEqual(self.build(breached), 4)
+        with pwmanager.BreachIndex(self.path) as index:
+            self.assertEqual(len(index), 4)
+            for password in breached:
+                self.assertIn(password, index)
+            self.assertIn(self.first.encode(), index)
+            for password in ("correct horse", password_in_bucket(b"\x00\x01"), password_in_bucket(b"\xff\xfe")):
+                self.assertNotIn(password, index)
+
+    def test_empty_bucket_edges(self):
+        self.build(["password"])
+        with pwmanager.BreachIndex(self.path) as index:
+            self.assertNotIn(self.first, index)
+            self.assertNotIn(self.last, index)
+
+    def test_no_hashes(self):
+        self.assertEqual(self.build([]), 0)
+        with pwmanager.BreachIndex(self.path) as index:
+            self.assertNotIn("password", index)
+
+    def test_malformed(self):
+        self.build(["password", "123456"])
+        with open(self.path, "rb") as f:
+            index = f.read()
+        header = len(pwmanager.BREACH_INDEX_MAGIC) + 8 * pwmanager.BREACH_FANOUT
+        for damaged in (b"", index[:10], index[:header - 20], index[:-20], index[:-1], b"NOTANIDX" + index[8:]):
+            with open(self.path, "wb") as f:
+                f.write(damaged)
+            with self.assertRaisesRegex(pwmanager.VaultError, "isn't a breach index"):
+                pwmanager.BreachIndex(self.path)
+
+    def test_confirm_with_damaged_index(self):
+        open(self.path, "wb").close()  # Left empty, e.g. by an interrupted copy.
+        with mock.patch.dict(os.environ, PW_BREACH_INDEX=self.path):
+            with mock.patch("builtins.input", return_value="y"):
+                self.assertTrue(pwmanager.breach_confirm("password"))
+            with mock.patch("builtins.input", return_value="n"), mock.patch("builtins.print"):
+                self.assertFalse(pwmanager.breach_confirm("password"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+""" Tests of EXPORT archives and reading them back with IMPORT. """
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.vault = pwmanager.Vault(os.path.join(self.directory.name, "store.db"))
+        self.vault.create()
+        self.vault.define("github", "gh")
+        self.vault.add("github", " me ", " pass word ")
+        self.vault.add("github", "you", "pässwörd\t")
+        self.vault.define("jira")
+
+    def tearDown(self):
+        self.vault.close()
+        self.directory.cleanup()
+
+    def passwords(self, vault):
+        """ Return every account of a vault with its password as bytes. """
+        return sorted((service, shorthand, username, vault.get(service, username)[1].encode())
+                      for service, shorthand, username in vault.list(acc=True) if username is not None)
+
+    def round_trip(self, plain):
+        """ Export the vault and import the file into a new vault, then compare every password. """
+        path = os.path.join(self.directory.name, "export.csv" if plain else "export.pwm")
+        count, key = self.vault.export(path, plain)
+        self.assertEqual(count, 3)
+
+        with pwmanager.Vault(os.path.join(self.directory.name, "imported.db")) as imported:
+            imported.create()
+            self.assertEqual(imported.import_file(path, lambda: key), (2, 0))
+            self.assertEqual(self.passwords(imported), self.passwords(self.vault))
+            self.assertEqual(sorted(imported.list()), sorted(self.vault.list()))
+
+    def test_archive_round_trip(self):
+        self.round_trip(plain=False)
+
+    def test_plain_round_trip(self):
+        self.round_trip(plain=True)
+
+    def archive(self):
+        """ Export the vault with one row per chunk.
+
+        :return: the archive's path, its key and a Fernet cipher for it.
+        """
+        path = os.path.join(self.directory.name, "export.pwm")
+        with mock.patch.object(pwmanager, "EXPORT_CHUNK_SIZE", 1):
+            count, key = self.vault.export(path)
+        fernet = pwmanager.lazy_import("cryptography.fernet")
+        return path, key, fernet.Fernet(key.encode())
+
+    def rewrite(self, path, edit):
+        """ Replace the chunk lines of an archive, keeping its header. """
+        with open(path) as f:
+            header, *chunks = f.read().splitlines()
+        with open(path, "w") as f:
+            f.write("\n".join([header] + edit(chunks)) + "\n")
+
+    def assert_rejected(self, path, key, message):
+        """ Check that importing an archive fails with a message and imports nothing. """
+        with pwmanager.Vault(os.path.join(self.directory.name, "imported.db")) as imported:
+            imported.create()
+            with self.assertRaisesRegex(pwmanager.VaultError, message):
+                imported.import_file(path, lambda: key)
+            self.assertEqual(list(imported.list(acc=True)), [])
+
+    def test_archive_chunks(self):
+        path, key, cipher = self.archive()
+        with open(path) as f:
+            self.assertEqual(len(f.read().splitlines()), 5)  # Header, three rows and the end marker.
+
+    def test_reordered_chunks(self):
+        path, key, cipher = self.archive()
+        self.rewrite(path, lambda chunks: [chunks[1], chunks[0]] + chunks[2:])
+        self.assert_rejected(path, key, "out of order")
+
+    def test_missing_chunk(self):
+        path, key, cipher = self.archive()
+        self.rewrite(path, lambda chunks: chunks[:1] + chunks[2:])
+        self.assert_rejected(path, key, "out of order")
+
+    def test_truncated(self):
+        path, key, cipher = self.archive()
+        self.rewrite(path, lambda chunks: chunks[:-1])
+        self.assert_rejected(path, key, "truncated")
+
+    def test_wrong_count(self):
+        path, key, cipher = self.archive()
+        end = cipher.encrypt(json.dumps({"index": 3, "end": True, "count": 4}).encode()).decode()
+        self.rewrite(path, lambda chunks: chunks[:-1] + [end])
+        self.assert_rejected(path, key, "incomplete")
+
+    def test_malformed_chunk(self):
+        path, key, cipher = self.archive()
+        chunk = cipher.encrypt(json.dumps({"index": 0, "rows": "nonsense"}).encode()).decode()
+        self.rewrite(path, lambda chunks: [chunk] + chunks[1:])
+        self.assert_rejected(path, key, "malformed chunk")
+
+    def test_wrong_key(self):
+        path, key, cipher = self.archive()
+        other_key = pwmanager.lazy_import("cryptography.fernet").Fernet.generate_key().decode()
+        self.assert_rejected(path, other_key, "invalid export key")
+
+
+if __name__ == "__main__":
+    unittest.main()
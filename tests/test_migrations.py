@@ -0,0 +1,54 @@
+""" Tests of the schema migrations, starting from a store made by the original version. """
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "store.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_v0_store(self, services, accounts):
+        """ Create a store with the original schema, which had no constraints to keep accounts unique
+        or attached to a service.
+
+        :param services: (service, shorthand) rows.
+        :param accounts: (service, username, password) rows.
+        """
+        fernet = pwmanager.lazy_import("cryptography.fernet")
+        key = fernet.Fernet.generate_key()
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE service (service_name text PRIMARY KEY, shorthand_name text);")
+        connection.execute("""CREATE TABLE account (account_name text, account_pw text, service_name text NOT NULL,
+                           FOREIGN KEY (service_name) REFERENCES service(service_name));""")
+        connection.execute("CREATE TABLE encryption (key text);")
+        connection.execute("INSERT INTO encryption VALUES(?);", (key,))
+        connection.executemany("INSERT INTO service VALUES(?, ?);", services)
+        connection.executemany("INSERT INTO account VALUES(?, ?, ?);",
+                               [(username, fernet.Fernet(key).encrypt(pw.encode()).decode(), service)
+                                for service, username, pw in accounts])
+        connection.commit()
+        connection.close()
+
+    def test_no_password_is_dropped(self):
+        self.make_v0_store([("github", "gh")], [("github", "me", "first"), ("github", "me", "second"),
+                                                ("gitlab", "me", "orphaned")])
+        with pwmanager.Vault(self.path) as vault:
+            self.assertEqual(vault.get("github", "me"), ("me", "first"))
+            self.assertEqual(vault.get("github", "me (duplicate 2)"), ("me (duplicate 2)", "second"))
+            self.assertEqual(vault.get("gitlab", "me"), ("me", "orphaned"))
+            self.assertEqual(vault.verify(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
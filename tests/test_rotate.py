@@ -0,0 +1,56 @@
+""" Tests of ROTATE, run in-process instead of across a process pool. """
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+
+class RotateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "store.db")
+        self.vault = pwmanager.Vault(self.path)
+        self.vault.create()
+        self.vault.define("github")
+        self.vault.add("github", "me", "first")
+        self.vault.add("github", "you", "second")
+
+    def tearDown(self):
+        self.vault.close()
+        self.directory.cleanup()
+
+    @staticmethod
+    def map_in_process(function, arg, chunks):
+        """ Stand in for map_chunks() without a process pool. """
+        for chunk in chunks:
+            yield chunk, function(arg, chunk)
+
+    def test_rotate(self):
+        with mock.patch.object(pwmanager, "map_chunks", self.map_in_process):
+            self.vault.rotate()
+        self.assertEqual(self.vault.get("github", "me"), ("me", "first"))
+        self.assertFalse(self.vault.rotation_pending())
+        self.assertEqual(self.vault.verify(), [])
+
+    def test_change_during_rotation_is_kept(self):
+        def map_with_change(function, arg, chunks):
+            """ Change a password in another process after its chunk has been read, before it's written. """
+            for chunk, result in self.map_in_process(function, arg, chunks):
+                with pwmanager.Vault(self.path) as other:
+                    other.update_account("github", "me", pw="changed")
+                yield chunk, result
+
+        with mock.patch.object(pwmanager, "map_chunks", map_with_change):
+            self.vault.rotate()
+        self.assertEqual(self.vault.get("github", "me"), ("me", "changed"))
+        self.assertEqual(self.vault.get("github", "you"), ("you", "second"))
+        self.assertEqual(self.vault.verify(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+""" Tests of the service index's prefix and fuzzy lookups. """
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+
+def edit_distance(a, b):
+    """ Return the Levenshtein distance between two strings, by the textbook recurrence. """
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class ServiceIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = pwmanager.ServiceIndex()
+        self.index.add("github", "gh")
+        self.index.add("gitlab", "gl")
+        self.index.add("abcd")
+        self.index.add("jira")
+
+    def test_prefix(self):
+        self.assertEqual(self.index.prefix("git"), ["github", "gitlab"])
+        self.assertEqual(self.index.prefix("g", limit=2), ["gh", "github"])
+
+    def test_fuzzy(self):
+        self.assertEqual(self.index.fuzzy("githb"), ["github", "gitlab"])
+        self.assertEqual(self.index.fuzzy("abxy"), ["abcd"])  # Two substitutions.
+        self.assertEqual(self.index.fuzzy("gx"), ["github", "gitlab"])  # By shorthand.
+        self.assertEqual(self.index.fuzzy("zzzzzz"), [])
+
+    def test_fuzzy_after_remove(self):
+        self.index.remove("github", "gh")
+        self.assertEqual(self.index.fuzzy("githb"), ["gitlab"])
+
+    def test_within_every_distance(self):
+        keys = ["".join(chars) for length in range(5) for chars in itertools.product("abc", repeat=length)]
+        for key in keys:
+            self.index.add(key)
+        for name in ("", "a", "abd", "cab", "dddd", "abcab"):
+            for max_distance in range(3):
+                expected = sorted((edit_distance(name, key), key) for key in self.index.keys
+                                  if edit_distance(name, key) <= max_distance)
+                self.assertEqual(sorted(self.index.within(name, max_distance)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+""" Tests of SYNC's merge logic, on two vaults in a temporary directory. """
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmanager  # noqa: E402
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local = pwmanager.Vault(os.path.join(self.directory.name, "local.db"))
+        self.other = pwmanager.Vault(os.path.join(self.directory.name, "other.db"))
+        self.local.create()
+        self.other.create()
+        self.local.define("github", "gh")
+        self.local.add("github", "me", "first")
+        self.local.define("jira")
+        self.local.add("jira", "me", "second")
+        self.assertEqual(self.local.sync(self.other), (4, 0, []))
+
+    def tearDown(self):
+        self.local.close()
+        self.other.close()
+        self.directory.cleanup()
+
+    def accounts(self, vault):
+        """ Return every account of a vault with its decrypted password. """
+        return sorted((service, shorthand, username, vault.get(service, username)[1])
+                      for service, shorthand, username in vault.list(acc=True) if username is not None)
+
+    def test_rotate_is_not_a_change(self):
+        self.other.update_account("github", "me", pw="changed")
+        self.local.rotate()
+        sent, received, conflicts = self.local.sync(self.other)
+        self.assertEqual(conflicts, [])
+        self.assertEqual((sent, received), (0, 1))
+        self.assertEqual(self.local.get("github", "me"), ("me", "changed"))
+        self.assertEqual(self.other.get("github", "me"), ("me", "changed"))
+
+    def test_rename(self):
+        self.local.update_service("github", "gitlab", "gl")
+        sent, received, conflicts = self.local.sync(self.other)
+        self.assertEqual(conflicts, [])
+        self.assertEqual(received, 0)
+        self.assertEqual(self.accounts(self.other), [("gitlab", "gl", "me", "first"), ("jira", None, "me", "second")])
+        self.assertEqual(self.accounts(self.other), self.accounts(self.local))
+
+    def test_delete_and_change(self):
+        self.local.remove_service("jira")
+        self.other.add("jira", "you", "third")
+        sent, received, conflicts = self.local.sync(self.other)
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual(self.accounts(self.local), [("github", "gh", "me", "first"), ("jira", None, "me", "second"),
+                                                     ("jira", None, "you", "third")])
+        self.assertEqual(self.accounts(self.other), self.accounts(self.local))
+        self.assertEqual(self.local.sync(self.other), (0, 0, []))
+
+    def test_newer_change_wins(self):
+        self.local.update_account("github", "me", pw="older")
+        time.sleep(0.01)  # Change times have millisecond resolution; a tie goes to the local vault.
+        self.other.update_account("github", "me", pw="newer")
+        sent, received, conflicts = self.local.sync(self.other)
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual(self.local.get("github", "me"), ("me", "newer"))
+        self.assertEqual(self.other.get("github", "me"), ("me", "newer"))
+
+
+if __name__ == "__main__":
+    unittest.main()